@@ -0,0 +1,344 @@
+"""
+Non-interactive transcription of files or stdin, one utterance per line,
+spread over a pool of worker processes. The converters, dictionary and
+ruleset are loaded once and shared by the workers (see preload), and results
+are written in input order.
+"""
+
+import gc
+import json
+import multiprocessing
+from collections import OrderedDict
+import os
+import sys
+from pipeline import Pipeline, MultiPipeline, WordCache
+from rulestats import RULE_STATS
+from textparser import read_chunks
+from init import *
+
+
+FORMATS = ("tsv", "jsonl")
+
+# The Pipeline of the current worker process, and the arguments it was made with
+_pipeline = None
+_pipeline_args = None
+
+
+def _init_worker(ruleset_name, compiled=False, stats=False, vectorized=False):
+    global _pipeline, _pipeline_args
+    args = (ruleset_name, compiled, vectorized)
+    if args != _pipeline_args:
+        if isinstance(ruleset_name, str):
+            _pipeline = Pipeline(ruleset_name, compiled=compiled, vectorized=vectorized)
+        else:
+            _pipeline = MultiPipeline(ruleset_name, compiled=compiled, vectorized=vectorized)
+        _pipeline_args = args
+    if stats:
+        RULE_STATS.enable()
+
+
+def transcribe_text(pipeline, text):
+    """
+    Returns (broad, narrow, error, oov) for text. error is None unless it
+    failed, in which case narrow (and broad, if it could not be produced) is
+    None. oov is the list of the words of text that are out of the
+    dictionary, and so left out of the transcriptions.
+    
+    With a MultiPipeline, narrow is an OrderedDict {ruleset name: narrow or
+    None}, and error lists the rulesets that failed.
+    """
+    oov = []
+    if isinstance(pipeline, MultiPipeline):
+        return _merge(pipeline.transcribe(text, oov)) + (oov,)
+    found = pipeline.lookup(text)
+    if found is not None:
+        # only dictionary words are in the narrow table
+        return found + (None, oov)
+    broad_ipa = None
+    try:
+        broad_ipa = pipeline.to_broad(text, oov)
+        narrow_ipa = pipeline.to_narrow(broad_ipa)
+    except Exception as e:
+        return broad_ipa, None, "{}: {}".format(type(e).__name__, e), oov
+    return broad_ipa, narrow_ipa, None, oov
+
+
+def transcribe_broad(pipeline, broad_ipa):
+    """
+    Returns (broad, narrow, error) for the broad IPA broad_ipa, as
+    transcribe_text does for text
+    """
+    if isinstance(pipeline, MultiPipeline):
+        return _merge(pipeline.to_narrow(broad_ipa))
+    try:
+        return broad_ipa, pipeline.to_narrow(broad_ipa), None
+    except Exception as e:
+        return broad_ipa, None, "{}: {}".format(type(e).__name__, e)
+
+
+def _merge(results):
+    """Returns (broad, narrow, error) for the results of a MultiPipeline (see transcribe_text)"""
+    broad_ipa = next((broad for broad, narrow, error in results.values() if broad is not None), None)
+    narrow_ipa = OrderedDict((name, narrow) for name, (broad, narrow, error) in results.items())
+    errors = ["{}: {}".format(name, error) for name, (broad, narrow, error) in results.items() if error]
+    return broad_ipa, narrow_ipa, "; ".join(errors) or None
+
+
+def preload(initializer, initargs):
+    """
+    Prepares the current process to start a pool of workers, returning the
+    multiprocessing context to start them with.
+    
+    Where processes can be forked, initializer(*initargs) is run here, and the
+    workers are forked from this process: they start with its converters,
+    dictionary and Pipelines, which they share with it read-only (the
+    initializer must then do nothing when they are already loaded).
+    Otherwise, each worker loads them itself, mostly from the memory-mapped
+    caches (see readme.txt), which are shared all the same.
+    
+    What is loaded is kept from the garbage collector (gc.freeze()), so the
+    caller must call gc.unfreeze() once the workers are started.
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+    initializer(*initargs)
+    # the collector would otherwise write to every object it tracks, copying
+    # the shared pages into each worker as soon as it runs there
+    gc.freeze()
+    return multiprocessing.get_context("fork")
+
+
+def _transcribe(line):
+    """Returns (input, broad, narrow, error, oov) for one line of input"""
+    text = line.rstrip("\r\n")
+    return (text,) + transcribe_text(_pipeline, text)
+
+
+def _transcribe_chunk(lines):
+    """Returns ([_transcribe(line) for line in lines], snapshot of RULE_STATS for them)"""
+    RULE_STATS.reset()
+    return [_transcribe(line) for line in lines], RULE_STATS.snapshot()
+
+
+def _chunks(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_lines(filenames):
+    """Generator (str) over the lines of every file in filenames ("-" is stdin)"""
+    for filename in filenames:
+        if filename == "-":
+            yield from sys.stdin
+        else:
+            with open(filename, "r", encoding="utf-8") as f:
+                yield from f
+
+
+def transcribe_lines(lines, ruleset_name, workers=None, chunksize=64, compiled=False, stats=False,
+        vectorized=False):
+    """
+    Generator over (input, broad, narrow, error, oov) tuples for each line
+    in lines, in input order (see transcribe_text).
+    
+    ruleset_name: str or list (str)
+        Ruleset, or rulesets to transcribe each line with at once (see
+        MultiPipeline)
+    workers: int
+        Number of worker processes. Defaults to the number of CPUs. With a
+        single worker everything runs in the current process.
+    compiled: bool
+        Apply the ruleset with the compiled engine (see transducer.py)
+    stats: bool
+        Count what each rule does (see rulestats.py) in RULE_STATS of the
+        current process, adding up the counts of every worker
+    vectorized: bool
+        Apply the ruleset with the whole-context engine (see vectorized.py),
+        unless compiled
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        _init_worker(ruleset_name, compiled, stats, vectorized)
+        for line in lines:
+            yield _transcribe(line)
+        return
+    initargs = (ruleset_name, compiled, stats, vectorized)
+    context = preload(_init_worker, (ruleset_name, compiled, False, vectorized))
+    with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+        gc.unfreeze()
+        if not stats:
+            yield from pool.imap(_transcribe, lines, chunksize=chunksize)
+            return
+        for results, snapshot in pool.imap(_transcribe_chunk, _chunks(lines, chunksize)):
+            RULE_STATS.merge(snapshot)
+            yield from results
+
+
+def write_results(results, out, fmt="tsv", err=sys.stderr, first_line=1):
+    """
+    Writes results from transcribe_lines() to the file object out, as
+    tab-separated "input broad narrow" rows (with a narrow column per
+    ruleset, if there are several) or as JSON lines, whose "oov" is the list
+    of words out of the dictionary. Failed lines are reported to err
+    (numbered from first_line), and written with empty (or null)
+    transcriptions; so are the words left out of a line.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown output format '{}'".format(fmt))
+    for n, (text, broad_ipa, narrow_ipa, error, oov) in enumerate(results, first_line):
+        if error is not None:
+            print("line {}: {}".format(n, error), file=err)
+        if oov:
+            print("line {}: not in the dictionary: {}".format(n, " ".join(oov)), file=err)
+        if fmt == "jsonl":
+            record = {"input": text, "broad": broad_ipa, "narrow": narrow_ipa, "oov": oov}
+            if error is not None:
+                record["error"] = error
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            row = [text.replace("\t", " "), broad_ipa or ""]
+            if isinstance(narrow_ipa, dict):
+                row += [narrow or "" for narrow in narrow_ipa.values()]
+            else:
+                row.append(narrow_ipa or "")
+            out.write("\t".join(row) + "\n")
+
+
+def transcribe_document(pipeline, chunks):
+    """
+    Generator over (Token, broad, narrow, error) tuples for each word of a
+    text given as an iterable of str chunks of it, in order (see
+    TextParser.tokenize and transcribe_broad). The broad IPA of each word is
+    the one the tokenizer looked up, and the rules are applied to it on its
+    own, so they don't apply across words; the transcriptions of the most
+    recent words are reused. A word out of the dictionary has no
+    transcriptions, and no error either: see Token.oov.
+    """
+    if isinstance(pipeline, MultiPipeline):
+        tp = next(iter(pipeline.pipelines.values())).tp
+        oov_narrow = OrderedDict((name, None) for name in pipeline.pipelines)
+    else:
+        tp = pipeline.tp
+        oov_narrow = None
+    # a word has the same transcriptions wherever it is
+    cache = WordCache()
+    for token in tp.tokenize(chunks):
+        if token.oov:
+            yield token, None, oov_narrow, None
+            continue
+        result = cache.get(token.ipa)
+        if result is None:
+            result = transcribe_broad(pipeline, token.ipa)
+            cache.put(token.ipa, result)
+        yield (token,) + result
+
+
+def write_tokens(results, out, source, fmt="tsv", err=sys.stderr):
+    """
+    Writes results from transcribe_document() for the text of source (a
+    file name) to the file object out, as tab-separated "source start end
+    word oov broad narrow" rows (with a narrow column per ruleset, if there
+    are several; oov is "oov" or empty) or as JSON lines. Words that failed
+    are reported to err.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown output format '{}'".format(fmt))
+    for token, broad_ipa, narrow_ipa, error in results:
+        if error is not None:
+            print("{} {}-{}: {}".format(source, token.start, token.end, error), file=err)
+        if fmt == "jsonl":
+            record = {
+                "source": source, "start": token.start, "end": token.end, "text": token.text,
+                "oov": token.oov, "broad": broad_ipa, "narrow": narrow_ipa
+            }
+            if error is not None:
+                record["error"] = error
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            row = [source, str(token.start), str(token.end), token.text, "oov" if token.oov else "", broad_ipa or ""]
+            if isinstance(narrow_ipa, dict):
+                row += [narrow or "" for narrow in narrow_ipa.values()]
+            else:
+                row.append(narrow_ipa or "")
+            out.write("\t".join(row) + "\n")
+
+
+def run_document(ruleset_name, filenames, output=None, fmt="tsv", compiled=False, stats=None, vectorized=False):
+    """
+    Transcribes filenames ("-" is stdin) as running text, word by word, to
+    output (see write_tokens). The files are read a chunk at a time and
+    each word is written out as soon as it is transcribed, so memory
+    doesn't grow with their size. Everything runs in the current process.
+    """
+    if stats:
+        RULE_STATS.reset()
+    _init_worker(ruleset_name, compiled, bool(stats), vectorized)
+    out = sys.stdout if output is None or output == "-" else open(output, "w", encoding="utf-8", newline="")
+    try:
+        for filename in filenames or ["-"]:
+            if filename == "-":
+                write_tokens(transcribe_document(_pipeline, read_chunks(sys.stdin)), out, filename, fmt=fmt)
+            else:
+                with open(filename, "r", encoding="utf-8") as f:
+                    write_tokens(transcribe_document(_pipeline, read_chunks(f)), out, filename, fmt=fmt)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    if stats:
+        print(RULE_STATS.format_table(sort=stats), file=sys.stderr)
+
+
+def run_stream(ruleset_name, filenames, output=None):
+    """
+    Transcribes the text of each of filenames ("-" is stdin) as one
+    utterance, writing its narrow IPA to output (a line per file) as it is
+    made (see Pipeline.transcribe_stream), so that memory doesn't grow with
+    the length of the text. The words out of the dictionary, which are left
+    out, are reported to stderr. Everything runs in the current process.
+    """
+    pipeline = Pipeline(ruleset_name)
+    out = sys.stdout if output is None or output == "-" else open(output, "w", encoding="utf-8", newline="")
+    try:
+        for filename in filenames or ["-"]:
+            oov = []
+            if filename == "-":
+                out.writelines(pipeline.transcribe_stream(read_chunks(sys.stdin), oov))
+            else:
+                with open(filename, "r", encoding="utf-8") as f:
+                    out.writelines(pipeline.transcribe_stream(read_chunks(f), oov))
+            out.write("\n")
+            if oov:
+                print("{}: not in the dictionary: {}".format(filename, " ".join(oov)), file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def run_batch(ruleset_name, filenames, output=None, fmt="tsv", workers=None, chunksize=64, compiled=False,
+        stats=None, vectorized=False):
+    """
+    Transcribes the lines of filenames to output. If stats is the name of a
+    counter (see rulestats.FIELDS), the counters of every rule are printed
+    to stderr afterwards, sorted by it.
+    """
+    lines = read_lines(filenames or ["-"])
+    if stats:
+        RULE_STATS.reset()
+    results = transcribe_lines(
+        lines, ruleset_name, workers=workers, chunksize=chunksize, compiled=compiled,
+        stats=bool(stats), vectorized=vectorized
+    )
+    if output is None or output == "-":
+        write_results(results, sys.stdout, fmt=fmt)
+    else:
+        with open(output, "w", encoding="utf-8", newline="") as out:
+            write_results(results, out, fmt=fmt)
+    if stats:
+        print(RULE_STATS.format_table(sort=stats), file=sys.stderr)
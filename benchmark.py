@@ -0,0 +1,363 @@
+"""
+Benchmarks of loading, tokenizing, rule matching and end-to-end
+transcription.
+
+    $ python benchmark.py [-o results.json] [--compare [BASELINE]] [--save-baseline]
+
+The corpora are fixed: words sampled from data/dict-english.txt with a fixed
+seed, and sentences of several lengths made from them, so that runs on
+different versions of the code are comparable. Each benchmark is run
+several times, and its best time is the one compared. Results are written
+as JSON {"meta": {...}, "results": {name: {...}}}.
+
+--compare flags every benchmark whose best time is more than --threshold
+slower than in the baseline (by default benchmark-baseline.json, written by
+--save-baseline), and exits with status 1 if there are any. Timings depend
+on the machine, so a baseline should only be compared against on the
+machine it was made on.
+
+The import/ benchmarks time importing a module in a fresh interpreter.
+Importing has a budget (IMPORT_BUDGETS) whatever the baseline: a module that
+goes over it is flagged too.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from init import *
+
+
+BENCHMARK_VERSION = 1
+
+SEED = 1
+CORPUS_WORDS = 1000
+SENTENCE_LENGTHS = (1, 8, 32)
+SENTENCES = 50
+REPEAT = 5
+
+# Engines the pipeline is timed with: (name suffix, Pipeline arguments)
+ENGINES = (
+    ("", {}),
+    ("/compiled", {"compiled": True}),
+    ("/vectorized", {"vectorized": True}),
+)
+
+# Most seconds importing each module may take, on its own, in a fresh
+# interpreter. Importing must stay cheap for tools that only need part of the
+# package (eg the rule parser), so it must not read data files or import
+# anything heavy up front.
+IMPORT_BUDGETS = {
+    "init": 0.005,
+    "segment": 0.02,
+    "ipaconverter": 0.03,
+    "rules": 0.08,
+    "pipeline": 0.12,
+}
+
+DEFAULT_BASELINE = os.path.join(DIR, "benchmark-baseline.json")
+DEFAULT_THRESHOLD = 0.25
+
+
+def sample_words(n=CORPUS_WORDS, seed=SEED, language="english"):
+    """Returns n (lower case) words sampled from the text dictionary of language"""
+    from dictionary import read_text_dictionary
+    words = sorted(read_text_dictionary(os.path.join(DATA_DIR, "dict-" + language + ".txt")))
+    return [word.lower() for word in random.Random(seed).sample(words, n)]
+
+
+def sample_sentences(words, length, n=SENTENCES, seed=SEED):
+    """Returns n sentences of length words each, picked from words"""
+    rng = random.Random(seed + length)
+    return [" ".join(rng.choice(words) for k in range(length)) for s in range(n)]
+
+
+def time_call(fn, repeat=REPEAT):
+    """Returns (the seconds each of repeat calls of fn took, what the last call returned)"""
+    times = []
+    for r in range(repeat):
+        t = time.perf_counter()
+        value = fn()
+        times.append(time.perf_counter() - t)
+    return times, value
+
+
+def time_import(module, repeat=REPEAT):
+    """Returns the seconds each of repeat imports of module in a fresh interpreter took"""
+    code = "import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)".format(module)
+    env = dict(os.environ)
+    # with stale bytecode, every import would time compiling the module
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    times = []
+    for r in range(repeat + 1):
+        out = subprocess.run(
+            [sys.executable, "-c", code], cwd=DIR, env=env, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+        ).stdout
+        times.append(float(out.split()[-1]))
+    # the first one may have written the bytecode
+    return times[1:]
+
+
+def bundled_rulesets():
+    return sorted(fn[:-len(".txt")] for fn in os.listdir(os.path.join(DIR, "rulesets")) if fn.endswith(".txt"))
+
+
+class Suite:
+    """
+    Runs the benchmarks whose names match any of patterns (fnmatch patterns,
+    all of them if there are none), collecting their results.
+    
+    Attributes
+    ------------------------
+    results: dict {str: dict}
+        {name: {"best": s, "median": s, "repeat": int, "items": int, ...}}
+        in the order they were run. items is the number of inputs one call
+        goes through (words, sentences or contexts), if any.
+    """
+    def __init__(self, patterns=(), repeat=REPEAT, verbose=True):
+        self.patterns = list(patterns)
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = {}
+        
+    def wants(self, prefix):
+        """Returns True if a benchmark whose name starts with prefix may be selected"""
+        if not self.patterns:
+            return True
+        for pattern in self.patterns:
+            literal = pattern
+            for c in "*?[":
+                literal = literal.split(c)[0]
+            if prefix.startswith(literal) or literal.startswith(prefix):
+                return True
+        return False
+        
+    def selected(self, name):
+        return not self.patterns or any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)
+        
+    def run(self, name, fn, items=None, value_key=None):
+        """
+        Times fn if name is selected. If value_key is given, what fn returns
+        is kept in the result under it.
+        """
+        if not self.selected(name):
+            return
+        times, value = time_call(fn, self.repeat)
+        result = self.add(name, times)
+        if items is not None:
+            result["items"] = items
+        if value_key is not None:
+            result[value_key] = value
+            
+    def add(self, name, times):
+        """Adds the result of a benchmark that took times, and returns it"""
+        result = self.results[name] = {
+            "best": min(times),
+            "median": statistics.median(times),
+            "repeat": len(times),
+        }
+        if self.verbose:
+            print("{:<60} {:>10.2f} ms".format(name, result["best"] * 1000), file=sys.stderr)
+        return result
+        
+    def run_imports(self):
+        for module, budget in IMPORT_BUDGETS.items():
+            name = "import/" + module
+            if self.selected(name):
+                result = self.add(name, time_import(module, self.repeat))
+                result["budget"] = budget
+                result["over_budget"] = result["best"] > budget
+    
+    def over_budget(self):
+        """Returns the names of the benchmarks that went over their budget"""
+        return [name for name, result in self.results.items() if result.get("over_budget")]
+            
+    def run_all(self, rulesets=None):
+        self.run_imports()
+        if not any(self.wants(prefix) for prefix in ("load/", "tokenize/", "ruleset/", "pipeline/")):
+            return
+            
+        from ipaconverter import IpaConverter
+        from textparser import TextParser
+        
+        if IpaConverter.FULL is None:
+            IpaConverter.initialize_full()
+        icf = IpaConverter.FULL
+        ic = IpaConverter("english")
+        tp = TextParser("english", ipa_converter=icf)
+        words = sample_words()
+        sentences = {length: sample_sentences(words, length) for length in SENTENCE_LENGTHS}
+        broad = [tp.to_ipa(word) for word in words]
+        
+        self.run("load/ipa-converter/full", lambda: IpaConverter("full"))
+        self.run("load/ipa-converter/english", lambda: IpaConverter("english"))
+        self.run("load/dictionary/english", tp.load_dictionary)
+        self.run("tokenize/to_segments", lambda: [ic.to_segments(ipa) for ipa in broad], items=len(broad))
+        
+        for ruleset_name in rulesets or bundled_rulesets():
+            if self.wants("ruleset/" + ruleset_name) or self.wants("load/ruleset/" + ruleset_name) \
+                    or self.wants("pipeline/" + ruleset_name):
+                self.run_ruleset(ruleset_name, ic, icf, broad, words, sentences)
+    
+    def run_ruleset(self, ruleset_name, ic, icf, broad, words, sentences):
+        from rules import load_ruleset
+        from pipeline import Pipeline
+        
+        self.run("load/ruleset/{}".format(ruleset_name), lambda: load_ruleset(ruleset_name, ic, icf))
+        self.run(
+            "load/ruleset/{}/parse".format(ruleset_name),
+            lambda: load_ruleset(ruleset_name, ic, icf, use_cache=False)
+        )
+        
+        # each Rule on the contexts it gets in the pipeline
+        rules = load_ruleset(ruleset_name, ic, icf)
+        contexts = [ic.to_segments(ipa) for ipa in broad]
+        for k, rule in enumerate(rules):
+            name = "ruleset/{}/{:02d} {}".format(ruleset_name, k, rule.name or "(rule)")
+            self.run(name, lambda: _apply_each(rule, contexts), items=len(contexts))
+            contexts = [context for context in _apply_each(rule, contexts) if context is not None]
+            
+        # the whole pipeline with each engine, without its caches
+        for suffix, engine in ENGINES:
+            if not self.wants("pipeline/" + ruleset_name):
+                break
+            pipeline = Pipeline(ruleset_name, word_cache_size=0, use_table=False, **engine)
+            name = "pipeline/{}/words{}".format(ruleset_name, suffix)
+            self.run(name, lambda: _transcribe_each(pipeline, words), items=len(words), value_key="failed")
+            for length, texts in sentences.items():
+                name = "pipeline/{}/sentences-{}{}".format(ruleset_name, length, suffix)
+                self.run(name, lambda: _transcribe_each(pipeline, texts), items=len(texts), value_key="failed")
+
+
+def _apply_each(rule, contexts):
+    """Returns the result of rule on each of contexts, None where it fails"""
+    results = []
+    for context in contexts:
+        try:
+            results.append(rule.apply(context))
+        except Exception:
+            results.append(None)
+    return results
+
+
+def _transcribe_each(pipeline, texts):
+    """Transcribes each of texts, returning the number that failed"""
+    failed = 0
+    for text in texts:
+        try:
+            pipeline.transcribe(text)
+        except Exception:
+            failed += 1
+    return failed
+
+
+def metadata():
+    return {
+        "version": BENCHMARK_VERSION,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seed": SEED,
+        "corpus_words": CORPUS_WORDS,
+        "sentence_lengths": list(SENTENCE_LENGTHS),
+        "sentences": SENTENCES,
+    }
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Returns [(name, baseline best, best, ratio)] of every benchmark in both
+    results and baseline, and the names of those whose best time regressed
+    by more than threshold (a fraction)
+    """
+    rows = []
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or not base["best"]:
+            continue
+        ratio = result["best"] / base["best"]
+        rows.append((name, base["best"], result["best"], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_comparison(rows, regressions, out=sys.stdout):
+    print("{:<60} {:>12} {:>12} {:>8}".format("benchmark", "baseline ms", "ms", "ratio"), file=out)
+    for name, base, best, ratio in rows:
+        flag = "  REGRESSION" if name in regressions else ""
+        print("{:<60} {:>12.2f} {:>12.2f} {:>8.2f}{}".format(name, base * 1000, best * 1000, ratio, flag), file=out)
+    print("\n{} of {} benchmarks regressed".format(len(regressions), len(rows)), file=out)
+
+
+def read_results(filename):
+    with open(filename, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("meta", {}).get("version") != BENCHMARK_VERSION:
+        raise ValueError("{} is from a different version of the benchmarks".format(filename))
+    return data
+
+
+def write_results(data, filename):
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1, ensure_ascii=False)
+        f.write("\n")
+
+
+def read_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the pyphone benchmarks")
+    parser.add_argument("patterns", nargs="*", metavar="PATTERN",
+        help="only run benchmarks whose names match a glob PATTERN, e.g. 'pipeline/*'")
+    parser.add_argument("-r", "--ruleset", action="append", default=None,
+        help="only benchmark this ruleset (default: every bundled ruleset). Can be repeated")
+    parser.add_argument("-n", "--repeat", type=int, default=REPEAT, help="times each benchmark is run")
+    parser.add_argument("-o", "--output", metavar="FILE", help="write the results as JSON to FILE")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, metavar="BASELINE",
+        help="compare against BASELINE (default {})".format(os.path.basename(DEFAULT_BASELINE)))
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+        help="slowdown (as a fraction) flagged as a regression")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, metavar="BASELINE",
+        help="write the results as the new baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = read_args(argv)
+    suite = Suite(args.patterns, repeat=args.repeat)
+    suite.run_all(args.ruleset)
+    data = {"meta": metadata(), "results": suite.results}
+    
+    status = 0
+    for name in suite.over_budget():
+        result = suite.results[name]
+        print("{} took {:.2f} ms, over its budget of {:.2f} ms".format(
+            name, result["best"] * 1000, result["budget"] * 1000), file=sys.stderr)
+        status = 1
+        
+    if args.output:
+        write_results(data, args.output)
+    if args.save_baseline:
+        write_results(data, args.save_baseline)
+    if args.compare:
+        baseline = read_results(args.compare)
+        rows, regressions = compare(suite.results, baseline["results"], args.threshold)
+        print_comparison(rows, regressions)
+        return 1 if regressions else status
+    if not args.output and not args.save_baseline:
+        json.dump(data, sys.stdout, indent=1, ensure_ascii=False)
+        print()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
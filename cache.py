@@ -0,0 +1,81 @@
+"""
+Helpers for on-disk caches of derived data (compiled rulesets, binary
+dictionaries, etc). Caches are an optimization only: a cache that can't be
+read is rebuilt, and one that can't be written is skipped.
+"""
+
+import hashlib
+import os
+import pickle
+from init import *
+
+
+CACHE_DIR = os.path.join(DIR, "cache")
+
+
+def cache_path(*parts):
+    return os.path.join(CACHE_DIR, *parts)
+
+
+def hash_files(*filenames, extra=()):
+    """Returns a hex digest of the contents of filenames, plus any str in extra"""
+    h = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            h.update(f.read())
+        h.update(b"\0")
+    for s in extra:
+        h.update(str(s).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def atomic_write(filename, write):
+    """
+    Calls write(f) with a binary file object, then moves the file into place
+    at filename, so readers never see a partially written file. Returns
+    False if the file could not be written.
+    """
+    # only needed to write, so not imported with the module
+    import tempfile
+    try:
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+    except OSError:
+        return False
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        # readable by every process that shares the cache, like a normal file
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def read_pickle(filename, key):
+    """
+    Returns the object pickled in filename by write_pickle() if it was
+    stored under key, otherwise None
+    """
+    try:
+        with open(filename, "rb") as f:
+            if pickle.load(f) != key:
+                return None
+            return pickle.load(f)
+    except Exception:
+        # missing, stale or unreadable cache
+        return None
+
+
+def write_pickle(filename, key, obj):
+    def write(f):
+        pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return atomic_write(filename, write)
@@ -0,0 +1,232 @@
+"""
+Checkpoints of the intermediate forms of every dictionary word after each
+rule of a ruleset, so that the narrow table (see narrowtable.py) can be
+rebuilt incrementally after the ruleset is edited.
+
+Checkpoints are keyed by fingerprints: fingerprint 0 hashes the data files,
+and fingerprint k hashes fingerprint k-1 with the text of rule k, so it
+identifies everything that the forms after rule k depend on. Checkpoint 0
+holds the broad IPA and the tokenized form of every word; checkpoint k only
+holds the words that rule k changed (its delta). A word a rule fails on has
+the form None from then on.
+
+A rebuild diffs the rules against those of the last build of the ruleset
+(its manifest), and goes through them in order:
+- a rule that is unchanged keeps its old delta for every word whose form is
+  the same as it was in the last build, and is only applied to the other,
+  dirty, words
+- a new or edited rule is applied to every word, and the words it leaves in
+  a different form than the last build did become dirty
+- a removed rule makes the words it had changed dirty
+So after one rule is edited, only that rule is run over the whole
+dictionary, and the rules after it only over the words whose form it
+changed.
+"""
+
+import difflib
+import glob
+import hashlib
+import os
+from multiprocessing import Pool
+from cache import cache_path, hash_files, read_pickle, write_pickle
+from rules import RULESET_CACHE_VERSION
+from init import *
+
+
+# Bump when the form of checkpoints or manifests changes
+CHECKPOINT_VERSION = 1
+
+# The Pipeline of the current worker process of a full build
+_pipeline = None
+
+
+def checkpoint_dir(language="english"):
+    return cache_path("checkpoints", language)
+
+
+def _checkpoint_path(language, fingerprint):
+    return os.path.join(checkpoint_dir(language), fingerprint + ".pickle")
+
+
+def _manifest_path(language, ruleset_name):
+    return os.path.join(checkpoint_dir(language), ruleset_name + ".manifest")
+
+
+def fingerprints(pipeline):
+    """Returns the fingerprints of the data and of each rule of pipeline, in order"""
+    fps = [hash_files(
+        pipeline.ic.filename,
+        pipeline.icf.filename,
+        pipeline.tp.filename,
+        extra=(CHECKPOINT_VERSION, RULESET_CACHE_VERSION)
+    )]
+    for rule in pipeline.rules:
+        fps.append(hashlib.sha256((fps[-1] + "\0" + rule.literal).encode("utf-8")).hexdigest())
+    return fps
+
+
+def _apply_rule(engine, k, form):
+    """Returns form after rule k of engine (a RulesetTransducer), or None if the rule fails"""
+    try:
+        return tuple(engine.apply(list(form), k, k + 1))
+    except Exception:
+        return None
+
+
+def _init_worker(ruleset_name, language):
+    global _pipeline
+    from pipeline import Pipeline
+    _pipeline = Pipeline(
+        ruleset_name, language=language, compiled=True, word_cache_size=0, use_table=False
+    )
+
+
+def _run_word(word):
+    """Returns (word, broad, form, [(k, form after rule k) for every rule k that changes form])"""
+    broad_ipa = _pipeline.to_broad(word)
+    try:
+        form = tuple(_pipeline.ic.to_segments(broad_ipa))
+    except ValueError:
+        return word, broad_ipa, None, []
+    initial = form
+    changes = []
+    for k in range(len(_pipeline.rules)):
+        new_form = _apply_rule(_pipeline.transducer, k, form)
+        if new_form != form:
+            changes.append((k, new_form))
+            form = new_form
+            if form is None:
+                break
+    return word, broad_ipa, initial, changes
+
+
+def _full_build(pipeline, words, workers, chunksize):
+    """Returns (initial, deltas) for words, running every rule on every word"""
+    initial = {}
+    deltas = [{} for rule in pipeline.rules]
+    
+    def collect(results):
+        for word, broad_ipa, form, changes in results:
+            initial[word] = (broad_ipa, form)
+            for k, new_form in changes:
+                deltas[k][word] = new_form
+    
+    args = (pipeline.ruleset_name, pipeline.tp.name)
+    if workers <= 1:
+        _init_worker(*args)
+        collect(map(_run_word, words))
+    else:
+        with Pool(workers, initializer=_init_worker, initargs=args) as pool:
+            collect(pool.imap_unordered(_run_word, words, chunksize=chunksize))
+    return initial, deltas
+
+
+def _incremental_build(pipeline, initial, old_literals, old_deltas):
+    """Returns the deltas of pipeline's rules, given those of the last build"""
+    engine = pipeline.transducer
+    literals = [rule.literal for rule in pipeline.rules]
+    deltas = [None] * len(literals)
+    forms = {word: form for word, (broad_ipa, form) in initial.items()}
+    # forms of the last build at the same point
+    old_forms = dict(forms)
+    dirty = set()
+    
+    matcher = difflib.SequenceMatcher(None, old_literals, literals, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for i, k in zip(range(i1, i2), range(j1, j2)):
+                delta = {}
+                for word, form in old_deltas[i].items():
+                    old_forms[word] = form
+                    if word not in dirty:
+                        forms[word] = form
+                        delta[word] = form
+                for word in list(dirty):
+                    form = forms[word]
+                    if form is not None:
+                        new_form = _apply_rule(engine, k, form)
+                        if new_form != form:
+                            forms[word] = delta[word] = new_form
+                    if forms[word] == old_forms[word]:
+                        dirty.discard(word)
+                deltas[k] = delta
+        else:
+            for i in range(i1, i2):
+                old_forms.update(old_deltas[i])
+            for k in range(j1, j2):
+                delta = {}
+                for word, form in forms.items():
+                    if form is not None:
+                        new_form = _apply_rule(engine, k, form)
+                        if new_form != form:
+                            forms[word] = delta[word] = new_form
+                deltas[k] = delta
+            dirty = {word for word, form in forms.items() if form != old_forms[word]}
+    return deltas
+
+
+def build_forms(pipeline, workers=None, chunksize=256):
+    """
+    Returns {word: (broad, form)} of every word in pipeline's dictionary,
+    where form is the tuple of Segments/boundaries after all of pipeline's
+    rules, or None if the word could not be transcribed. pipeline must have
+    been made with compiled=True.
+    
+    Reuses the checkpoints of the last build of the ruleset if there are
+    any, and writes new ones.
+    """
+    language = pipeline.tp.name
+    fps = fingerprints(pipeline)
+    manifest_fn = _manifest_path(language, pipeline.ruleset_name)
+    
+    initial = read_pickle(_checkpoint_path(language, fps[0]), fps[0])
+    manifest = read_pickle(manifest_fn, CHECKPOINT_VERSION)
+    old_deltas = None
+    if initial is not None and manifest is not None and manifest[0] == fps[0]:
+        old_literals, old_fps = manifest[1], manifest[2]
+        old_deltas = []
+        for fp in old_fps:
+            delta = read_pickle(_checkpoint_path(language, fp), fp)
+            if delta is None:
+                old_deltas = None
+                break
+            old_deltas.append(delta)
+            
+    if old_deltas is None:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        words = [word.lower() for word in pipeline.tp.words()]
+        initial, deltas = _full_build(pipeline, words, workers, chunksize)
+        write_pickle(_checkpoint_path(language, fps[0]), fps[0], initial)
+    else:
+        deltas = _incremental_build(pipeline, initial, old_literals, old_deltas)
+        
+    for fp, delta in zip(fps[1:], deltas):
+        if not os.path.isfile(_checkpoint_path(language, fp)):
+            write_pickle(_checkpoint_path(language, fp), fp, delta)
+    literals = [rule.literal for rule in pipeline.rules]
+    write_pickle(manifest_fn, CHECKPOINT_VERSION, (fps[0], literals, fps[1:]))
+    _remove_unused(language)
+    
+    forms = {}
+    for word, (broad_ipa, form) in initial.items():
+        forms[word] = form
+    for delta in deltas:
+        forms.update(delta)
+    return {word: (initial[word][0], form) for word, form in forms.items()}
+
+
+def _remove_unused(language):
+    """Deletes the checkpoints that no manifest refers to"""
+    used = set()
+    for manifest_fn in glob.glob(os.path.join(checkpoint_dir(language), "*.manifest")):
+        manifest = read_pickle(manifest_fn, CHECKPOINT_VERSION)
+        if manifest is not None:
+            used.add(manifest[0])
+            used.update(manifest[2])
+    for fn in glob.glob(os.path.join(checkpoint_dir(language), "*.pickle")):
+        if os.path.basename(fn)[:-len(".pickle")] not in used:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
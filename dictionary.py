@@ -0,0 +1,191 @@
+"""
+Binary, memory-mapped form of the "data/dict-<name>.txt" phonetic
+dictionaries.
+
+The binary file is built from the text file and is searched in place, so
+opening it costs next to nothing and every process using it shares the same
+pages of the OS page cache.
+
+The same format holds any {word: str} table, eg the precompiled narrow
+transcriptions of narrowtable.py, along with a key identifying what the
+table was made from.
+
+Layout (integers are little-endian uint32):
+    MAGIC
+    version, count, table_size, key (32 bytes, all zero if there is none)
+    offsets: count + 1 offsets of the records, relative to the record data
+    hash table: table_size slots holding record index + 1 (0 if empty),
+        open addressing with linear probing on zlib.crc32 of the word
+    record data: "<word>\\t<ipa>" utf-8 records, sorted by word
+"""
+
+import mmap
+import os
+import struct
+import zlib
+from collections.abc import Mapping
+from cache import atomic_write
+
+
+MAGIC = b"PYPHDICT"
+VERSION = 3
+_HEADER = struct.Struct("<III32s")
+_NO_KEY = bytes(32)
+_OFFSET = struct.Struct("<I")
+_DATA_START = len(MAGIC) + _HEADER.size
+
+
+def read_text_dictionary(filename):
+    """Returns a dict {word: ipa} of the text dictionary in filename"""
+    d = {}
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            if line[0] == "#":
+                continue
+            line = line.strip()
+            word, p = line.split("  ")
+            p = p.replace("g", "ɡ")
+            
+            d[word] = p
+    return d
+
+
+def build_binary_dictionary(text_filename, filename):
+    """
+    Writes the binary form of the text dictionary text_filename to filename.
+    Returns False if it could not be written.
+    """
+    return write_binary_dictionary(read_text_dictionary(text_filename), filename)
+
+
+def write_binary_dictionary(d, filename, key=None):
+    """
+    Writes the dict {word: str} d to filename in binary form, with key (a
+    hex digest, see cache.hash_files) if given. Returns False if it could not
+    be written.
+    """
+    key = bytes.fromhex(key) if key else _NO_KEY
+    words = sorted(word.encode("utf-8") for word in d)
+    
+    table_size = 1
+    while table_size < len(words) * 2:
+        table_size *= 2
+    table = [0] * table_size
+    for i, word in enumerate(words):
+        slot = zlib.crc32(word) & (table_size - 1)
+        while table[slot]:
+            slot = (slot + 1) & (table_size - 1)
+        table[slot] = i + 1
+        
+    def write(f):
+        f.write(MAGIC)
+        f.write(_HEADER.pack(VERSION, len(words), table_size, key))
+        offset = 0
+        records = []
+        for word in words:
+            record = word + b"\t" + d[word.decode("utf-8")].encode("utf-8")
+            records.append(record)
+            f.write(_OFFSET.pack(offset))
+            offset += len(record)
+        f.write(_OFFSET.pack(offset))
+        f.write(struct.pack("<{}I".format(table_size), *table))
+        for record in records:
+            f.write(record)
+    return atomic_write(filename, write)
+
+
+class BinaryDictionary(Mapping):
+    """
+    Read-only {word: ipa} Mapping over a memory-mapped binary dictionary file.
+    Lookups go through the hash table; iteration is in sorted order.
+    
+    Attributes
+    ------------------------
+    filename: str
+    key: str or None
+        Hex digest the file was written with, if any
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(filename + " is not a binary dictionary")
+        try:
+            version, self._count, self._table_size, key = _HEADER.unpack_from(self._mm, len(MAGIC))
+        except struct.error:
+            self.close()
+            raise ValueError(filename + " is truncated")
+        if version != VERSION:
+            self.close()
+            raise ValueError("{} has version {}, expected {}".format(filename, version, VERSION))
+        self.key = key.hex() if key != _NO_KEY else None
+        self._table_start = _DATA_START + _OFFSET.size * (self._count + 1)
+        self._records_start = self._table_start + _OFFSET.size * self._table_size
+        # the records end where the file does
+        size = len(self._mm)
+        if size < self._records_start or self._records_start + self._offset(self._count) != size:
+            self.close()
+            raise ValueError(filename + " is truncated")
+        
+    @classmethod
+    def open(cls, text_filename, filename):
+        """
+        Opens the binary dictionary filename, (re)building it from
+        text_filename first if it is missing, outdated, truncated or invalid.
+        Returns None if it could not be built.
+        """
+        try:
+            if os.path.getmtime(filename) >= os.path.getmtime(text_filename):
+                return cls(filename)
+        except (OSError, ValueError, struct.error):
+            pass
+        if not build_binary_dictionary(text_filename, filename):
+            return None
+        return cls(filename)
+        
+    def close(self):
+        self._mm.close()
+        
+    def _offset(self, i):
+        """Returns the offset of record i, relative to the record data"""
+        return _OFFSET.unpack_from(self._mm, _DATA_START + _OFFSET.size * i)[0]
+        
+    def _record(self, i):
+        """Returns the (start, end) of record i in the file"""
+        return self._records_start + self._offset(i), self._records_start + self._offset(i + 1)
+        
+    def _split(self, i):
+        start, end = self._record(i)
+        tab = self._mm.find(b"\t", start, end)
+        return self._mm[start:tab], tab + 1, end
+        
+    def _find(self, key):
+        """Returns the (start, end) of the ipa of key in the file, or None"""
+        mask = self._table_size - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            i, = _OFFSET.unpack_from(self._mm, self._table_start + _OFFSET.size * slot)
+            if not i:
+                return None
+            word, start, end = self._split(i - 1)
+            if word == key:
+                return start, end
+            slot = (slot + 1) & mask
+            
+    def __getitem__(self, word):
+        found = self._find(word.encode("utf-8"))
+        if found is None:
+            raise KeyError(word)
+        return self._mm[found[0]:found[1]].decode("utf-8")
+        
+    def __contains__(self, word):
+        return isinstance(word, str) and self._find(word.encode("utf-8")) is not None
+        
+    def __len__(self):
+        return self._count
+        
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._split(i)[0].decode("utf-8")
@@ -1,13 +1,10 @@
-import os.path
-import csv
-
+"""
+Constants shared by every module. Importing this has no side effects and
+reads no files; configuration (eg tracing, see tracing.py) is up to the
+program that uses the package.
+"""
 
-import sys
-V = "-v" in sys.argv
-print("verbose:", V)
-def vpr(*args, i=0):
-    if V:
-        print("  " * i, *args)
+import os.path
 
 
 DIR = os.path.split(__file__)[0]
@@ -17,28 +14,40 @@ DATA_DIR = os.path.join(DIR, "data")
 # boundaries
 SYLL_B = "<syll>"
 WORD_B = "<word>"
-BOUNDARIES = (SYLL_B, WORD_B)
+BOUNDARIES = frozenset((SYLL_B, WORD_B))
 
 NULL = ""
 NULLSIGN = "Ø"
 STATICSIGN = "◯"
 
-def __load_featureset():
-    filename = "ipa-full.csv"
-    filename = os.path.join(DATA_DIR, filename)
-    if not os.path.isfile(filename):
-        raise IOError(filename + " does not exist. There must be a complete feature matrix contained in this file.")
-        
-    featureset = set()
-    with open(filename, "r", newline="", encoding="utf-8") as f:
-        reader = csv.reader(filter(lambda row: not row[0] == "#", f))
-        header = next(reader)
-        if not header or len(header) < 3 or header[0] != "ipa" or header[-1] != "name":
-            raise ValueError(filename + " is invalid")
-        featureset = set(header[1:-1])
-    return featureset
+# The features of the full IPA csv, in the bit order of packed Segments (see
+# segment.py). Every IPA csv must have exactly these feature columns, which
+# IpaConverter checks when it loads one, so a feature added to the csv files
+# has to be added here too.
+FEATURES = (
+    "syl", "son", "cons", "cont", "delrel", "lat", "nas", "strid", "voi", "sg",
+    "cg", "ant", "cor", "distr", "lab", "hi", "lo", "back", "front", "round",
+    "velaric", "tense", "long", "hitone", "hireg"
+)
+FEATURESET = set(FEATURES)
+
+
+_regex = None
+
 
-FEATURESET = __load_featureset()
+def regex_module():
+    """
+    Returns the regex module if it is installed, otherwise re. It is
+    imported on first use, as importing regex is slow.
+    """
+    global _regex
+    if _regex is None:
+        try:
+            import regex
+        except ImportError:
+            import re as regex
+        _regex = regex
+    return _regex
 
 GREEK_ALPHABET = {
     "alpha": "α",
@@ -1,11 +1,34 @@
 import csv
+import mmap
 import os.path
+import struct
+import sys
+from array import array
 from segment import Segment
+from cache import atomic_write, cache_path, hash_files
 from init import *
 
 
 FULL_NAME = "full"
 
+NO_SYMBOL = "<NO SYMBOL>"
+
+# How get_ipa_symbol renders a Segment that isn't in the inventory (see
+# nearest.py): as the nearest symbol, or as the nearest symbol plus diacritics
+NEAREST = "nearest"
+COMPOSE = "compose"
+
+# Cached tables of the csv files (see IpaConverter.load_table).
+# Layout (integers are little-endian):
+#     TABLE_MAGIC
+#     version, count (uint32), key (32 bytes, hash of the csv and FEATURES)
+#     bits: count uint64, the packed features of each symbol, in csv order
+#     symbols: utf-8 "<ipa>\t<name>" records, separated by "\n", in csv order
+TABLE_MAGIC = b"PYPHIPAT"
+TABLE_VERSION = 1
+_TABLE_HEADER = struct.Struct("<II32s")
+_TABLE_START = len(TABLE_MAGIC) + _TABLE_HEADER.size
+
 
 class IpaConverter:
     """
@@ -16,15 +39,29 @@ class IpaConverter:
     name: str
         Converter name. Should match an existing "data/ipa-<name>.csv"
         file to be loaded.
-    names: list (str)
+    filename: str
+        Path of the "data/ipa-<name>.csv" file
+    names: dict {str: str}
         names of IPA phonemes as listed in the csv file under "name" col.
-        Generally not used for anything other than maybe debugging.
+        Generally not used for anything other than maybe debugging, so when
+        the table is memory-mapped, it is only read from it on first use.
+    symbols: list (str)
+        IPA symbols in csv order
+    bits: sequence (int)
+        Packed features (see segment.pack_features) of each of symbols: the
+        inventory's feature matrix. It is a view of the memory-mapped table
+        (see load_table) if there is one, so that processes share it.
+    fallback: str or None
+        How a Segment that isn't in the inventory is converted: NEAREST,
+        COMPOSE or None for NO_SYMBOL. Results are memoized per Segment.
         
     _ipa_seg_dict: dict {str: Segment}
         Mapping of IPA representation to Segment
-    _seg_ipa_dict: dict {frozenset: str}
-        Mapping of Segment to IPA representation. Segment is represented by a
-        frozenset (for hashing) provided by _to_set_key() method
+    _seg_ipa_dict: dict {int: str}
+        Mapping of Segment to IPA representation. Segment is represented by
+        its packed features, provided by its get_hash() method
+    _trie: dict
+        Prefix trie of the IPA symbols, used for tokenizing (see _build_trie)
     
         
     """
@@ -35,16 +72,28 @@ class IpaConverter:
     
     default = None
     
-    def __init__(self, name):
+    def __init__(self, name, fallback=NEAREST):
         """
         
         """
         self.name = name
+        self.fallback = fallback
+        self.filename = os.path.join(DATA_DIR, "ipa-" + self.name + ".csv")
         self._ipa_seg_dict = None
         self._seg_ipa_dict = None
-        self.names = None
+        self._trie = None
+        self._mm = None
+        self._nearest = None
+        self._fallback_dict = {}
+        self._names = None
+        self._records_start = None
+        self.symbols = None
+        self.bits = None
         
-        self.read_file()
+        if not self.load_table():
+            self.read_file()
+            self.write_table()
+        self._index()
         
     @classmethod
     def initialize_full(cls, name=FULL_NAME):
@@ -57,14 +106,29 @@ class IpaConverter:
         """Set this instance as default to be used when no other is supplied"""
         IpaConverter.default = self
         
+    @property
+    def names(self):
+        if self._names is None and self._mm is not None:
+            self._names = dict(
+                record.split("\t", 1)
+                for record in self._mm[self._records_start:].decode("utf-8").split("\n")
+            )
+        return self._names
+        
+    def table_path(self):
+        return cache_path("ipa-" + self.name + ".bin")
+        
+    def table_key(self):
+        return hash_files(self.filename, extra=(TABLE_VERSION, " ".join(FEATURES)))
+        
     def read_file(self):
-        filename = "ipa-" + self.name + ".csv"
-        filename = os.path.join(DATA_DIR, filename)
+        """Reads symbols, names and bits from the csv file"""
+        filename = self.filename
         
         s2n = {"-": -1, "0": 0, "+": 1}
-        self._ipa_seg_dict = {}
-        self._seg_ipa_dict = {}
-        self.names = {}
+        self.symbols = []
+        self._names = {}
+        self.bits = array("Q")
         with open(filename, "r", newline="", encoding="utf-8") as f:
             reader = csv.DictReader(filter(lambda row: not row[0] == "#", f))
             
@@ -72,7 +136,7 @@ class IpaConverter:
             for fieldname in ("ipa", "name"):
                 featureset.discard(fieldname)
             if featureset != FEATURESET:
-                raise ValueError(filename + " featureset does not match features in full IPA csv")
+                raise ValueError(filename + " featureset does not match FEATURES in init.py")
                 
             for row in reader:
                 ipa = row["ipa"]
@@ -80,19 +144,88 @@ class IpaConverter:
                 del row["ipa"]
                 del row["name"]
                 
-                self.names[ipa] = name
+                self._names[ipa] = name
                 
                 value = {feat: s2n[v] for feat, v in row.items()}
                 seg = Segment(value, ipa=ipa)
                 
-                self._ipa_seg_dict[ipa] = seg
-                self._seg_ipa_dict[seg.get_hash()] = ipa
+                self.symbols.append(ipa)
+                self.bits.append(seg.bits)
                 
+    def write_table(self):
+        """
+        Writes symbols, names and bits to the cached table of the csv file.
+        Returns False if it could not be written.
+        """
+        bits = array("Q", self.bits)
+        if sys.byteorder == "big":
+            bits.byteswap()
+        records = "\n".join(ipa + "\t" + self.names[ipa] for ipa in self.symbols)
+        
+        def write(f):
+            f.write(TABLE_MAGIC)
+            f.write(_TABLE_HEADER.pack(TABLE_VERSION, len(self.symbols), bytes.fromhex(self.table_key())))
+            f.write(bits.tobytes())
+            f.write(records.encode("utf-8"))
+        return atomic_write(self.table_path(), write)
+        
+    def load_table(self):
+        """
+        Loads symbols, names and bits from the cached table of the csv file.
+        Returns False if there is no table, or it is invalid or stale.
+        """
+        try:
+            with open(self.table_path(), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        try:
+            if mm[:len(TABLE_MAGIC)] != TABLE_MAGIC:
+                raise ValueError
+            version, count, key = _TABLE_HEADER.unpack_from(mm, len(TABLE_MAGIC))
+            if version != TABLE_VERSION or key.hex() != self.table_key():
+                raise ValueError
+            records_start = _TABLE_START + 8 * count
+            records = mm[records_start:].decode("utf-8").split("\n")
+            if len(records) != count:
+                raise ValueError
+        except (ValueError, struct.error, UnicodeDecodeError):
+            mm.close()
+            return False
+            
+        self.symbols = [record[:record.index("\t")] for record in records]
+        if sys.byteorder == "little":
+            self.bits = memoryview(mm)[_TABLE_START:records_start].cast("Q")
+            self._mm = mm
+            self._records_start = records_start
+        else:
+            self.bits = array("Q", mm[_TABLE_START:records_start])
+            self.bits.byteswap()
+            self._names = dict(record.split("\t", 1) for record in records)
+            mm.close()
+        return True
+        
+    def _index(self):
+        """Builds the Segment to IPA lookup table from symbols and bits"""
+        self._seg_ipa_dict = dict(zip(self.bits, self.symbols))
+        
+    def _ipa_segments(self):
+        """
+        Returns _ipa_seg_dict, building it and _trie on first use: many
+        converters (eg the full one) are only used to convert Segments to IPA
+        """
+        if self._ipa_seg_dict is None:
+            self._ipa_seg_dict = {}
+            for ipa, bits in zip(self.symbols, self.bits):
+                self._ipa_seg_dict[ipa] = Segment.from_bits(bits, ipa=ipa)
+            self._trie = self._build_trie()
+        return self._ipa_seg_dict
+        
     def __iter__(self):
         """
         Iterates over symbol, segment pairs (str, Segment)
         """
-        return iter((k, v.copy()) for k, v in self._ipa_seg_dict.items())
+        return iter(self._ipa_segments().items())
         
     def get_ipa_symbol(self, seg):
         if seg == WORD_B:
@@ -104,10 +237,22 @@ class IpaConverter:
         hash = seg.get_hash()
         if hash in self._seg_ipa_dict:
             return self._seg_ipa_dict[hash]
-        # for ipa, value in self._ipa_seg_dict.items():
-            # if seg.match(value):
-                # return ipa
-        return "<NO SYMBOL>"
+        key = (self.fallback, hash)
+        symbol = self._fallback_dict.get(key)
+        if symbol is None:
+            symbol = self._fallback_dict[key] = self._fallback_symbol(seg)
+        return symbol
+        
+    def _fallback_symbol(self, seg):
+        """Returns the symbol of seg, which isn't in the inventory, according to fallback"""
+        if self.fallback is None or not isinstance(seg, Segment):
+            return NO_SYMBOL
+        if self._nearest is None:
+            from nearest import NearestSymbols
+            self._nearest = NearestSymbols(self.symbols, self.bits)
+        if self.fallback == COMPOSE:
+            return self._nearest.compose(seg.bits)
+        return self.symbols[self._nearest.nearest(seg.bits)[0]]
     
     def to_ipa(self, segs):
         if isinstance(segs, Segment):
@@ -130,6 +275,47 @@ class IpaConverter:
             
         return "".join(ipa_li)
         
+    def iter_ipa(self, segs):
+        """
+        Generator (str) over the IPA of the iterable segs, in pieces, as they
+        come: "".join(self.iter_ipa(segs)) == self.to_ipa(segs). Only the
+        symbols since the last boundary are held, as a stress mark may still
+        be added after it.
+        """
+        pending = []  # pieces since the last boundary
+        last_stress = -1
+        started = False
+        trailing = []  # boundaries (and empty pieces) dropped if nothing follows them
+        
+        def release(pieces):
+            nonlocal started
+            out = []
+            for piece in pieces:
+                if piece in " .":
+                    if started:
+                        trailing.append(piece)
+                else:
+                    started = True
+                    out += trailing
+                    del trailing[:]
+                    out.append(piece)
+            return "".join(out)
+            
+        for seg in segs:
+            if seg in BOUNDARIES:
+                piece = release(pending)
+                if piece:
+                    yield piece
+                pending = [self.get_ipa_symbol(seg), ""]
+                last_stress = 1
+                continue
+            pending.append(self.get_ipa_symbol(seg))
+            if seg.stress is not None:
+                pending[last_stress] = self.STRESS_CHARS[seg.stress]
+        piece = release(pending)
+        if piece:
+            yield piece
+            
     def to_segments(self, ipa):
         segs = [WORD_B]
         for seg in self._ipa_tokenize(ipa):
@@ -137,37 +323,66 @@ class IpaConverter:
         segs += [WORD_B]
         return segs
         
+    def iter_segments(self, words):
+        """
+        Generator over the symbols of the IPA strings of the iterable words,
+        as to_segments gives them for " ".join(words), a word at a time
+        """
+        yield WORD_B
+        for k, word in enumerate(words):
+            if k:
+                yield WORD_B
+            yield from self._ipa_tokenize(word)
+        yield WORD_B
+        
     def to_segment(self, ipa, stress=None):
-        segment = self._ipa_seg_dict[ipa].copy()
-        segment.stress = stress
-        return segment
+        return self._ipa_segments()[ipa].with_stress(stress)
         
-    def _ipa_tokenize(self, ipa):
+    _TRIE_SYMBOL = None
+    
+    def _build_trie(self):
         """
-        TODO: Make this its own class
+        Returns a prefix trie of the IPA symbols of this converter. Each node
+        is a dict {char: node}; a node that completes a symbol maps
+        _TRIE_SYMBOL to that symbol.
+        """
+        trie = {}
+        for ipa in self._ipa_seg_dict:
+            node = trie
+            for c in ipa:
+                node = node.setdefault(c, {})
+            node[self._TRIE_SYMBOL] = ipa
+        return trie
         
-        Generator (str) for tokenizing IPA strings into individual phoneme
-        representations, including ones that use multiple Unicode characters
+    def _ipa_tokenize(self, ipa):
         """
+        Generator (Segment or boundary) for tokenizing IPA strings into
+        individual phoneme representations, including ones that use multiple
+        Unicode characters.
         
-        # removing stress markers/word boundaries from IPA string
-        # for c in "ˈˌ":
-            # ipa = ipa.replace(c,"")
-        # TODO: convert in whatever stress/boundary representation I end up doing
+        Symbols are matched greedily: a token is extended while it is still
+        the prefix of some symbol in the trie, so tokenizing takes time linear
+        in the length of ipa. Stress marks apply to the next syllabic
+        segment, and " " and "." end the current token and yield a word or
+        syllable boundary.
+        """
         if not ipa:
             return
         
+        ipa_seg_dict = self._ipa_segments()
+        root = self._trie
+        node = root
         buffer = []
-        possibilities = set(self._ipa_seg_dict.keys())
-        
-        pli = []
+        token_start = 0
         
         i = 0
+        end = len(ipa) - 1
         next_boundary = None
         last_stress = 0
         while True:
             c = ipa[i]
             
+            dead_end = False
             if c == " ":
                 next_boundary = WORD_B
             elif c == ".":
@@ -176,48 +391,43 @@ class IpaConverter:
                 last_stress = 1
             elif c == "ˌ":
                 last_stress = 2
-            
             else:
+                if not buffer:
+                    token_start = i
                 buffer.append(c)
-                s = "".join(buffer)
-                
-                for p in possibilities.copy():
-                    pli.append("%s starts with %s: %s" % (p, s, p.startswith(s)))
-                    if not p.startswith(s):
-                        possibilities.discard(p)
+                child = node.get(c)
+                if child is None:
+                    dead_end = True
+                else:
+                    node = child
                     
             token = None
-            if len(possibilities) == 0:
-                # Tokenize and move back if no more possibilities
+            if dead_end:
+                # Tokenize and move back if no symbol continues with c
                 if len(buffer) == 1:
                     token = buffer[0]
                 else:
                     token = "".join(buffer[:-1])
                 i -= 1
-            elif i >= len(ipa)-1 or next_boundary:
+            elif i >= end or next_boundary:
                 # Tokenize if at end of string, or if the character is a boundary
                 token = "".join(buffer)
                 
             if token is not None:
-                if token in self._ipa_seg_dict:
-                    segment = self._ipa_seg_dict[token].copy()
-                    if segment.get("syl") == 1:
-                        segment.stress = last_stress
-                        last_stress = 0
-                    yield segment
-                    
-                    possibilities = set(self._ipa_seg_dict.keys())
-                    buffer = []
-                else:
-                    for x in pli:
-                        print(self.name, x)
-                    with open("out.txt", "w", encoding="utf-8") as f:
-                        f.write("\n".join(pli))
-                    raise ValueError("\"ipa-{}\" IpaConverter has no match for symbol \"{}\" in string {}".format(
-                        self.name, token, ipa
+                segment = ipa_seg_dict.get(token)
+                if segment is None:
+                    raise ValueError("\"ipa-{}\" IpaConverter has no match for symbol \"{}\" at position {} in string {}".format(
+                        self.name, token, token_start, ipa
                     ))
+                if segment.get("syl") == 1:
+                    segment = segment.with_stress(last_stress)
+                    last_stress = 0
+                yield segment
+                
+                node = root
+                buffer = []
                     
-                if i >= len(ipa)-1:
+                if i >= end:
                     return
                     
             if next_boundary:
@@ -225,8 +435,3 @@ class IpaConverter:
                 next_boundary = None
                 
             i += 1
-
-
-    
-
-
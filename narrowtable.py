@@ -0,0 +1,111 @@
+"""
+Precompiled transcriptions of every word in the dictionary, for one ruleset.
+
+Most input is a single dictionary word, so its broad and narrow
+transcriptions can be computed ahead of time:
+    $ python pyphone.py <ruleset> --build-table
+The table is a binary dictionary (see dictionary.py) {WORD: "broad\\tnarrow"}
+in "cache/narrow-<ruleset>.bin". It is keyed by a hash of the ruleset, the
+feature matrices and the text dictionary, and a table whose key doesn't
+match is never used.
+
+A Pipeline looks an input up in the table, skipping the TextParser and the
+rules, when it is a single word, or when every rule is word-local (see
+Rule.is_word_local) so that each word can be looked up on its own.
+"""
+
+import os
+from cache import cache_path, hash_files
+from dictionary import BinaryDictionary, write_binary_dictionary
+from rules import RULESET_CACHE_VERSION, ruleset_path
+from init import *
+
+
+# Bump when the way the table is built changes
+TABLE_VERSION = 2
+
+
+def table_path(ruleset_name, language="english"):
+    return cache_path("narrow-{}-{}.bin".format(language, ruleset_name))
+
+
+def table_key(pipeline):
+    """Returns the key of the narrow table of pipeline's ruleset and data"""
+    return hash_files(
+        ruleset_path(pipeline.ruleset_name),
+        pipeline.ic.filename,
+        pipeline.icf.filename,
+        pipeline.tp.filename,
+        extra=(TABLE_VERSION, RULESET_CACHE_VERSION)
+    )
+
+
+def open_table(pipeline):
+    """Returns the narrow table of pipeline, or None if there is none or it is stale"""
+    filename = table_path(pipeline.ruleset_name, pipeline.tp.name)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        table = BinaryDictionary(filename)
+    except (OSError, ValueError):
+        return None
+    if table.key != table_key(pipeline):
+        table.close()
+        return None
+    return table
+
+
+def lookup(pipeline, table, text):
+    """
+    Returns (broad, narrow) of text from pipeline's table, or None if the
+    table can't be used for text
+    """
+    words = text.strip().lower().split()
+    if not words or (len(words) > 1 and not pipeline.word_local):
+        return None
+    broad_li = []
+    narrow_li = []
+    for word in words:
+        entry = table.get(word.upper())
+        if entry is None:
+            return None
+        broad_ipa, narrow_ipa = entry.split("\t")
+        if not narrow_ipa or narrow_ipa[0] == "." or narrow_ipa[-1] == ".":
+            # joined, it wouldn't be the same as transcribing the whole text
+            if len(words) > 1:
+                return None
+        broad_li.append(broad_ipa)
+        narrow_li.append(narrow_ipa)
+    return " ".join(broad_li), " ".join(narrow_li)
+
+
+def build_table(ruleset_name, language="english", workers=None, chunksize=256):
+    """
+    Transcribes every word of the dictionary with ruleset_name and writes
+    the narrow table. The forms of the words after each rule are
+    checkpointed (see checkpoints.py), so after the ruleset is edited only
+    the rules from the first edited one on are run again, and only over the
+    words that they change. A full build runs over workers processes.
+    Words that fail are left out.
+    Returns (number of words written, number of words that failed), or None
+    if the table is already up to date.
+    """
+    from pipeline import Pipeline
+    from checkpoints import build_forms
+    
+    pipeline = Pipeline(ruleset_name, language=language, compiled=True, word_cache_size=0)
+    if pipeline.narrow_table is not None:
+        return None
+    key = table_key(pipeline)
+    
+    d = {}
+    failed = 0
+    forms = build_forms(pipeline, workers=workers, chunksize=chunksize)
+    for word, (broad_ipa, form) in forms.items():
+        if form is None:
+            failed += 1
+            continue
+        d[word.upper()] = broad_ipa + "\t" + pipeline.icf.to_ipa(list(form))
+    if not write_binary_dictionary(d, table_path(ruleset_name, language), key=key):
+        raise IOError("Could not write " + table_path(ruleset_name, language))
+    return len(d), failed
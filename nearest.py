@@ -0,0 +1,144 @@
+"""
+Nearest-symbol search over the feature matrix of an IpaConverter, for
+rendering feature bundles that aren't in its inventory (see
+IpaConverter.get_ipa_symbol).
+
+The packed features (see segment.pack_features) of every symbol are laid
+side by side in one big int, one 64-bit lane per symbol. Comparing a bundle
+against the whole inventory then takes a few big int operations per feature
+instead of a Python loop over thousands of symbols: XOR with the bundle
+repeated in every lane, then per feature shift, mask and add its weight into
+every lane at once.
+"""
+
+import sys
+import unicodedata
+from array import array
+from segment import NEG_SHIFT, POS_BITS
+from init import *
+
+
+_LANE_BYTES = 8
+
+# Most diacritics added to a symbol when composing one
+MAX_DIACRITICS = 3
+
+# Unicode categories of diacritics: combining marks and modifier letters/symbols
+_DIACRITIC_CATEGORIES = ("Mn", "Lm", "Sk")
+
+
+def lanes_to_int(values):
+    """Returns the big int with the int lane k holding values[k]"""
+    lanes = array("Q", values)
+    if sys.byteorder == "big":
+        lanes.byteswap()
+    return int.from_bytes(lanes.tobytes(), "little")
+
+
+def int_to_lanes(n, count):
+    """Returns the count lanes of the big int n, as an array"""
+    lanes = array("Q", n.to_bytes(count * _LANE_BYTES, "little"))
+    if sys.byteorder == "big":
+        lanes.byteswap()
+    return lanes
+
+
+class NearestSymbols:
+    """
+    Attributes
+    ------------------------
+    symbols: list (str)
+    bits: sequence (int)
+        Packed features of each of symbols
+    weights: dict {str: int}
+        Weight of each feature in the distance: the distance between two
+        bundles is the sum of the weights of the features they disagree on.
+        By default every feature weighs 1 (Hamming distance).
+    """
+    def __init__(self, symbols, bits, weights=None):
+        self.symbols = symbols
+        self.bits = bits
+        self.weights = {feat: 1 for feat in FEATURES}
+        if weights:
+            self.weights.update(weights)
+        self._matrix = lanes_to_int(bits)
+        self._ones = lanes_to_int([1] * len(bits))
+        self._diacritics = None
+        
+    def distances(self, bits):
+        """Returns the distance from packed features bits to each symbol, as an array"""
+        diff = self._matrix ^ (bits * self._ones)
+        total = 0
+        for k, feat in enumerate(FEATURES):
+            weight = self.weights[feat]
+            if weight:
+                # feature k differs if its + bit or its - bit does
+                total += (((diff >> k) | (diff >> (k + NEG_SHIFT))) & self._ones) * weight
+        return int_to_lanes(total, len(self.bits))
+        
+    def distance(self, bits, other):
+        """Returns the distance between two packed feature bundles"""
+        diff = bits ^ other
+        diff |= diff >> NEG_SHIFT
+        return sum(self.weights[feat] for feat, bit in POS_BITS.items() if diff & bit)
+        
+    def nearest(self, bits):
+        """Returns (index of the symbol nearest to packed features bits, its distance)"""
+        distances = self.distances(bits)
+        best = min(distances)
+        return distances.index(best), best
+        
+    def diacritics(self):
+        """
+        Returns [(diacritic, mask, value)] of the diacritics of the inventory.
+        Adding diacritic to a symbol sets the features in mask to value. The
+        effect of a diacritic is learnt from the symbols that are another
+        symbol plus that diacritic, taking the most common one.
+        """
+        if self._diacritics is not None:
+            return self._diacritics
+        bits_of = dict(zip(self.symbols, self.bits))
+        effects = {}
+        for symbol, bits in zip(self.symbols, self.bits):
+            diacritic = symbol[-1]
+            base_bits = bits_of.get(symbol[:-1])
+            if base_bits is None or unicodedata.category(diacritic) not in _DIACRITIC_CATEGORIES:
+                continue
+            diff = bits ^ base_bits
+            diff |= diff >> NEG_SHIFT
+            diff &= (1 << NEG_SHIFT) - 1
+            mask = diff | (diff << NEG_SHIFT)
+            if mask:
+                counts = effects.setdefault(diacritic, {})
+                effect = (mask, bits & mask)
+                counts[effect] = counts.get(effect, 0) + 1
+        self._diacritics = [
+            (diacritic, ) + max(counts, key=counts.get)
+            for diacritic, counts in sorted(effects.items())
+        ]
+        return self._diacritics
+        
+    def compose(self, bits):
+        """
+        Returns the nearest symbol to packed features bits, plus up to
+        MAX_DIACRITICS diacritics, each added only if it brings the symbol
+        closer to bits
+        """
+        i, best = self.nearest(bits)
+        symbol = self.symbols[i]
+        current = self.bits[i]
+        for n in range(MAX_DIACRITICS):
+            if not best:
+                break
+            chosen = None
+            for diacritic, mask, value in self.diacritics():
+                new = (current & ~mask) | value
+                distance = self.distance(new, bits)
+                if distance < best:
+                    best = distance
+                    chosen = diacritic, new
+            if chosen is None:
+                break
+            symbol += chosen[0]
+            current = chosen[1]
+        return symbol
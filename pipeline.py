@@ -0,0 +1,375 @@
+from collections import OrderedDict
+from ipaconverter import IpaConverter
+from textparser import TextParser
+from rules import load_ruleset
+from transducer import RulesetTransducer
+from vectorized import VectorizedRuleset
+from streaming import StreamingRuleset
+import narrowtable
+from init import *
+
+
+DEFAULT_WORD_CACHE_SIZE = 4096
+
+
+class WordCache:
+    """
+    Bounded cache of the Segments of words, evicting the least recently used
+    
+    Attributes
+    ------------------------
+    maxsize: int
+        Most words kept
+    hits: int
+        Lookups that found their word
+    misses: int
+        Lookups that didn't
+    """
+    def __init__(self, maxsize=DEFAULT_WORD_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._d = OrderedDict()
+        
+    def get(self, word):
+        segments = self._d.get(word)
+        if segments is None:
+            self.misses += 1
+            return None
+        self._d.move_to_end(word)
+        self.hits += 1
+        return segments
+        
+    def put(self, word, segments):
+        self._d[word] = segments
+        if len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+            
+    def clear(self):
+        self._d.clear()
+        self.hits = 0
+        self.misses = 0
+        
+    def __len__(self):
+        return len(self._d)
+
+
+class Pipeline:
+    """
+    Full transcription pipeline for one ruleset:
+    orthographic text -> broad IPA -> Segments -> rules -> narrow IPA
+    
+    Rules that are word-local (see Rule.is_word_local) give the same result
+    on each word on its own as on the whole utterance. The leading run of
+    them is applied word by word, and the result is kept in word_cache, so a
+    repeated word is neither tokenized nor run through them again. The rest
+    of the rules are applied to the whole utterance. If every rule is
+    word-local, a cached word needs no work at all.
+    
+    Attributes
+    ------------------------
+    ruleset_name: str
+        Name of the ruleset file in the rulesets directory (without .txt)
+    icf: IpaConverter
+        Full IPA converter, used for the narrow transcription
+    ic: IpaConverter
+        Language IPA converter, used to tokenize the broad transcription
+    tp: TextParser
+        Orthography to broad IPA converter
+    rules: list of Rule
+        Rules applied in order to the Segments of each input
+    transducer: RulesetTransducer or None
+        Compiled form of rules, used instead of applying them one by one if
+        the Pipeline was made with compiled=True
+    vectorizer: VectorizedRuleset or None
+        Form of rules evaluated over whole contexts (see vectorized.py),
+        used instead of applying them one by one if the Pipeline was made
+        with vectorized=True and compiled=False
+    word_local_rules: int
+        Number of leading rules that are word-local
+    word_cache: WordCache or None
+        {broad IPA of a word: its Segments after the word-local rules}, None
+        if the Pipeline was made with word_cache_size=0
+    narrow_table: BinaryDictionary or None
+        Precompiled transcriptions of the dictionary words (see
+        narrowtable.py), None if there is no up to date table or the Pipeline
+        was made with use_table=False
+    streamer: StreamingRuleset
+        Form of rules applied as a chain of generators (see streaming.py),
+        used by transcribe_stream. Made on first use.
+    """
+    def __init__(self, ruleset_name, language="english", compiled=False,
+            word_cache_size=DEFAULT_WORD_CACHE_SIZE, use_table=True, vectorized=False):
+        self.ruleset_name = ruleset_name
+        if IpaConverter.FULL is None:
+            IpaConverter.initialize_full()
+        self.icf = IpaConverter.FULL
+        self.ic = IpaConverter(language)
+        self.tp = TextParser(language, ipa_converter=self.icf)
+        self.rules = load_ruleset(ruleset_name, self.ic, self.icf)
+        self.transducer = RulesetTransducer(self.rules) if compiled else None
+        self.vectorizer = VectorizedRuleset(self.rules) if vectorized and not compiled else None
+        
+        self.word_local_rules = 0
+        for rule in self.rules:
+            if not rule.is_word_local():
+                break
+            self.word_local_rules += 1
+        self.word_cache = WordCache(word_cache_size) if word_cache_size else None
+        self.narrow_table = narrowtable.open_table(self) if use_table else None
+        self._streamer = None
+        
+    @property
+    def word_local(self):
+        """True if every rule is word-local"""
+        return self.word_local_rules == len(self.rules)
+        
+    @property
+    def streamer(self):
+        if self._streamer is None:
+            self._streamer = StreamingRuleset(self.rules)
+        return self._streamer
+        
+    def to_broad(self, text, oov=None):
+        """Returns the broad IPA of text, adding the words left out to the list oov (see TextParser.to_ipa)"""
+        return self.tp.to_ipa(text.strip().lower(), oov)
+        
+    def _apply_rules(self, segments, start=0, stop=None):
+        """Applies rules[start:stop] to segments"""
+        if self.transducer is not None:
+            return self.transducer.apply(segments, start, stop)
+        if self.vectorizer is not None:
+            return self.vectorizer.apply(segments, start, stop)
+        for rule in self.rules[start:stop]:
+            segments = rule.apply(segments)
+        return segments
+        
+    def _word_segments(self, word):
+        """Returns the Segments of word between its boundaries, after the word-local rules"""
+        segments = self.word_cache.get(word)
+        if segments is None:
+            segments = self.ic.to_segments(word)
+            segments = self._apply_rules(segments, stop=self.word_local_rules)
+            # word-local rules never touch the boundaries
+            segments = tuple(segments[1:-1])
+            self.word_cache.put(word, segments)
+        return segments
+        
+    def to_narrow(self, broad_ipa):
+        words = broad_ipa.split(" ")
+        if self.word_cache is None or (len(words) > 1 and "" in words):
+            segments = self._apply_rules(self.ic.to_segments(broad_ipa))
+            return self.icf.to_ipa(segments)
+            
+        try:
+            segments = [WORD_B]
+            for word in words:
+                segments += self._word_segments(word)
+                segments.append(WORD_B)
+        except ValueError:
+            # tokenize the whole utterance, for the error message
+            self.ic.to_segments(broad_ipa)
+            raise
+        segments = self._apply_rules(segments, start=self.word_local_rules)
+        return self.icf.to_ipa(segments)
+        
+    def lookup(self, text):
+        """
+        Returns (broad, narrow) IPA strings for text from narrow_table, or
+        None if text can't be looked up
+        """
+        if self.narrow_table is None:
+            return None
+        return narrowtable.lookup(self, self.narrow_table, text)
+        
+    def transcribe(self, text):
+        """Returns (broad, narrow) IPA strings for text"""
+        found = self.lookup(text)
+        if found is not None:
+            return found
+        broad_ipa = self.to_broad(text)
+        return broad_ipa, self.to_narrow(broad_ipa)
+        
+    def transcribe_stream(self, chunks, oov=None):
+        """
+        Returns an iterator (str) over the narrow IPA of a text given as an
+        iterable of str chunks of it (eg textparser.read_chunks(f)),
+        transcribed as one utterance: "".join(self.transcribe_stream([text]))
+        is self.transcribe(text)[1]. Each stage, from tokenizing the text to
+        rendering the IPA, reads from the one before it as it goes and holds
+        only a window of it (see streaming.py), so the IPA comes out in pieces
+        while the text is read, and memory doesn't grow with its length.
+        Words out of the dictionary are left out, and added to the list oov if
+        it is given.
+        """
+        segments = self.ic.iter_segments(self._broad_words(chunks, oov))
+        return self.icf.iter_ipa(self.streamer.run(segments))
+        
+    def _broad_words(self, chunks, oov):
+        """Generator (str) over the broad IPA of the words in chunks, as transcribe_stream reads them"""
+        for token in self.tp.tokenize(chunks):
+            if token.ipa is not None:
+                yield token.ipa
+            elif oov is not None:
+                oov.append(token.text)
+
+
+class MultiPipeline:
+    """
+    Transcribes each input with several rulesets of one language at once.
+    
+    The broad transcription, and the Segments if they are needed, are made
+    once for all of them. Rulesets that start with the same Rules (by
+    Rule.__eq__) share a branch of a prefix tree of Rules: each run of Rules
+    common to several rulesets is applied once, and its result goes on to
+    the Rules that differ. A ruleset that shares no leading Rule with the
+    others is transcribed by its own Pipeline, with its word cache.
+    
+    Attributes
+    ------------------------
+    pipelines: OrderedDict {str: Pipeline}
+        A Pipeline per ruleset name, in the order given
+    root: MultiPipeline.Branch
+        Root of the prefix tree, with no Rules
+    """
+    class Branch:
+        """
+        Attributes
+        ------------------------
+        pipeline: Pipeline or None
+            Pipeline whose rules[start:stop] the Branch applies, which every
+            ruleset under it has
+        start, stop: int
+        names: list (str)
+            The rulesets under the Branch
+        finished: list (str)
+            The rulesets that end with this Branch
+        children: list of MultiPipeline.Branch
+        """
+        def __init__(self, pipeline, start, stop, names):
+            self.pipeline = pipeline
+            self.start = start
+            self.stop = stop
+            self.names = names
+            self.finished = []
+            self.children = []
+            
+    def __init__(self, ruleset_names, language="english", compiled=False,
+            word_cache_size=DEFAULT_WORD_CACHE_SIZE, use_table=True, vectorized=False):
+        self.pipelines = OrderedDict()
+        for name in ruleset_names:
+            self.pipelines[name] = Pipeline(
+                name, language=language, compiled=compiled, word_cache_size=word_cache_size,
+                use_table=use_table, vectorized=vectorized
+            )
+        if not self.pipelines:
+            raise ValueError("No ruleset given")
+        self.root = self.Branch(None, 0, 0, list(self.pipelines))
+        self._grow(self.root)
+        
+    def _grow(self, branch):
+        """Adds the children of branch, whose rulesets all have the same Rules up to branch.stop"""
+        groups = []
+        for name in branch.names:
+            rules = self.pipelines[name].rules
+            if len(rules) == branch.stop:
+                branch.finished.append(name)
+                continue
+            for group in groups:
+                if self.pipelines[group[0]].rules[branch.stop] == rules[branch.stop]:
+                    group.append(name)
+                    break
+            else:
+                groups.append([name])
+        for names in groups:
+            rule_lists = [self.pipelines[name].rules for name in names]
+            stop = branch.stop + 1
+            while all(len(rules) > stop and rules[stop] == rule_lists[0][stop] for rules in rule_lists):
+                stop += 1
+            child = self.Branch(self.pipelines[names[0]], branch.stop, stop, names)
+            branch.children.append(child)
+            self._grow(child)
+            
+    def shared_rules(self):
+        """Returns [(ruleset names, number of Rules)] for each run of Rules shared by several rulesets"""
+        shared = []
+        branches = list(self.root.children)
+        while branches:
+            branch = branches.pop(0)
+            if len(branch.names) > 1:
+                shared.append((branch.names, branch.stop - branch.start))
+            branches += branch.children
+        return shared
+        
+    def transcribe(self, text, oov=None):
+        """
+        Returns OrderedDict {ruleset name: (broad, narrow, error)} for text.
+        error is None unless that transcription failed, in which case narrow
+        (and broad, if it could not be produced) is None. The words left out
+        of broad are added to the list oov if it is given (see
+        Pipeline.to_broad).
+        """
+        results = OrderedDict((name, None) for name in self.pipelines)
+        for name, pipeline in self.pipelines.items():
+            found = pipeline.lookup(text)
+            if found is not None:
+                results[name] = found + (None, )
+        if all(results.values()):
+            return results
+            
+        first = next(iter(self.pipelines.values()))
+        try:
+            broad_ipa = first.to_broad(text, oov)
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+            for name in results:
+                if results[name] is None:
+                    results[name] = None, None, error
+            return results
+        return self.to_narrow(broad_ipa, results)
+        
+    def to_narrow(self, broad_ipa, results=None):
+        """
+        Returns OrderedDict {ruleset name: (broad, narrow, error)} for the
+        broad IPA broad_ipa, as transcribe does for text. The rulesets that
+        already have a result in results are left as they are.
+        """
+        if results is None:
+            results = OrderedDict((name, None) for name in self.pipelines)
+        first = next(iter(self.pipelines.values()))
+        segments = None
+        for branch in self.root.children:
+            if all(results[name] for name in branch.names):
+                continue
+            if len(branch.names) == 1:
+                try:
+                    results[branch.names[0]] = broad_ipa, branch.pipeline.to_narrow(broad_ipa), None
+                except Exception as e:
+                    results[branch.names[0]] = broad_ipa, None, "{}: {}".format(type(e).__name__, e)
+                continue
+            if segments is None:
+                try:
+                    segments = first.ic.to_segments(broad_ipa)
+                except Exception as e:
+                    segments = e
+            self._run(branch, segments, broad_ipa, results)
+        return results
+        
+    def _run(self, branch, segments, broad_ipa, results):
+        """Applies the Rules of branch and of the Branches under it to segments (or the exception before)"""
+        if not isinstance(segments, Exception):
+            try:
+                segments = branch.pipeline._apply_rules(segments, branch.start, branch.stop)
+            except Exception as e:
+                segments = e
+        for name in branch.finished:
+            if results[name] is not None:
+                continue
+            if isinstance(segments, Exception):
+                results[name] = broad_ipa, None, "{}: {}".format(type(segments).__name__, segments)
+            else:
+                results[name] = broad_ipa, self.pipelines[name].icf.to_ipa(segments), None
+        for child in branch.children:
+            if not all(results[name] for name in child.names):
+                self._run(child, segments, broad_ipa, results)
+
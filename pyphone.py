@@ -1,10 +1,9 @@
 # -*- coding: utf-8 -*-
 
-import sys
-from ipaconverter import IpaConverter
-from textparser import TextParser
+import argparse
+from rulestats import FIELDS
+from tracing import TRACER, DEBUG, print_sink
 from init import *
-import rules
 
 
 DEFAULT_RULESETS = {
@@ -12,31 +11,96 @@ DEFAULT_RULESETS = {
     "rp": "received-pronunciation",
     "ae": "australian-english"
 }
-def read_args():
-    # NOTE; the flag -v for verbose is read in init.py
-    ruleset = "standard-american-english"
-    for arg in sys.argv[1:]:
-        if arg[0] == "-":
-            arg = arg[1:]
-            continue
-        elif arg in DEFAULT_RULESETS:
-            ruleset = DEFAULT_RULESETS[arg]
-        else:
-            ruleset = arg
-    return ruleset
+def read_args(argv=None):
+    parser = argparse.ArgumentParser(description="Transcribe English text to narrow IPA")
+    parser.add_argument("ruleset", nargs="?", default="standard-american-english",
+        help="ruleset name, or one of: {}. Several comma-separated rulesets are applied at once".format(
+            ", ".join(DEFAULT_RULESETS)))
+    parser.add_argument("-v", action="store_true", help="verbose output")
+    parser.add_argument("-c", "--compiled", action="store_true",
+        help="apply the ruleset with the compiled engine (same results, faster)")
+    parser.add_argument("--vectorized", action="store_true",
+        help="apply the ruleset with the whole-context engine (same results; ignored with -c)")
+    parser.add_argument("-b", "--batch", action="store_true",
+        help="transcribe stdin non-interactively, one utterance per line")
+    parser.add_argument("-i", "--input", action="append", default=[], metavar="FILE",
+        help="transcribe FILE non-interactively (\"-\" for stdin). Can be repeated")
+    parser.add_argument("-d", "--document", action="store_true",
+        help="transcribe the input as running text, word by word, with the span of each word in it")
+    parser.add_argument("-s", "--stream", action="store_true",
+        help="transcribe each input file as one utterance, writing the narrow IPA as it is made")
+    parser.add_argument("-o", "--output", metavar="FILE", help="batch output file (default stdout)")
+    parser.add_argument("-f", "--format", choices=("tsv", "jsonl"), default="tsv",
+        help="batch output format")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+        help="number of batch worker processes (default: number of CPUs)")
+    parser.add_argument("--chunksize", type=int, default=64,
+        help="lines sent to a batch worker at a time")
+    parser.add_argument("--stats", nargs="?", const="seconds", choices=FIELDS, metavar="COUNTER",
+        help="after a batch, print what each rule did, sorted by COUNTER (default seconds; one of: {})".format(
+            ", ".join(FIELDS)))
+    parser.add_argument("--build-table", action="store_true",
+        help="precompile the transcriptions of every dictionary word with the ruleset, using -j workers")
+    args = parser.parse_args(argv)
+    args.rulesets = [DEFAULT_RULESETS.get(name, name) for name in args.ruleset.split(",")]
+    if args.stream and (args.document or len(args.rulesets) > 1):
+        parser.error("--stream takes a single ruleset, and can't be used with --document")
+    args.ruleset = args.rulesets[0]
+    args.batch = args.batch or bool(args.input) or args.document or args.stream
+    return args
 
 
 def main():
-    icf = IpaConverter.initialize_full()
-    icf.set_as_default()
-    
-    tp = TextParser("english")
-    ic = IpaConverter("english")
+    args = read_args()
+    ruleset_name = args.ruleset if len(args.rulesets) == 1 else args.rulesets
+    if args.v:
+        TRACER.level = DEBUG
+        TRACER.sinks.append(print_sink)
     
-    ruleset_name = read_args()
-    from rules import load_ruleset
-    rules = load_ruleset(ruleset_name, ic, icf)
+    if args.build_table:
+        from narrowtable import build_table, table_path
+        for name in args.rulesets:
+            built = build_table(name, workers=args.workers)
+            if built is None:
+                print("{} is up to date".format(table_path(name)))
+            else:
+                print("Wrote {} words to {} ({} failed)".format(built[0], table_path(name), built[1]))
+        return
+        
+    if args.stream:
+        from batch import run_stream
+        run_stream(ruleset_name, args.input, output=args.output)
+        return
+        
+    if args.document:
+        from batch import run_document
+        run_document(
+            ruleset_name, args.input, output=args.output, fmt=args.format, compiled=args.compiled,
+            stats=args.stats, vectorized=args.vectorized
+        )
+        return
+        
+    if args.batch:
+        from batch import run_batch
+        run_batch(
+            ruleset_name, args.input, output=args.output, fmt=args.format,
+            workers=args.workers, chunksize=args.chunksize, compiled=args.compiled,
+            stats=args.stats, vectorized=args.vectorized
+        )
+        return
+        
+    if len(args.rulesets) > 1:
+        interact_multi(args)
+        return
+        
+    from pipeline import Pipeline
+    pipeline = Pipeline(ruleset_name, compiled=args.compiled, vectorized=args.vectorized)
+    rules = pipeline.rules
     print("\nRuleset: {}\n{} Rules in effect:".format(ruleset_name, len(rules)))
+    if pipeline.transducer is not None:
+        print("({} compiled)".format(len(pipeline.transducer.compiled)))
+    elif pipeline.vectorizer is not None:
+        print("({} vectorized)".format(len(pipeline.vectorizer.vectorized)))
     for rule in rules:
         if rule.name:
             print("{}:".format(rule.name))
@@ -46,20 +110,45 @@ def main():
     print()
     
     while True:
-        inp = input(" (English input): ").strip().lower()
-        broad_ipa = tp.to_ipa(inp)
+        inp = input(" (English input): ")
+        found = pipeline.lookup(inp)
+        oov = []
+        broad_ipa = found[0] if found else pipeline.to_broad(inp, oov)
+        if oov:
+            print("Not in the dictionary: {}".format(" ".join(oov)))
         
         print("/{}/".format(broad_ipa))
         print()
-        segments = ic.to_segments(broad_ipa)
-        
-        for rule in rules:
-            segments = rule.apply(segments)
-            
-        narrow_ipa = icf.to_ipa(segments)
+        narrow_ipa = found[1] if found else pipeline.to_narrow(broad_ipa)
         print("[{}]".format(narrow_ipa))
 
 
+def interact_multi(args):
+    """Interactive mode with several rulesets"""
+    from pipeline import MultiPipeline
+    multi = MultiPipeline(args.rulesets, compiled=args.compiled, vectorized=args.vectorized)
+    print("\nRulesets: {}".format(", ".join(args.rulesets)))
+    for names, count in multi.shared_rules():
+        print("({} leading Rules shared by {})".format(count, ", ".join(names)))
+    print()
+    
+    width = max(len(name) for name in args.rulesets)
+    while True:
+        inp = input(" (English input): ")
+        oov = []
+        results = multi.transcribe(inp, oov)
+        if oov:
+            print("Not in the dictionary: {}".format(" ".join(oov)))
+        broad_ipa = next((broad for broad, narrow, error in results.values() if broad is not None), None)
+        if broad_ipa is not None:
+            print("/{}/".format(broad_ipa))
+            print()
+        for name, (broad, narrow, error) in results.items():
+            if error is None:
+                print("{:<{}} [{}]".format(name, width, narrow))
+            else:
+                print("{:<{}} {}".format(name, width, error))
+
+
 if __name__ == "__main__":
     main()
-
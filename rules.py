@@ -1,16 +1,47 @@
 from segment import Segment, MetaSegment
 from init import *
 from ipaconverter import IpaConverter
-try:
-    import regex
-except ImportError:
-    import re as regex
+from cache import cache_path, hash_files, read_pickle, write_pickle
+from tracing import TRACER, trace, OFF, INFO, DEBUG
+from rulestats import RULE_STATS
+from time import perf_counter
         
         
-def load_ruleset(name, ipaconverter, ipaconverter_full):
-    fn = "rulesets/{}.txt".format(name)
+# Bump when the pickled form of Rule (or anything it contains) changes
+RULESET_CACHE_VERSION = 7
+
+
+def ruleset_path(name):
+    return "rulesets/{}.txt".format(name)
+
+
+def load_ruleset(name, ipaconverter, ipaconverter_full, use_cache=True):
+    """
+    Returns the list of Rules in "rulesets/<name>.txt".
+    
+    Parsed rulesets are cached in compiled (pickled) form, keyed by a hash of
+    the ruleset text and both converters' feature csv files, so an unchanged
+    ruleset is loaded without parsing. Pass use_cache=False to always parse.
+    """
+    fn = ruleset_path(name)
     if not os.path.isfile(fn):
         raise IOError("No such ruleset '{}'".format(fn))
+    if not use_cache:
+        return _parse_ruleset(fn, ipaconverter, ipaconverter_full)
+        
+    key = hash_files(
+        fn, ipaconverter.filename, ipaconverter_full.filename,
+        extra=(RULESET_CACHE_VERSION,)
+    )
+    cache_fn = cache_path("rulesets", name + ".pickle")
+    rules = read_pickle(cache_fn, key)
+    if rules is None:
+        rules = _parse_ruleset(fn, ipaconverter, ipaconverter_full)
+        write_pickle(cache_fn, key, rules)
+    return rules
+
+
+def _parse_ruleset(fn, ipaconverter, ipaconverter_full):
     rules = []
     name = None
     with open(fn, "r", encoding="utf-8", newline="") as f:
@@ -34,12 +65,39 @@ def load_ruleset(name, ipaconverter, ipaconverter_full):
 
 
 class Rule:
+    """
+    Attributes
+    ------------------------
+    core, left_environment, right_environment: Environment
+    transformation: Transformation
+    name: str or None
+    literal: str or None
+        Text the Rule was parsed from
+    core_start: Environment.Node or None
+        First non-null node of the core, if it must match the symbol a
+        match starts at (see build_prefilter)
+    left_end: Environment.Node or None
+        Last node of the left environment, if it must match the nearest
+        symbol before a match
+    positions: int
+        Positions the Rule has been tried at by apply()
+    pruned: int
+        Positions that apply() skipped because the prefilter ruled them out
+        
+    apply() counts more, per rule name, while RULE_STATS is enabled (see
+    rulestats.py)
+    """
     def __init__(self):
         self.left_environment = None
         self.right_environment = None
         self.core = None
         self.transformation = None
         self.name = None
+        self.literal = None
+        self.core_start = None
+        self.left_end = None
+        self.positions = 0
+        self.pruned = 0
         
     def __str__(self):
         return "{} -> {} / {} _ {}".format(
@@ -52,13 +110,10 @@ class Rule:
     def __eq__(self, other):
         if not isinstance(other, Rule):
             return False
-        vpr(
-            "Rule eq:",
-            # "core:", self.core == other.core,
-            "tf:", self.transformation == other.transformation,
-            # "left:", self.left_environment == other.left_environment,
-            "right:", self.right_environment == other.right_environment
-        )
+        trace(DEBUG, lambda: "Rule eq: tf: {} right: {}".format(
+            self.transformation == other.transformation,
+            self.right_environment == other.right_environment
+        ))
         return (
             self.core == other.core and \
             self.transformation == other.transformation and \
@@ -96,54 +151,165 @@ class Rule:
         if cos != tos:
             raise ValueError("core and transformation ordinals dont' match in rule {}".format(rs))
                     
+    def build_prefilter(self):
+        """
+        Sets core_start and left_end, which let apply() rule out most
+        positions with a single test each instead of running Matchers
+        """
+        self.core_start = None
+        for node in self.core.nodes:
+            if node.kind != Environment.Node.NULL:
+                if node.kind in (Environment.Node.SEGMENT, Environment.Node.BOUNDARY):
+                    self.core_start = node
+                break
+                
+        self.left_end = None
+        if self.left_environment:
+            node = self.left_environment.nodes[-1]
+            if node.kind in (Environment.Node.SEGMENT, Environment.Node.BOUNDARY) and not node.zero_plus:
+                self.left_end = node
+    
+    @staticmethod
+    def _node_accepts(node, symbol):
+        if node.kind == Environment.Node.BOUNDARY:
+            if node.value == SYLL_B:
+                return symbol in BOUNDARIES
+            return symbol == node.value
+        return symbol not in BOUNDARIES and node.value.matches(symbol)
+        
+    def can_start(self, context, i):
+        """
+        Returns False if the Rule can't match at context[i], judging only by
+        core_start and left_end. True means it may.
+        """
+        if self.core_start is not None and not self._node_accepts(self.core_start, context[i]):
+            return False
+        if self.left_end is not None:
+            i -= 1
+            if self.left_environment.crosses_boundaries:
+                while i >= 0 and context[i] in BOUNDARIES:
+                    i -= 1
+            if i < 0 or not self._node_accepts(self.left_end, context[i]):
+                return False
+        return True
+        
+    def is_word_local(self):
+        """
+        Returns True if the Rule can never read or change anything past a
+        word boundary, so that applying it to each word of an utterance on
+        its own (between its two word boundaries) gives the same result as
+        applying it to the whole utterance
+        """
+        for t_node in self.transformation.nodes:
+            if t_node.kind == Transformation.Node.BOUNDARY:
+                return False
+        if not self.core.crosses_boundaries:
+            # the core is tried at boundaries too; it must never match there
+            if not self.core.nodes or self.core.nodes[0].kind != Environment.Node.SEGMENT:
+                return False
+        # if the core skips boundaries, it starts at a Segment
+        state = _word_state(self.core, _AT_SEGMENT if self.core.crosses_boundaries else _ANYWHERE)
+        if state is None or state == _PAST_BOUNDARY:
+            return False
+        if self.left_environment and _word_state(self.left_environment, _ANYWHERE, reverse=True) is None:
+            return False
+        if self.right_environment and _word_state(self.right_environment, _ANYWHERE) is None:
+            return False
+        return True
+        
+    def reset_stats(self):
+        self.positions = 0
+        self.pruned = 0
+        
     def apply(self, context):
-        vpr("\nApplying rule: {}".format(self))
+        if RULE_STATS.enabled:
+            start = perf_counter()
+        if TRACER.rules is not None:
+            with TRACER.rule_scope(self):
+                result = self._apply(context)
+        else:
+            result = self._apply(context)
+        if RULE_STATS.enabled:
+            counters = RULE_STATS.get(self)
+            counters.calls += 1
+            counters.seconds += perf_counter() - start
+        return result
+        
+    def _apply(self, context):
+        trace(INFO, "\nApplying rule: {}", self)
+        tracing = TRACER.level >= DEBUG
         result = []
         i = 0
         last_i = -1
+        positions = 0
+        pruned = 0
+        left_attempts = 0
+        right_attempts = 0
+        match_count = 0
+        changes = 0
+        core_matcher = self.core.matcher()
+        left_matcher = self.left_environment.matcher(reverse=True) if self.left_environment else None
+        right_matcher = self.right_environment.matcher() if self.right_environment else None
         while i < len(context):
             if self.core.crosses_boundaries and context[i] in BOUNDARIES:
                 result.append(context[i])
                 i += 1
                 continue
                 
-            vpr("context index {}: {}".format(i, context[i]))
+            if tracing:
+                trace(DEBUG, "context index {}: {}", i, context[i])
             
+            positions += 1
+            if not self.can_start(context, i):
+                if tracing:
+                    trace(DEBUG, "  pruned")
+                pruned += 1
+                result.append(context[i])
+                i += 1
+                continue
+                
             matches = True
-            core_matcher = Matcher(context, self.core, i=i)
-            core_match = core_matcher.match()
-            vpr("  matching core...")
+            core_match = core_matcher.match(context, i)
+            if tracing:
+                trace(DEBUG, "  matching core...")
             if not core_match:
-                vpr("  no core match")
+                if tracing:
+                    trace(DEBUG, "  no core match")
                 matches = False
-            else:
-                vpr("  core match!")
+            elif tracing:
+                trace(DEBUG, "  core match!")
                 
-            if matches and self.left_environment:
-                vpr("  matching left...")
-                left_matcher = Matcher(context, self.left_environment, i=i-1, reverse=True)
-                if not left_matcher.match():
-                    vpr("  no left match")
+            if matches and left_matcher is not None:
+                left_attempts += 1
+                if tracing:
+                    trace(DEBUG, "  matching left...")
+                if not left_matcher.match(context, i - 1):
+                    if tracing:
+                        trace(DEBUG, "  no left match")
                     matches = False
-                else:
-                    vpr("  left match!")
-            if matches and self.right_environment:
-                vpr("  matching right...")
-                right_matcher = Matcher(context, self.right_environment, i=core_match.range[1])
-                if not right_matcher.match():
-                    vpr("  no right match")
+                elif tracing:
+                    trace(DEBUG, "  left match!")
+            if matches and right_matcher is not None:
+                right_attempts += 1
+                if tracing:
+                    trace(DEBUG, "  matching right...")
+                if not right_matcher.match(context, core_match.range[1]):
+                    if tracing:
+                        trace(DEBUG, "  no right match")
                     matches = False
-                else:
-                    vpr("  right match!")
+                elif tracing:
+                    trace(DEBUG, "  right match!")
                 
             if matches:
-                vpr("match at content index {}. Applying transformation...".format(i))
+                trace(INFO, "match at content index {}. Applying transformation...", i)
                 tf = self.transformation.apply(core_match, self.core)
+                match_count += 1
+                if RULE_STATS.enabled and [x for x in tf if x != NULL] != list(core_match.matchli):
+                    changes += 1
                 
-                prli = [(
+                trace(INFO, lambda: "transformation: {}".format("".join([(
                     IpaConverter.FULL.to_ipa(tfi) if isinstance(tfi, (Segment, MetaSegment)) else tfi
-                ) for tfi in tf]
-                vpr("transformation: {}".format("".join(prli)))
+                ) for tfi in tf])))
                 result += tf
                 
                 if core_match.range[1] == core_match.range[0]:
@@ -156,10 +322,78 @@ class Rule:
                 result.append(context[i])
                 i += 1
                 
+        self.positions += positions
+        self.pruned += pruned
+        if RULE_STATS.enabled:
+            counters = RULE_STATS.get(self)
+            counters.positions += positions
+            counters.pruned += pruned
+            counters.core += positions - pruned
+            counters.left += left_attempts
+            counters.right += right_attempts
+            counters.matches += match_count
+            counters.transformations += changes
+        trace(INFO, "pruned {} of {} positions", pruned, positions)
         result = [x for x in result if x != ""]
         return result
     
     
+def apply_rules(rules, segments, engine=None):
+    """
+    Returns the result of applying each of rules in turn to segments (an
+    iterable of Segments and boundaries) with Rule.apply, which traces and
+    counts (see rulestats.py) rule by rule and position by position. If
+    engine is given, engine(segments) is returned instead unless a Tracer or
+    RULE_STATS is on: the other engines (see transducer.py, vectorized.py and
+    streaming.py) fall back on the interpreter then.
+    """
+    if engine is not None and TRACER.level == OFF and not RULE_STATS.enabled:
+        return engine(segments)
+    if not isinstance(segments, list):
+        segments = list(segments)
+    for rule in rules:
+        segments = rule.apply(segments)
+    return segments
+
+
+# Where matching an Environment may be, for Rule.is_word_local: at a
+# Segment, anywhere (maybe at a word boundary) or maybe past a word boundary
+_AT_SEGMENT = 0
+_ANYWHERE = 1
+_PAST_BOUNDARY = 2
+
+
+def _word_state(env, state, reverse=False):
+    """
+    Returns where matching env leaves the position, given where it starts
+    (state), or None if matching env may read past a word boundary
+    """
+    nodes = reversed(env.nodes) if reverse else env.nodes
+    for node in nodes:
+        if state == _PAST_BOUNDARY:
+            # even a null node checks for the end of the context
+            return None
+        if env.crosses_boundaries and state == _ANYWHERE:
+            # the boundary would be skipped
+            return None
+        if node.kind == Environment.Node.SEGMENT:
+            # a Segment never matches a boundary
+            state = _ANYWHERE
+        elif node.kind == Environment.Node.BOUNDARY:
+            state = _PAST_BOUNDARY
+        elif node.kind in (Environment.Node.OPTIONAL, Environment.Node.POSSIBILITIES):
+            sub_envs = [node.value] if node.kind == Environment.Node.OPTIONAL else node.value
+            # an optional node may match nothing
+            end_state = state if node.kind == Environment.Node.OPTIONAL else _AT_SEGMENT
+            for sub_env in sub_envs:
+                sub_state = _word_state(sub_env, state, reverse=reverse)
+                if sub_state is None:
+                    return None
+                end_state = max(end_state, sub_state)
+            state = end_state
+    return state
+
+
 class RuleParser:
     def __init__(self, literal, ipaconverter=None, ipaconverter_full=None):
         self.literal = literal
@@ -178,23 +412,25 @@ class RuleParser:
 
     def _parse(self):
         rule = Rule()
+        rule.literal = self.literal
         
-        vpr("\nParsing core...")
+        trace(DEBUG, "\nParsing core...")
         rule.core = self.EnvironmentParser(self, self.ic, stopat="->").parse()
-        vpr("Completed core:", rule.core)
-        vpr("\nParsing transformation...")
+        trace(DEBUG, "Completed core: {}", rule.core)
+        trace(DEBUG, "\nParsing transformation...")
         rule.transformation = self.EnvironmentParser(self, self.icf, stopat="/", is_trans=True).parse()
-        vpr("Completed transformation:", rule.transformation)
-        vpr("\nParsing left_environment...")
+        trace(DEBUG, "Completed transformation: {}", rule.transformation)
+        trace(DEBUG, "\nParsing left_environment...")
         rule.left_environment = self.EnvironmentParser(self, self.icf, stopat = "_").parse()
-        vpr("Completed left_environment:", rule.left_environment)
-        vpr("\nParsing right_environment...")
+        trace(DEBUG, "Completed left_environment: {}", rule.left_environment)
+        trace(DEBUG, "\nParsing right_environment...")
         rule.right_environment = self.EnvironmentParser(self, self.icf, stopat=":").parse()
-        vpr("Completed right_environment:", rule.right_environment)
+        trace(DEBUG, "Completed right_environment: {}", rule.right_environment)
         if self.i < len(self.literal):
             flags = self.parse_flags()
         rule.validate()
-        vpr("\ncompleted rule:", rule)
+        rule.build_prefilter()
+        trace(DEBUG, "\ncompleted rule: {}", rule)
         
         return rule
         
@@ -243,14 +479,14 @@ class RuleParser:
                     self.in_square, self.in_curly, self.in_brackets
                 )) and self.stopat is not None:
                     if self.stop_here():
-                        vpr("Breaking due to stopat", i=self._depth)
+                        trace(DEBUG, "Breaking due to stopat", i=self._depth)
                         break
                         
                 token = self.parser.literal[self.parser.i]
-                vpr("  Token: \"{}\"  i={}/{}".format(token, self.parser.i, len(self.parser.literal)), i=self._depth)
-                vpr("  {}\n  {}^".format(self.parser.literal, " " * self.parser.i), i=self._depth)
+                trace(DEBUG, "  Token: \"{}\"  i={}/{}", token, self.parser.i, len(self.parser.literal), i=self._depth)
+                trace(DEBUG, lambda: "  {}\n  {}^".format(self.parser.literal, " " * self.parser.i), i=self._depth)
                 if token.isspace():
-                    vpr("    skipping whitespace")
+                    trace(DEBUG, "    skipping whitespace")
                     pass
                 elif self.in_curly:
                     self.__parse_env_token_in_curly(token)
@@ -260,7 +496,7 @@ class RuleParser:
                     self.__parse_env_token_out_square(token)
                         
                 self.parser.i += 1
-                vpr("    advancing parser generally ::", self.parser.literal[self.parser.i] if self.parser.i < len(self.parser.literal) else "END", i=self._depth)
+                trace(DEBUG, lambda: self._trace_position("advancing parser generally"), i=self._depth)
                 
             tags = {}
             if self.has_tags:
@@ -269,13 +505,18 @@ class RuleParser:
                 raise ValueError()
             return self.env_class(self.nodes, depth=self._depth, **tags)
             
+        def _trace_position(self, message):
+            return "    {} :: {}".format(message,
+                self.parser.literal[self.parser.i] if self.parser.i < len(self.parser.literal) else "END"
+            )
+            
         def stop_here(self):
             for _stopat in self.stopat:
                 test_stop = self.parser.literal[self.parser.i:self.parser.i + len(_stopat)]
-                vpr("    test_stop: \"{}\" == \"{}\": {}".format(test_stop, _stopat, test_stop == _stopat), i=self._depth)
+                trace(DEBUG, "    test_stop: \"{}\" == \"{}\": {}", test_stop, _stopat, test_stop == _stopat, i=self._depth)
                 if test_stop == _stopat:
                     self.parser.i += len(_stopat)
-                    vpr("    advancing parser to end of stopat", _stopat, "::", self.parser.literal[self.parser.i] if self.parser.i < len(self.parser.literal) else "END", i=self._depth)
+                    trace(DEBUG, lambda: self._trace_position("advancing parser to end of stopat " + _stopat), i=self._depth)
                     return True
             return False
             
@@ -319,7 +560,7 @@ class RuleParser:
             if self.buffer:
                 if token.isnumeric():
                     self.buffer.append(token)
-                    vpr("    adding ordinal digit +{} (ordinal is now {})".format(token, "".join(self.buffer)), i=self._depth)
+                    trace(DEBUG, "    adding ordinal digit +{} (ordinal is now {})", token, "".join(self.buffer), i=self._depth)
                 elif token == ":":
                     if not self.buffer:
                         raise ValueError("Invalid rule syntax (colon without ordinal)")
@@ -329,7 +570,7 @@ class RuleParser:
                     raise ValueError("invalid rule syntax (ordinal not closed with colon)")
             elif token.isnumeric() and token != "0":
                 self.buffer.append(token)
-                vpr("    adding ordinal digit +{} (ordinal is now {})".format(token, "".join(self.buffer)), i=self._depth)
+                trace(DEBUG, "    adding ordinal digit +{} (ordinal is now {})", token, "".join(self.buffer), i=self._depth)
                 
             elif token == ":":
                 self.has_tags = True
@@ -340,7 +581,7 @@ class RuleParser:
                 node = self.env_class.Node(
                     self.env_class.Node.NULL, NULL, ordinal=self.ordinal
                 )
-                vpr("   +node  (null): ", node, i=self._depth)
+                trace(DEBUG, "   +node  (null): {}", node, i=self._depth)
                 self.nodes.append(node)
                 self.ordinal = None
             elif token == STATICSIGN:
@@ -349,7 +590,7 @@ class RuleParser:
                 node = Transformation.Node(
                     Transformation.Node.STATIC, STATICSIGN, ordinal=self.ordinal
                 )
-                vpr("   +node  (static): ", node, i=self._depth)
+                trace(DEBUG, "   +node  (static): {}", node, i=self._depth)
                 self.nodes.append(node)
                 self.ordinal = None
             elif token == "0":
@@ -360,7 +601,7 @@ class RuleParser:
                     WORD_B if token == "#" else SYLL_B if token == "$" else MORPHEME_B,
                     ordinal=self.ordinal
                 )
-                vpr("   +node (bound): ", node, i=self._depth)
+                trace(DEBUG, "   +node (bound): {}", node, i=self._depth)
                 self.nodes.append(node)
                 self.ordinal = None
             elif token == "[":
@@ -372,19 +613,19 @@ class RuleParser:
                 self.curly_envs = []
             elif token == "(":
                 self.parser.i += 1
-                vpr("    advancing parser after ( ::", self.parser.literal[self.parser.i] if self.parser.i < len(self.parser.literal) else "END", i=self._depth)
+                trace(DEBUG, lambda: self._trace_position("advancing parser after ("), i=self._depth)
                 env = RuleParser.EnvironmentParser(self.parser, self.ic, stopat=")", depth=self._depth+1).parse()
                 node = Environment.Node(
                     Environment.Node.OPTIONAL, env
                 )
-                vpr("   +node (paren): ", node, i=self._depth)
+                trace(DEBUG, "   +node (paren): {}", node, i=self._depth)
                 self.nodes.append(node)
             
             else:
                 raise ValueError("Unrecognized or invalid rule syntax")
                 
         def __parse_env_token_in_curly(self, token):
-            vpr("  instantiating new EnvironmentParser within curly braces", i=self._depth)
+            trace(DEBUG, "  instantiating new EnvironmentParser within curly braces", i=self._depth)
             env = RuleParser.EnvironmentParser(self.parser, self.ic, stopat=[",","}"], depth=self._depth+1).parse()
             self.curly_envs.append(env)
             if self.parser.get_last_char() == "}":
@@ -392,16 +633,16 @@ class RuleParser:
                     Environment.Node.POSSIBILITIES,
                     self.curly_envs
                 )
-                vpr("   +node (  }  ): ", node, i=self._depth)
+                trace(DEBUG, "   +node (  }}  ): {}", node, i=self._depth)
                 self.nodes.append(node)
                 self.curly_envs = None
                 self.in_curly = False
             else:
-                vpr("  comma break in curly braces", i=self._depth)
+                trace(DEBUG, "  comma break in curly braces", i=self._depth)
                 # To counteract the automatic skipping of initial and final characters in EnvironmentParsers
                 # ("," is both the end of the previous and the start of the new Enviornment)
             self.parser.i -= 1
-            vpr("    receding parser after , in {} ::", self.parser.literal[self.parser.i] if self.parser.i < len(self.parser.literal) else "END", i=self._depth)
+            trace(DEBUG, lambda: self._trace_position("receding parser after , in"), i=self._depth)
                 
         def finalize_square_node(self):
             self.finalize_feat()
@@ -420,7 +661,7 @@ class RuleParser:
                     ),
                     ordinal=self.ordinal
                 )
-                vpr("   +node (metaS): ", node, i=self._depth)
+                trace(DEBUG, "   +node (metaS): {}", node, i=self._depth)
                 self.nodes.append(node)
                 
             self.feats = None
@@ -432,15 +673,22 @@ class RuleParser:
             self.in_square = False
             self.ordinal = None
             
-        STRESS_REGEX = regex.compile(r"stress=(\((?P<group>[012]+)\)|(?P<single>[012]))")
+        _stress_regex = None
+        
+        @classmethod
+        def stress_regex(cls):
+            if cls._stress_regex is None:
+                cls._stress_regex = regex_module().compile(r"stress=(\((?P<group>[012]+)\)|(?P<single>[012]))")
+            return cls._stress_regex
+            
         def finalize_feat(self):
             if not self.buffer:
                 return
             feat = "".join(self.buffer)
-            vpr("     feat:", feat, i=self._depth)
+            trace(DEBUG, "     feat: {}", feat, i=self._depth)
             self.buffer.clear()
             
-            m = self.STRESS_REGEX.match(feat)
+            m = self.stress_regex().match(feat)
             if m:
                 if m.group("group"):
                     stress = list(m.group("group"))
@@ -459,11 +707,11 @@ class RuleParser:
                     raise ValueError("No segment for IPA \"{}\"".format(feat))
                     
                 if self.env_class != Transformation:
-                    seg = MetaSegment(seg.data, stress=self.stress, ipa=seg.ipa)
+                    seg = MetaSegment(seg.data, stress=self.stress, ipa=feat)
                 node = self.env_class.Node(
                     self.env_class.Node.SEGMENT, seg
                 )
-                vpr("   +node (sgmnt): ", node, i=self._depth)
+                trace(DEBUG, "   +node (sgmnt): {}", node, i=self._depth)
                 self.nodes.append(node)
                 self.close_segment = True
                 
@@ -509,6 +757,10 @@ class Environment:
         
         self._is_fixed = self._check_fixed()
         self._inverse = None
+        self._matchers = None
+        self.ordinal_metas = {
+            node.ordinal: k for k, node in enumerate(self.nodes) if node.ordinal is not None
+        }
         
         self._depth = depth
         
@@ -525,15 +777,12 @@ class Environment:
         return "".join(sli)
         
     def __eq__(self, other):
-        vpr(
-            "Environment eq:",
-            "instance", isinstance(other, Environment),
-            "nodes", self.nodes == other.nodes,
-            "cb", self.crosses_boundaries == other.crosses_boundaries,
-            i=self._depth
-        )
         if not isinstance(other, Environment):
             return False
+        trace(DEBUG, lambda: "Environment eq: nodes {} cb {}".format(
+            self.nodes == other.nodes,
+            self.crosses_boundaries == other.crosses_boundaries
+        ), i=self._depth)
         return (
             self.nodes == other.nodes and self.crosses_boundaries == other.crosses_boundaries
         )
@@ -551,6 +800,15 @@ class Environment:
     def __getitem__(self, i):
         return self.nodes[i]
         
+    def matcher(self, reverse=False):
+        """Returns the Matcher of this Environment (matching backwards if reverse), made on first use"""
+        if self._matchers is None:
+            self._matchers = [None, None]
+        matcher = self._matchers[reverse]
+        if matcher is None:
+            matcher = self._matchers[reverse] = Matcher(self, reverse=reverse)
+        return matcher
+        
     def inverse(self):
         if not self._inverse:
             nodes = []
@@ -581,16 +839,6 @@ class Environment:
             self._ordinal = ordinal
             
         def __eq__(self, other):
-            # vpr(
-            (
-                "ENode {} == {} eq:".format(self, other),
-                "isntance", isinstance(other, Environment.Node),
-                "kind", self._kind == other._kind,
-                "value", self._value == other._value,
-                "zp", self._zero_plus == other._zero_plus,
-                "ord", self._ordinal == other._ordinal,
-                # i=self._depth
-            )
             if not isinstance(other, Environment.Node):
                 return False
             return (
@@ -678,260 +926,213 @@ class Environment:
             return self._ordinal
             
             
-class TriDict:
-    """
-    (index, meta, ordinal)
-    """
-    def __init__(self):
-        self._data = []
-        
-    def add(self, index, meta, ordinal):
-        self._data.append((index, meta, ordinal))
-        
-    def index_to_meta(self, index):
-        for i, j, o in self._data:
-            if i == index:
-                return j
-        return None
-        
-    def meta_to_index(self, index):
-        for i, j, o in self._data:
-            if j == index:
-                return i
-        return None
-        
-    def ordinal_to_index(self, ordinal):
-        for i, j, o in self._data:
-            if o == ordinal:
-                return i
-        return None
-        
-    def index_to_ordinal(self, index):
-        for i, j, o in self._data:
-            if i == index:
-                return o
-        return None
-        
-    def ordinal_to_meta(self, ordinal):
-        for i, j, o in self._data:
-            if o == ordinal:
-                return j
-        return None
-        
-    def meta_to_ordinal(self, index):
-        for i, j, o in self._data:
-            if j == index:
-                return o
-        return None
-        
-    
 class Matcher:
     """
+    Matches an Environment at any position of any context. There is one
+    Matcher per Environment and direction (see Environment.matcher), reused
+    for every attempt: a failed attempt allocates nothing, and a successful
+    one only its Match. Since it keeps working state, a Matcher must not be
+    used by two threads at once.
+    
     Attributes:
     --------------------------
-    context: list of Segment/boundry
-        This should be a reference to the original context, so don't change
-        anything in it. We're going to be making a lot of Matchers, so we
-        really don't want to clone this
     environment: Environment
-        The Environment to be matched
-    i: int
-        The index currently being operated on
-    _start_i: int
-        Original value of i. We need this for making the range in the Match
-        object at the end.
+        The Environment to be matched (its inverse if reverse)
     reverse: bool
         if True will attempt to match from right end of Environment and i
         will decrement instead of increment. Also Match object range will
-        be reversed (i, _start_i)
+        be reversed (i, start)
+    greek: dict or None
+        Greek letter values of the current attempt, if it has any
         
-    matchli: list of Segment/boundaries
-        Working list of match in context
-    
-    indexes: TriDict
-        3-way map matching indexes in matchli, to environment, to ordinals.
-        Only instantiated in fixed-width environments
+    _indexes: list (int or None) or None
+        Working index in the match list of each node. Only kept for
+        fixed-width environments matched forward
+    _nulls: list (int)
+        Working indexes of the nulls in the match list
     """
-    def __init__(self, context, environment, i, reverse=False):
-        self.context = context
-        self.environment = environment
-        self.i = i
-        self._start_i = i
+    def __init__(self, environment, reverse=False):
         self.reverse = reverse
+        self.environment = environment.inverse() if reverse else environment
+        self.greek = None
+        self._indexes = None
+        if environment.is_fixed and not reverse:
+            self._indexes = [None] * len(environment)
+        self._nulls = []
         
-        self.matchli = []
-        self.greek = {}
+    def match(self, context, i):
+        """
+        Returns the Match of the Environment in context starting at i (or
+        ending at i, if reverse), or None
+        """
+        env = self.environment
+        nodes = env.nodes
+        crosses_boundaries = env.crosses_boundaries
+        reverse = self.reverse
+        step = -1 if reverse else 1
+        end = len(context)
+        indexes = self._indexes
+        nulls = self._nulls
+        if nulls:
+            del nulls[:]
+        greek = self.greek = None
+        start = i
         
-        self.indexes = None
-        if self.environment.is_fixed and not self.reverse:
-            self.indexes = TriDict()
+        tracing = TRACER.level >= DEBUG
+        depth = env._depth
+        if tracing:
+            trace(DEBUG, lambda: "    MATCHER {} ON: {}".format(
+                env,
+                "".join([str(x) for x in (context[:i+1] if reverse else context[i:])])
+            ), i=depth)
             
-        if self.reverse:
-            self.environment = self.environment.inverse()
-        vpr("    MATCHER {} ON: {}".format(
-            self.environment,
-            "".join([str(x) for x in 
-                (self.context[:self.i+1] if self.reverse else self.context[self.i:])
-            ]),
-            i=self.environment._depth
-        ))
-        
-    def _is_end_of_context(self):
-        if (not self.reverse and self.i >= len(self.context)) \
-                or (self.reverse and self.i < 0):
-            vpr("    end of context", i=self.environment._depth)
-            return True
-        return False
-        
-    def match(self):
         meta_index = 0
-        while True:
-            # have we reached the end of the environment?
-            if meta_index >= len(self.environment):
-                break
-        
-            node = self.environment[meta_index]
-            vpr("    env index {}: {}".format(meta_index, node), i=self.environment._depth)
-            
-            if self._is_end_of_context():
+        while meta_index < len(nodes):
+            node = nodes[meta_index]
+            if tracing:
+                trace(DEBUG, "    env index {}: {}", meta_index, node, i=depth)
+                
+            if i < 0 or i >= end:
+                if tracing:
+                    trace(DEBUG, "    end of context", i=depth)
                 return None
-            # Add boundaries to matchli if needed
-            if self.environment.crosses_boundaries:
-                vpr("    skipping boundaries...", i=self.environment._depth)
-                while self.context[self.i] in BOUNDARIES:
-                    vpr("      i:{} is boundary {}".format(self.i, self.context[self.i]), i=self.environment._depth)
-                    self.matchli.append(self.context[self.i])
-                    self.i += -1 if self.reverse else 1
-                    if self._is_end_of_context():
+            # Boundaries are part of the match if skipped
+            if crosses_boundaries:
+                while context[i] in BOUNDARIES:
+                    if tracing:
+                        trace(DEBUG, "      i:{} is boundary {}", i, context[i], i=depth)
+                    i += step
+                    if i < 0 or i >= end:
+                        if tracing:
+                            trace(DEBUG, "    end of context", i=depth)
                         return None
             
-            vpr("    i is {}".format(self.i), i=self.environment._depth)
-            vpr("    does {} match {}".format(node, self.context[self.i]), i=self.environment._depth)
-            matches = self.match_node(node, meta_index)
-            vpr("      {}".format(matches), i=self.environment._depth)
+            symbol = context[i]
+            if tracing:
+                trace(DEBUG, "    does {} match {} (i {})", node, symbol, i, i=depth)
+            kind = node.kind
+            if kind == Environment.Node.SEGMENT:
+                meta = node.value
+                matches = symbol not in BOUNDARIES and meta.matches(symbol, greek=greek)
+                if matches:
+                    if indexes is not None:
+                        indexes[meta_index] = abs(i - start) + len(nulls)
+                    if meta.greek_feats:
+                        if greek is None:
+                            greek = self.greek = {}
+                        self.set_greek(node, symbol)
+                    i += step
+            elif kind == Environment.Node.NULL:
+                matches = True
+                if indexes is not None:
+                    indexes[meta_index] = abs(i - start) + len(nulls)
+                nulls.append(abs(i - start) + len(nulls))
+            elif kind == Environment.Node.BOUNDARY:
+                if node.value == SYLL_B:
+                    matches = symbol in BOUNDARIES
+                else:
+                    matches = symbol == node.value
+                if matches:
+                    if indexes is not None:
+                        indexes[meta_index] = abs(i - start) + len(nulls)
+                    i += step
+            else:
+                # an optional node always matches; possibilities need one to
+                matches = kind == Environment.Node.OPTIONAL
+                sub_envs = (node.value, ) if matches else node.value
+                for sub_env in sub_envs:
+                    m = sub_env.matcher(reverse).match(context, i)
+                    if m is not None:
+                        offset = abs(i - start) + len(nulls)
+                        for k in m.nulls:
+                            nulls.append(offset + k)
+                        i = m.range[0 if reverse else 1]
+                        matches = True
+                        break
+            
+            if tracing:
+                trace(DEBUG, "      {}", matches, i=depth)
             if node.zero_plus:
                 if not matches:
-                    vpr("    zp match end", i=self.environment._depth)
+                    if tracing:
+                        trace(DEBUG, "    zp match end", i=depth)
                     meta_index += 1
-                else:
-                    vpr("    zp match...", i=self.environment._depth)
+            elif not matches:
+                if tracing:
+                    trace(DEBUG, "    no match, returning None", i=depth)
+                return None
             else:
-                if not matches:
-                    vpr("    no match, returning None", i=self.environment._depth)
-                    return None
-                vpr("      match", i=self.environment._depth)
                 meta_index += 1
                 
-        vpr("    match!", i=self.environment._depth)
-        match = Match(
-            tuple(self.matchli),
-            (self._start_i, self.i),
-            self.indexes,
-            self.greek
+        if tracing:
+            trace(DEBUG, "    match!", i=depth)
+        if reverse:
+            # the match list was built backwards
+            last = abs(i - start) + len(nulls) - 1
+            return Match(context, (i, start), i + 1, None, tuple(last - k for k in reversed(nulls)), greek)
+        return Match(
+            context, (start, i), start, tuple(indexes) if indexes is not None else None,
+            tuple(nulls), greek
         )
-        if self.reverse:
-            match.reverse()
-        return match
-        
-    def match_node(self, node, meta_index):
-        if node.kind == Environment.Node.SEGMENT:
-            matches = self.match_segment_node(node, meta_index)
-        elif node.kind == Environment.Node.NULL:
-            matches = self.match_null_node(node, meta_index)
-        elif node.kind == Environment.Node.BOUNDARY:
-            matches = self.match_boundary_node(node, meta_index)
-        elif node.kind == Environment.Node.OPTIONAL:
-            matches = self.match_optional_node(node)
-        elif node.kind == Environment.Node.POSSIBILITIES:
-            matches = self.match_possibilities_node(node)
-        return matches
-        
-    def match_segment_node(self, node, meta_index):
-        seg = self.context[self.i]
-        if seg in BOUNDARIES:
-            vpr("    seg in boundaries: {}".format(seg), i=self.environment._depth)
-            return False
-        if not node.value.matches(seg, greek=self.greek):
-            vpr("    seg does not match: {}".format(seg), i=self.environment._depth)
-            return False
-        self.matchli.append(self.context[self.i])
-        
-        if self.environment.is_fixed and self.indexes:
-            match_index = len(self.matchli) - 1
-            self.indexes.add(match_index, meta_index, node.ordinal)
-                
-        self.set_greek(node, seg)
-        self.i += -1 if self.reverse else 1
-        return True
         
     def set_greek(self, node, segment):
         for feat, value in node.value.items():
             if value in GREEK and value not in greek:
                 self.greek[value] = segment[feat]
-            
-    def match_null_node(self, node, meta_index):
-        self.matchli.append(NULL)
-        
-        if self.environment.is_fixed and not self.reverse:
-            match_index = len(self.matchli) - 1
-            self.indexes.add(match_index, meta_index, node.ordinal)
-            
-        return True
-    
-    def match_boundary_node(self, node, meta_index):
-        if node.value == SYLL_B:
-            if self.context[self.i] not in (SYLL_B, WORD_B):
-                return False
-        elif node.value != self.context[self.i]:
-            return False
-        self.matchli.append(self.context[self.i])
-        
-        if self.environment.is_fixed and not self.reverse:
-            match_index = len(self.matchli) - 1
-            self.indexes.add(match_index, meta_index, node.ordinal)
-        
-        self.i += -1 if self.reverse else 1
-        return True
-                
-    def match_optional_node(self, node):
-        vpr("    checking optional node...", i=self.environment._depth)
-        matcher = Matcher(self.context, node.value, self.i, reverse=self.reverse)
-        m = matcher.match()
-        if m is None:
-            vpr("    optional node nbd", i=self.environment._depth)
-            return True
-        self.matchli += m.matchli
-        self.i = m.range[0 if self.reverse else 1]
-        vpr("    optional node match!", i=self.environment._depth)
-        return True
-    
-    def match_possibilities_node(self, node):
-        for env in node.value:
-            matcher = Matcher(self.context, env, self.i, reverse=self.reverse)
-            m = matcher.match()
-            if m is not None:
-                self.matchli += m.matchli
-                self.i = m.range[0 if self.reverse else 1]
-                return True
-        return False
 
 
 class Match:
-    def __init__(self, matchli, range, indexes, greek):
-        self.matchli = matchli
+    """
+    A match of an Environment in a context. Its match list (matchli) is the
+    symbols of the context it spans, with a NULL where each null node (of
+    the Environment or of an optional node or possibility) matched. It is
+    only built if asked for, from the context, which must not have changed.
+    
+    Attributes
+    ------------------------
+    context: list of Segment/boundaries
+    range: (int, int)
+        Start and end of the match in context
+    indexes: tuple (int or None) or None
+        Index in the match list of each Segment, null or boundary node of a
+        fixed-width Environment matched forward, None for other nodes
+    nulls: tuple (int)
+        Indexes of the nulls in the match list, ascending
+    greek: dict or None
+        Values of the Greek letters of the Environment, if it has any
+    """
+    __slots__ = ("context", "range", "indexes", "nulls", "greek", "_first", "_matchli")
+    def __init__(self, context, range, first, indexes, nulls, greek):
+        self.context = context
         self.range = range
         self.indexes = indexes
+        self.nulls = nulls
         self.greek = greek
+        self._first = first
+        self._matchli = None
         
-    def reverse(self):
-        self.matchli = tuple(reversed(self.matchli))
-        self.range = (self.range[1], self.range[0])
+    @property
+    def matchli(self):
+        if self._matchli is None:
+            first = self._first
+            matchli = list(self.context[first:first + abs(self.range[1] - self.range[0])])
+            for k in self.nulls:
+                matchli.insert(k, NULL)
+            self._matchli = tuple(matchli)
+        return self._matchli
         
     def __len__(self):
-        return len(self.matchli)
+        return abs(self.range[1] - self.range[0]) + len(self.nulls)
         
     def __getitem__(self, i):
-        return self.matchli[i]
+        if self.nulls or i < 0:
+            return self.matchli[i]
+        if i >= abs(self.range[1] - self.range[0]):
+            raise IndexError("Match index out of range")
+        return self.context[self._first + i]
+        
+    def __iter__(self):
+        return iter(self.matchli)
 
 
 class Transformation:
@@ -951,14 +1152,11 @@ class Transformation:
         ])
         
     def __eq__(self, other):
-        vpr(
-            "Transformation {} == {} eq:".format(self, other),
-            "isinstance", isinstance(other, Transformation),
-            "nodes:", self.nodes == other.nodes
-        )
-            
         if not isinstance(other, Transformation):
             return False
+        trace(DEBUG, lambda: "Transformation {} == {} eq: nodes: {}".format(
+            self, other, self.nodes == other.nodes
+        ))
         return self.nodes == other.nodes
     
     class Node:
@@ -974,15 +1172,14 @@ class Transformation:
             self._ordinal = ordinal
             
         def __eq__(self, other):
-            vpr(
-                "TNode {} == {}".format(self, other),
-                "isinstance {} == {}".format(type(self), type(other)), isinstance(other, Transformation.Node),
-                "kind", self._kind == other._kind,
-                "value", self._value == other._value,
-                "ordinal", self._ordinal == other._ordinal
-            )
             if not isinstance(other, Transformation.Node):
                 return False
+            trace(DEBUG, lambda: "TNode {} == {} kind {} value {} ordinal {}".format(
+                self, other,
+                self._kind == other._kind,
+                self._value == other._value,
+                self._ordinal == other._ordinal
+            ))
             return (
                 self._kind == other._kind and \
                 self._value == other._value and \
@@ -1039,7 +1236,7 @@ class Transformation:
                 return segment
             if self.kind != self.METASEGMENT:
                 return self.value
-            vpr("new seg: {}  value: {}".format(type(segment), type(self.value)))
+            trace(DEBUG, "new seg: {}  value: {}", type(segment), type(self.value))
             new_seg = segment.update(self.value, greek=greek)
             if core_node.value.bracketed:
                 if core_node.value.bracketed.matches(seg):
@@ -1053,48 +1250,60 @@ class Transformation:
         return self.nodes[i]
             
     def apply(self, core_match, core):
-        vpr("\nApplying Transformation to {}...".format("".join(str(x) for x in core_match)))
+        tracing = TRACER.level >= DEBUG
+        if tracing:
+            trace(DEBUG, lambda: "\nApplying Transformation to {}...".format("".join(str(x) for x in core_match)))
         result = []
         ii = 0
         for t, t_node in enumerate(self.nodes):
-            vpr("  {}".format(t_node))
+            if tracing:
+                trace(DEBUG, "  {}", t_node)
+                trace(DEBUG, "    last i: {}", ii)
             # Load boundaries if applicable
-            vpr("    last i: {}".format(ii))
             if core.crosses_boundaries:
                 while ii < len(core_match) and core_match[ii] in BOUNDARIES:
-                    vpr("      loading boundary {}".format(core_match[ii]))
+                    if tracing:
+                        trace(DEBUG, "      loading boundary {}", core_match[ii])
                     result.append(core_match[ii])
                     ii += 1
                 
             o = t_node.ordinal
             if o is not None:
-                j = core_match.indexes.ordinal_to_meta(o)
-                vpr("    ordinal {} == meta {}".format(o, j))
+                j = core.ordinal_metas.get(o)
+                if tracing:
+                    trace(DEBUG, "    ordinal {} == meta {}", o, j)
             else:
                 j = t
-                vpr("    no ordinal == meta {}".format(j))
+                if tracing:
+                    trace(DEBUG, "    no ordinal == meta {}", j)
             core_node = core[j]
-            vpr("    core node: {}".format(core_node))
+            if tracing:
+                trace(DEBUG, "    core node: {}", core_node)
             
-            i = core_match.indexes.meta_to_index(j)
-            vpr("    index == {}".format(i))
+            i = core_match.indexes[j]
+            if tracing:
+                trace(DEBUG, "    index == {}", i)
             ii = i + 1
             seg = core_match[i]
-            vpr("    core match segment == {}".format(seg))
-            
-            vpr("    applying {} to {}".format(t_node, seg))
+            if tracing:
+                trace(DEBUG, "    core match segment == {}", seg)
+                trace(DEBUG, "    applying {} to {}", t_node, seg)
             new_seg = t_node.apply(seg, core_node, greek=core_match.greek)
-            vpr("      result: {}".format(new_seg))
             result.append(new_seg)
-            vpr("  {}".format("".join(str(x) for x in result)))
+            if tracing:
+                trace(DEBUG, "      result: {}", new_seg)
+                trace(DEBUG, lambda: "  {}".format("".join(str(x) for x in result)))
             
         # Load any remaining boundaries before the end
         if core.crosses_boundaries:
-            vpr("    last i: {}".format(ii))
+            if tracing:
+                trace(DEBUG, "    last i: {}", ii)
             while ii < len(core_match) and core_match[ii] in BOUNDARIES:
-                vpr("      final loading boundary {}".format(core_match[ii]))
+                if tracing:
+                    trace(DEBUG, "      final loading boundary {}", core_match[ii])
                 result.append(core_match[ii])
                 ii += 1
                 
-        vpr("completed: {}".format("".join(str(x) for x in result)))
+        if tracing:
+            trace(DEBUG, lambda: "completed: {}".format("".join(str(x) for x in result)))
         return result
@@ -0,0 +1,127 @@
+"""
+Per-rule runtime counters.
+
+While RULE_STATS is enabled, Rule.apply counts, per rule name, what it
+does:
+    RULE_STATS.enable()
+    pipeline.transcribe(text)
+    print(RULE_STATS.format_table())
+    RULE_STATS.reset()
+Rules without a name are counted under their text. The counters describe
+the interpreter: while they are enabled, a RulesetTransducer applies its
+Rules with Rule.apply too.
+
+Disabled (the default), they cost one test per Rule.apply call.
+"""
+
+from collections import OrderedDict
+
+
+# Counters, in table order:
+#     calls: Rule.apply calls
+#     positions: positions scanned
+#     pruned: positions the prefilter ruled out
+#     core, left, right: match attempts of the core and of each environment
+#     matches: positions where the whole Rule matched
+#     transformations: matches whose transformation changed the context
+#     seconds: wall time in Rule.apply
+FIELDS = (
+    "calls", "positions", "pruned", "core", "left", "right", "matches",
+    "transformations", "seconds"
+)
+
+
+class RuleCounters:
+    """The counters of one rule name (see FIELDS)"""
+    __slots__ = FIELDS
+    def __init__(self):
+        for field in FIELDS:
+            setattr(self, field, 0)
+            
+    def add(self, other):
+        for field in FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+            
+    def as_dict(self):
+        return {field: getattr(self, field) for field in FIELDS}
+        
+    @classmethod
+    def from_dict(cls, d):
+        counters = cls()
+        for field in FIELDS:
+            setattr(counters, field, d.get(field, 0))
+        return counters
+
+
+class RuleStats:
+    """
+    Attributes
+    ------------------------
+    enabled: bool
+        Whether Rule.apply counts
+    counters: OrderedDict {str: RuleCounters}
+        Counters by rule name, in the order the rules were first applied
+    """
+    def __init__(self):
+        self.enabled = False
+        self.counters = OrderedDict()
+        
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        
+    def disable(self):
+        self.enabled = False
+        
+    def reset(self):
+        self.counters.clear()
+        
+    @staticmethod
+    def rule_key(rule):
+        return rule.name or rule.literal or str(rule)
+        
+    def get(self, rule):
+        """Returns the RuleCounters of rule, creating them if need be"""
+        key = self.rule_key(rule)
+        counters = self.counters.get(key)
+        if counters is None:
+            counters = self.counters[key] = RuleCounters()
+        return counters
+        
+    def snapshot(self):
+        """Returns the counters as {rule name: {counter: value}}"""
+        return OrderedDict((key, counters.as_dict()) for key, counters in self.counters.items())
+        
+    def merge(self, snapshot):
+        """Adds the counters of a snapshot(), eg one taken in another process"""
+        for key, d in snapshot.items():
+            counters = self.counters.get(key)
+            if counters is None:
+                counters = self.counters[key] = RuleCounters()
+            counters.add(RuleCounters.from_dict(d))
+            
+    def rows(self, sort="seconds"):
+        """Returns [(rule name, RuleCounters)], sorted by the counter sort, descending"""
+        if sort not in FIELDS:
+            raise ValueError("Unknown counter '{}'".format(sort))
+        return sorted(self.counters.items(), key=lambda row: getattr(row[1], sort), reverse=True)
+        
+    def format_table(self, sort="seconds", width=40):
+        """Returns the counters as a table of text, one rule per row, sorted as by rows()"""
+        widths = [max(len(field), 10) for field in FIELDS]
+        lines = ["{:<{}}".format("rule", width) + "".join(
+            " {:>{}}".format(field, w) for field, w in zip(FIELDS, widths)
+        )]
+        for key, counters in self.rows(sort):
+            if len(key) > width:
+                key = key[:width - 3] + "..."
+            cells = []
+            for field, w in zip(FIELDS, widths):
+                if field == "seconds":
+                    cells.append(" {:>{}.4f}".format(counters.seconds, w))
+                else:
+                    cells.append(" {:>{}}".format(getattr(counters, field), w))
+            lines.append("{:<{}}".format(key, width) + "".join(cells))
+        return "\n".join(lines)
+
+
+RULE_STATS = RuleStats()
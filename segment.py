@@ -1,41 +1,70 @@
 """
-Wrapper for panphon Segment object that allows it to be
-initialized with a dict or a str without having to supply
-names of all segments.
+Phonological segments made of ternary (+, -, 0) features, modelled on
+panphon's feature vectors. They can be initialized with a dict or a str
+without having to supply names of all features.
+
+A complete Segment packs its features into a single int (see
+pack_features) and is immutable and interned; a MetaSegment keeps a dict of
+only the features it specifies.
 """
 
-from panphon.segment import Segment as _Segment
-try:
-    import regex as re
-except ImportError:
-    import re
 from init import *
+from tracing import TRACER, trace, DEBUG
+
+
+# Packed features: feature k of FEATURES is + if bit k is set, - if bit
+# k + NEG_SHIFT is set, and 0 if neither is.
+NEG_SHIFT = len(FEATURES)
+POS_BITS = {feat: 1 << k for k, feat in enumerate(FEATURES)}
+NEG_BITS = {feat: 1 << (k + NEG_SHIFT) for k, feat in enumerate(FEATURES)}
+
+# Segment stress as a bit, for matching against a set of stresses in one test
+STRESS_BITS = {None: 1, 0: 2, 1: 4, 2: 8}
+ANY_STRESS = 15
+
 
+def pack_features(features):
+    """Returns the packed int of a dict {feature: 1, -1 or 0}"""
+    bits = 0
+    for feat, val in features.items():
+        if val == 1:
+            bits |= POS_BITS[feat]
+        elif val == -1:
+            bits |= NEG_BITS[feat]
+    return bits
 
-class AbstractSegment(_Segment):
+
+def unpack_feature(bits, feat):
+    """Returns the value (1, -1 or 0) of feat in the packed int bits"""
+    if bits & POS_BITS[feat]:
+        return 1
+    if bits & NEG_BITS[feat]:
+        return -1
+    return 0
+
+
+class AbstractSegment:
     """
     Parent class of Segment and MetaSegment.
     """
+    __slots__ = ("stress", "ipa")
     S2N = {"+": 1, "-": -1, "0": 0}
     N2S = {1: "+", -1: "-", 0: "0"}
-    def __init__(self, features, stress=None, ipa=None):
+    def __init__(self, stress=None, ipa=None):
         self.stress = stress
         self.ipa = ipa
         
+    @staticmethod
+    def _read_features(features):
+        """Returns a new dict {feature: value} of features given as a dict or str"""
         if isinstance(features, dict):
-            names = list(features.keys())
-            
-        elif isinstance(features, str):
+            return dict(features)
+        if isinstance(features, str):
             d = {}
-            for m in re.finditer(r"'(\+|0|-)(\w+)", features):
-                d[m.group(1)] = m.group(2)
-            features = d
-            names = list(features.keys())
-            
-        else:
-            raise ValueError("Segment must be initalized with type str or dict, not '%s'" % type(features))
-        
-        _Segment.__init__(self, names, features=features)
+            for m in regex_module().finditer(r"(\+|0|-)(\w+)", features):
+                d[m.group(2)] = AbstractSegment.S2N[m.group(1)]
+            return d
+        raise ValueError("Segment must be initalized with type str or dict, not '%s'" % type(features))
         
     def is_subsegment(self, other):
         """returns True if self is a subsegment of other. That is, all
@@ -47,15 +76,19 @@ class AbstractSegment(_Segment):
             return False
         return True
         
-    def get_hash(self):
-        return hash(frozenset(self.data.items()))
+    def items(self):
+        return list(self.iteritems())
         
-    _STRESS_D = {0:-1, None:0, 1:1, 2:1}
-    def __getitem__(self, k):
-        if k == "stress":
-            return self._STRESS_D[self.stress]
-        return _Segment.__getitem__(self, k)
+    def iteritems(self):
+        return iter(self.data.items())
+        
+    def __iter__(self):
+        return iter(self.data)
         
+    def __len__(self):
+        return len(self.data)
+        
+    _STRESS_D = {0:-1, None:0, 1:1, 2:1}
     
     def get(self, k, default=None):
         return self.data.get(k, default)
@@ -67,8 +100,13 @@ class AbstractSegment(_Segment):
     def __str__(self):
         if self.ipa is not None:
             return self.ipa
-        return _Segment.__str__(self)
-                
+        return repr(self)
+        
+    def __repr__(self):
+        """Return a string representation of a feature vector"""
+        fts = ", ".join(["{}{}".format(self.N2S.get(v, v), k) for k, v in self.iteritems()])
+        return "<Segment [{}]>".format(fts)
+
 
 class Segment(AbstractSegment):
     """
@@ -76,18 +114,29 @@ class Segment(AbstractSegment):
     1) Segment must have a + or - in self.data for ALL features. This
     represents a complete segment, not a transformation or environment, and
     2) Segment stress is an int (or None if the segment is -syl)
+    
+    Features are stored packed in self.bits (see pack_features). self.data
+    is a dict built from them on demand.
+    
+    Segments are immutable flyweights: there is only ever one Segment for
+    each combination of features and stress, so two Segments are equal only
+    if they are the same object. self.ipa is only a label for display; it
+    is the symbol the Segment was first created with, if any.
     """
-    def __init__(self, features, stress=None, ipa=None):
-        AbstractSegment.__init__(self, features, stress=stress, ipa=ipa)
-        if set(self.data.keys()) != FEATURESET:
+    __slots__ = ("bits",)
+    _interned = {}
+    
+    def __new__(cls, features, stress=None, ipa=None):
+        features = cls._read_features(features)
+        if features.keys() != FEATURESET:
             missing_feats = set()
             extra_feats = set()
-            for feat in self.data.keys():
+            for feat in features.keys():
                 if feat not in FEATURESET:
                     print("EXTRA FEAT: '{}'".format(feat))
                     extra_feats.add(feat)
             for feat in FEATURESET:
-                if feat not in self.data:
+                if feat not in features:
                     missing_feats.add(feat)
             error = []
             if missing_feats:
@@ -96,27 +145,76 @@ class Segment(AbstractSegment):
                 error.append("extra feats: [{}]".format(", ".join(missing_feats)))
             error = "  ".join(error)
             raise ValueError("Instantiating full Segment with featureset that does not match default. {}".format(error))
-        if self.stress not in (None, 0, 1, 2):
+        if stress not in (None, 0, 1, 2):
             raise ValueError("Segment stress must be 0, 1, 2, or None.")
-            
+        return cls.from_bits(pack_features(features), stress=stress, ipa=ipa)
+        
+    def __init__(self, features, stress=None, ipa=None):
+        # everything is done in __new__
+        pass
+        
+    @classmethod
+    def from_bits(cls, bits, stress=None, ipa=None):
+        """
+        Trusted constructor: returns the Segment with already packed
+        features and stress, without validating them
+        """
+        seg = cls._interned.get((bits, stress))
+        if seg is None:
+            seg = object.__new__(cls)
+            object.__setattr__(seg, "bits", bits)
+            object.__setattr__(seg, "stress", stress)
+            object.__setattr__(seg, "ipa", ipa)
+            cls._interned[(bits, stress)] = seg
+        return seg
+        
+    def __setattr__(self, name, value):
+        raise AttributeError("Segments are immutable, use with_stress() or update() instead")
+        
+    def __reduce__(self):
+        # unpickled Segments are interned too
+        return (Segment.from_bits, (self.bits, self.stress, self.ipa))
+        
+    @property
+    def data(self):
+        return {feat: unpack_feature(self.bits, feat) for feat in FEATURES}
+        
+    def __getitem__(self, k):
+        if k == "stress":
+            return self._STRESS_D[self.stress]
+        return unpack_feature(self.bits, k)
+        
+    def get(self, k, default=None):
+        if k not in POS_BITS:
+            return default
+        return unpack_feature(self.bits, k)
+        
+    def get_hash(self):
+        return self.bits
+        
     def __eq__(self, other):
-        if not isinstance(other, Segment):
-            return False
-        return self.stress == other.stress and self.data == other.data
+        return self is other
+        
+    __hash__ = object.__hash__
+    
+    def with_stress(self, stress):
+        return Segment.from_bits(self.bits, stress=stress, ipa=self.ipa)
         
     def update(self, other, greek=None):
-        odata = other.data if isinstance(other, Segment) else other
-        if greek:
-            for feat, value in odata.items():
-                if value in greek:
-                    odata[feat] = greek[value]
-        data = self.data.copy()
-        for feat, val in odata.items():
-            data[feat] = val
-        return Segment(data, stress=self.stress)
+        if isinstance(other, Segment):
+            bits = other.bits
+        else:
+            if not isinstance(other, MetaSegment):
+                other = MetaSegment(other)
+            bits = (self.bits & ~other.mask_bits) | other.value_bits
+            for feat, value in other.greek_feats:
+                if greek and value in greek:
+                    bits |= pack_features({feat: greek[value]})
+        return Segment.from_bits(bits, stress=self.stress)
         
     def copy(self):
-        return Segment(self.data, stress=self.stress, ipa=self.ipa)
+        # immutable, so there is nothing to copy
+        return self
 
 
 class MetaSegment(AbstractSegment):
@@ -129,9 +227,22 @@ class MetaSegment(AbstractSegment):
     3) MetaSegment stress is a set of ints (or None) OR an int if being used
     for transformation
     4) Has a bracketed value (MetaSegment or None) representing optional features
+    
+    self.data is compiled once into packed masks, so that matching and
+    transforming don't need to look at features one by one:
+    mask_bits: every feature in self.data
+    match_bits: every non-Greek feature in self.data (the care-mask)
+    value_bits: the packed values of the non-Greek features
+    greek_feats: tuple of (feature, Greek letter) pairs
+    stress_bits: STRESS_BITS of every stress in self.stress
     """
+    __slots__ = (
+        "data", "bracketed", "mask_bits", "match_bits", "value_bits",
+        "greek_feats", "stress_bits"
+    )
     def __init__(self, features, stress=None, bracketed=None, ipa=None):
-        AbstractSegment.__init__(self, features, stress=stress, ipa=ipa)
+        AbstractSegment.__init__(self, stress=stress, ipa=ipa)
+        self.data = self._read_features(features)
         for feat in self.data:
             if feat not in FEATURESET:
                 raise ValueError("Feature '{}' does not exist in default featureset".format(feat))
@@ -139,36 +250,73 @@ class MetaSegment(AbstractSegment):
             self.stress = set([self.stress])
         self.bracketed = bracketed
         
+        self.mask_bits = 0
+        self.match_bits = 0
+        self.value_bits = 0
+        greek_feats = []
+        for feat, value in self.data.items():
+            feat_bits = POS_BITS[feat] | NEG_BITS[feat]
+            self.mask_bits |= feat_bits
+            if isinstance(value, str):
+                greek_feats.append((feat, value))
+            else:
+                self.match_bits |= feat_bits
+                self.value_bits |= pack_features({feat: value})
+        self.greek_feats = tuple(greek_feats)
+        
+        if self.stress is None:
+            self.stress_bits = ANY_STRESS
+        else:
+            self.stress_bits = 0
+            for stress in self.stress:
+                self.stress_bits |= STRESS_BITS[stress]
+        
+    @property
+    def names(self):
+        return list(self.data)
+        
+    def __getitem__(self, k):
+        if k == "stress":
+            return self._STRESS_D[self.stress]
+        return self.data[k]
+        
+    def get_hash(self):
+        return hash(frozenset(self.data.items()))
+        
     def __eq__(self, other):
         if not isinstance(other, MetaSegment):
             return False
         return self.stress == other.stress and self.data == other.data
         
     def matches(self, segment, greek=None):
-        for feat in self.data:
-            if isinstance(self[feat], str):
-                # skips Greek values
-                continue
-            if segment[feat] != self[feat]:
-                vpr("no match on feat:", feat)
-                return False
-                
+        if segment.bits & self.match_bits != self.value_bits:
+            if TRACER.level >= DEBUG:
+                trace(DEBUG, "no match on feat: {}", self._mismatched_feat(segment))
+            return False
+            
         if greek:
-            for feat in self.data:
-                if self[feat] not in greek:
+            for feat, value in self.greek_feats:
+                if value not in greek:
                     continue
-                if segment[feat] != greek[self[feat]]:
-                    vpr("no match on feat:", feat, "(greek)")
+                if segment[feat] != greek[value]:
+                    if TRACER.level >= DEBUG:
+                        trace(DEBUG, "no match on feat: {} (greek)", feat)
                     return False
-                
-        if self.stress is not None:
-            if segment.stress not in self.stress:
-                vpr("no match on stress:", self.stress, "vs", segment.stress)
-                return False
+        
+        if not STRESS_BITS[segment.stress] & self.stress_bits:
+            if TRACER.level >= DEBUG:
+                trace(DEBUG, "no match on stress: {} vs {}", self.stress, segment.stress)
+            return False
         return True
         
+    def _mismatched_feat(self, segment):
+        for feat, value in self.data.items():
+            if not isinstance(value, str) and segment[feat] != value:
+                return feat
+        return None
+        
     def transform(self, segment, greek=None):
-        new_data = dict(segment.data)
+        new_data = segment.data
         for feat, v in self.data.items():
             if v in greek:
                 v = greek[v]
@@ -183,12 +331,3 @@ class MetaSegment(AbstractSegment):
                     )
                 new_stress = self.stress
         return Segment(new_data, stress=new_stress)
-        
-    def __repr__(self):
-        """Return a string representation of a feature vector"""
-        pairs = [(self.n2s.get(self.data[k], self.data[k]), k) for k in self.names]
-        fts = ', '.join(['{}{}'.format(*pair) for pair in pairs])
-        return '<Segment [{}]>'.format(fts)
-    
-
-
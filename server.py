@@ -0,0 +1,551 @@
+"""
+Long-running transcription server.
+
+Every run of pyphone.py loads the converters, the dictionary and the ruleset
+anew. The server loads them once, with a Pipeline for each of several
+rulesets, and answers requests as newline-delimited JSON over a Unix socket
+or a TCP port on localhost:
+    {"id": 7, "text": "hello world", "ruleset": "rp"}
+    {"id": 7, "broad": "...", "narrow": "...", "error": null, "oov": []}
+"ruleset" defaults to the first ruleset the server was started with, and
+"id" (any JSON value) is echoed back: a connection may have many requests in
+flight, and each response is sent as soon as it is ready. "oov" lists the
+words of the text that are out of the dictionary, and so left out of the
+transcriptions. The request {"stats": true} is answered with {"stats": ...}
+(see LatencyStats.summary).
+
+The requests of all connections are collected into micro-batches: a batch is
+sent off once it has max_batch requests, or once its first request has
+waited max_delay seconds. Batches run on a pool of worker processes, which
+share the Pipelines of the server process (see batch.preload), at most one
+batch per worker at a time, so that under load requests gather into larger
+batches instead of queueing up in the pool. With workers=0, batches run in a
+thread of the server process.
+
+TranscriptionServer.transcribe() is the same service without a socket, and
+Client talks to a running server:
+    $ python server.py -r sae -r rp --socket /tmp/pyphone.sock
+    $ python server.py --client -r rp --socket /tmp/pyphone.sock < input.txt
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import math
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from batch import FORMATS, preload, read_lines, transcribe_text, write_results
+from pyphone import DEFAULT_RULESETS
+from init import *
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_MAX_BATCH = 64
+DEFAULT_MAX_DELAY = 0.002
+
+# Requests a client keeps in flight
+DEFAULT_CONCURRENCY = 256
+
+# Latencies the percentiles are computed over: those of the most recent requests
+LATENCY_WINDOW = 10000
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Longest request or response line, in bytes
+MAX_LINE = 1 << 20
+
+# Result of the requests a closing server doesn't transcribe
+_CLOSING = (None, None, "CancelledError: server closing", [])
+
+# The Pipelines of the current worker process, by ruleset name, and the
+# arguments they were made with
+_pipelines = None
+_pipelines_args = None
+
+
+def _init_worker(ruleset_names, compiled=False, vectorized=False):
+    global _pipelines, _pipelines_args
+    from pipeline import Pipeline
+    args = (list(ruleset_names), compiled, vectorized)
+    if args == _pipelines_args:
+        return
+    _pipelines = {
+        name: Pipeline(name, compiled=compiled, vectorized=vectorized)
+        for name in ruleset_names
+    }
+    _pipelines_args = args
+
+
+def _transcribe_batch(requests):
+    """Returns [(broad, narrow, error, oov)] for requests, a list of (ruleset name, text)"""
+    return [transcribe_text(_pipelines[name], text) for name, text in requests]
+
+
+def _error(e):
+    return "{}: {}".format(type(e).__name__, e)
+
+
+class LatencyStats:
+    """
+    Attributes
+    ------------------------
+    latencies: deque (float)
+        Seconds each of the most recent requests took
+    count: int
+        Requests measured in all
+    batches: int
+        Batches run
+    batched: int
+        Requests in them
+    """
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self.batches = 0
+        self.batched = 0
+        
+    def add(self, seconds):
+        self.latencies.append(seconds)
+        self.count += 1
+        
+    def add_batch(self, size):
+        self.batches += 1
+        self.batched += size
+        
+    def percentiles(self, percentiles=PERCENTILES):
+        """Returns {percentile: seconds} over latencies (nearest rank), empty if there are none"""
+        values = sorted(self.latencies)
+        if not values:
+            return {}
+        return {
+            p: values[min(max(math.ceil(p / 100 * len(values)) - 1, 0), len(values) - 1)]
+            for p in percentiles
+        }
+        
+    def summary(self):
+        """Returns the stats as a dict, with latencies in milliseconds"""
+        latency = {"p{:g}".format(p): round(s * 1000, 3) for p, s in self.percentiles().items()}
+        if self.latencies:
+            latency["max"] = round(max(self.latencies) * 1000, 3)
+        summary = {"requests": self.count, "latency_ms": latency}
+        if self.batches:
+            summary["batches"] = self.batches
+            summary["mean_batch"] = round(self.batched / self.batches, 2)
+        return summary
+        
+    def format(self):
+        """Returns the stats as a line of text"""
+        parts = ["{} requests".format(self.count)]
+        if self.batches:
+            parts.append("{} batches (mean size {:.1f})".format(self.batches, self.batched / self.batches))
+        parts += [
+            "p{:g} {:.2f} ms".format(p, s * 1000) for p, s in self.percentiles().items()
+        ]
+        return ", ".join(parts)
+
+
+class TranscriptionServer:
+    """
+    Attributes
+    ------------------------
+    ruleset_names: list (str)
+        Rulesets served, the first being the default
+    workers: int
+        Worker processes, or 0 to run batches in a thread
+    max_batch: int
+        Most requests in a batch
+    max_delay: float
+        Most seconds a request waits for others to join its batch
+    compiled, vectorized: bool
+        Engine the Pipelines apply their rulesets with (see Pipeline)
+    stats: LatencyStats
+        Latencies from receiving each request to having its result
+    """
+    def __init__(self, ruleset_names, workers=None, max_batch=DEFAULT_MAX_BATCH,
+            max_delay=DEFAULT_MAX_DELAY, compiled=False, vectorized=False):
+        self.ruleset_names = [DEFAULT_RULESETS.get(name, name) for name in ruleset_names]
+        if not self.ruleset_names:
+            raise ValueError("No ruleset to serve")
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.compiled = compiled
+        self.vectorized = vectorized
+        self.stats = LatencyStats()
+        self._executor = None
+        self._queue = None
+        self._slots = None
+        self._batcher = None
+        self._collecting = None
+        self._running = set()
+        
+    async def start(self):
+        """Starts the workers, which load their Pipelines, and the batching"""
+        loop = asyncio.get_running_loop()
+        initargs = (self.ruleset_names, self.compiled, self.vectorized)
+        if self.workers:
+            context = preload(_init_worker, initargs)
+            self._executor = ProcessPoolExecutor(
+                self.workers, mp_context=context, initializer=_init_worker, initargs=initargs
+            )
+        else:
+            self._executor = ThreadPoolExecutor(1, initializer=_init_worker, initargs=initargs)
+        # an empty batch per worker, so that loading doesn't delay the first requests
+        await asyncio.gather(*[
+            loop.run_in_executor(self._executor, _transcribe_batch, [])
+            for k in range(max(self.workers, 1))
+        ])
+        # the workers are started (see batch.preload)
+        gc.unfreeze()
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max(self.workers, 1))
+        self._batcher = asyncio.ensure_future(self._run_batches())
+        
+    async def close(self):
+        """
+        Stops the batching and the workers. The batches already sent to a
+        worker are finished; every other request is answered with a "server
+        closing" error.
+        """
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+            waiting = self._collecting or []
+            self._collecting = None
+            while not self._queue.empty():
+                waiting.append(self._queue.get_nowait())
+            for name, text, future in waiting:
+                if not future.done():
+                    future.set_result(_CLOSING)
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+        if self._executor is not None:
+            executor = self._executor
+            self._executor = None
+            # waits for the workers to exit, so not on the event loop
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+            
+    async def __aenter__(self):
+        await self.start()
+        return self
+        
+    async def __aexit__(self, *exc_info):
+        await self.close()
+        
+    async def transcribe(self, text, ruleset=None):
+        """
+        Returns {"broad": str, "narrow": str, "error": str, "oov": list} for
+        text with ruleset (a name or abbreviation, the first ruleset if None).
+        error is None unless it failed (see batch.transcribe_text).
+        """
+        start = time.perf_counter()
+        name = self.ruleset_names[0] if ruleset is None else DEFAULT_RULESETS.get(ruleset, ruleset)
+        if self._batcher is None:
+            result = _CLOSING
+        elif name in self.ruleset_names:
+            future = asyncio.get_running_loop().create_future()
+            self._queue.put_nowait((name, text, future))
+            result = await future
+        else:
+            result = None, None, "ValueError: Ruleset '{}' is not served".format(ruleset), []
+        self.stats.add(time.perf_counter() - start)
+        return dict(zip(("broad", "narrow", "error", "oov"), result))
+        
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        while True:
+            batch = self._collecting = [await queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            # requests that came in while every worker was busy join the batch
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            self.stats.add_batch(len(batch))
+            work = loop.run_in_executor(
+                self._executor, _transcribe_batch, [(name, text) for name, text, future in batch]
+            )
+            self._collecting = None
+            work.add_done_callback(partial(self._finish_batch, batch))
+            self._running.add(work)
+            work.add_done_callback(self._running.discard)
+            
+    def _finish_batch(self, batch, work):
+        self._slots.release()
+        if work.cancelled():
+            results = [_CLOSING] * len(batch)
+        elif work.exception() is not None:
+            results = [(None, None, _error(work.exception()), [])] * len(batch)
+        else:
+            results = work.result()
+        for (name, text, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    async def respond(self, line):
+        """Returns the response (a dict) to one request line"""
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request is not a JSON object")
+        except ValueError as e:
+            return {"id": None, "error": _error(e)}
+        response = {"id": request.get("id")}
+        if request.get("stats"):
+            response["stats"] = self.stats.summary()
+            return response
+        text = request.get("text")
+        if not isinstance(text, str):
+            response["error"] = "ValueError: request has no \"text\" string"
+            return response
+        response.update(await self.transcribe(text, request.get("ruleset")))
+        return response
+        
+    async def _answer(self, line, writer):
+        response = await self.respond(line)
+        writer.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+            
+    async def handle(self, reader, writer):
+        """Answers the requests of one connection, until the client closes it"""
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, ConnectionError):
+                    # a line over MAX_LINE, or the client went away
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.ensure_future(self._answer(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+    
+    async def serve(self, socket_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT, ready=None):
+        """
+        Serves on the Unix socket socket_path, or else on host:port, until
+        cancelled. ready() is called once the server accepts connections.
+        """
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle, socket_path, limit=MAX_LINE)
+        else:
+            server = await asyncio.start_server(self.handle, host, port, limit=MAX_LINE)
+        async with server:
+            if ready is not None:
+                ready()
+            await server.serve_forever()
+
+
+class Client:
+    """
+    Client of a TranscriptionServer. Requests may be made concurrently over
+    the one connection: each waits only for its own response.
+    """
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._pending = {}
+        self._next_id = 0
+        self._receiver = asyncio.ensure_future(self._receive())
+        
+    @classmethod
+    async def connect(cls, socket_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """Returns a Client connected to the Unix socket socket_path, or else to host:port"""
+        if socket_path:
+            reader, writer = await asyncio.open_unix_connection(socket_path, limit=MAX_LINE)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=MAX_LINE)
+        return cls(reader, writer)
+        
+    async def request(self, request):
+        """Sends request (a dict, to which it adds an id) and returns the response"""
+        if self._receiver.done():
+            raise ConnectionError("Connection to the server is closed")
+        self._next_id += 1
+        request = dict(request, id=self._next_id)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request["id"]] = future
+        self._writer.write(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        await self._writer.drain()
+        return await future
+        
+    async def transcribe(self, text, ruleset=None):
+        """Returns the response to text: a dict with "broad", "narrow", "error" and "oov" """
+        request = {"text": text}
+        if ruleset is not None:
+            request["ruleset"] = ruleset
+        return await self.request(request)
+        
+    async def stats(self):
+        """Returns the stats of the server (see LatencyStats.summary)"""
+        return (await self.request({"stats": True}))["stats"]
+        
+    async def _receive(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._pending.pop(response.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to the server closed"))
+            self._pending.clear()
+            
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+        self._receiver.cancel()
+        try:
+            await self._receiver
+        except asyncio.CancelledError:
+            pass
+
+
+async def run_client(filenames, ruleset=None, output=None, fmt="tsv", concurrency=DEFAULT_CONCURRENCY,
+        socket_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Transcribes the lines of filenames (see batch.read_lines) with a running
+    server, keeping up to concurrency requests in flight, and writes the
+    results in input order to output (see batch.write_results). Prints the
+    client's and the server's latency stats to stderr afterwards.
+    """
+    client = await Client.connect(socket_path, host, port)
+    stats = LatencyStats()
+    
+    async def transcribe(text):
+        start = time.perf_counter()
+        response = await client.transcribe(text, ruleset)
+        stats.add(time.perf_counter() - start)
+        return text, response.get("broad"), response.get("narrow"), response.get("error"), response.get("oov", [])
+        
+    out = sys.stdout if output is None or output == "-" else open(output, "w", encoding="utf-8", newline="")
+    try:
+        pending = deque()
+        n = 0
+        for line in read_lines(filenames or ["-"]):
+            pending.append(asyncio.ensure_future(transcribe(line.rstrip("\r\n"))))
+            if len(pending) >= concurrency:
+                n += 1
+                write_results([await pending.popleft()], out, fmt=fmt, first_line=n)
+        while pending:
+            n += 1
+            write_results([await pending.popleft()], out, fmt=fmt, first_line=n)
+        print("client: " + stats.format(), file=sys.stderr)
+        print("server: " + json.dumps(await client.stats()), file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        await client.close()
+
+
+async def run_server(server, socket_path=None, host=DEFAULT_HOST, port=DEFAULT_PORT, stats_interval=None):
+    """Starts server and serves until cancelled, printing its stats every stats_interval seconds"""
+    async with server:
+        where = socket_path or "{}:{}".format(host, port)
+        ready = lambda: print("Serving {} on {}".format(", ".join(server.ruleset_names), where), file=sys.stderr)
+        serving = asyncio.ensure_future(server.serve(socket_path, host, port, ready=ready))
+        try:
+            printed = 0
+            while stats_interval and not serving.done():
+                await asyncio.sleep(stats_interval)
+                if server.stats.count != printed:
+                    printed = server.stats.count
+                    print(server.stats.format(), file=sys.stderr)
+            await serving
+        finally:
+            serving.cancel()
+            print(server.stats.format(), file=sys.stderr)
+
+
+def read_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve transcriptions as newline-delimited JSON")
+    parser.add_argument("-r", "--ruleset", action="append", default=[],
+        help="ruleset to serve (can be repeated; the first is the default), or with --client, to request. "
+            "Serves {} by default".format(", ".join(DEFAULT_RULESETS)))
+    parser.add_argument("--socket", metavar="PATH", help="Unix socket to listen on (default: TCP on --host:--port)")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-j", "--workers", type=int, default=None,
+        help="worker processes (default: number of CPUs; 0 runs batches in a thread)")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH, help="most requests in a batch")
+    parser.add_argument("--max-delay", type=float, default=DEFAULT_MAX_DELAY * 1000, metavar="MS",
+        help="most milliseconds a request waits for others to join its batch")
+    parser.add_argument("-c", "--compiled", action="store_true", help="apply the rulesets with the compiled engine")
+    parser.add_argument("--vectorized", action="store_true", help="apply the rulesets with the whole-context engine")
+    parser.add_argument("--stats-interval", type=float, default=None, metavar="SECONDS",
+        help="print the latency stats every SECONDS")
+    parser.add_argument("--client", action="store_true",
+        help="transcribe lines with a running server instead of serving")
+    parser.add_argument("-i", "--input", action="append", default=[], metavar="FILE",
+        help="with --client, file to transcribe (\"-\" for stdin, the default). Can be repeated")
+    parser.add_argument("-o", "--output", metavar="FILE", help="with --client, output file (default stdout)")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="tsv", help="with --client, output format")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+        help="with --client, most requests in flight")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = read_args()
+    if args.client:
+        coroutine = run_client(
+            args.input, ruleset=args.ruleset[0] if args.ruleset else None, output=args.output,
+            fmt=args.format, concurrency=args.concurrency, socket_path=args.socket, host=args.host,
+            port=args.port
+        )
+    else:
+        server = TranscriptionServer(
+            args.ruleset or list(DEFAULT_RULESETS), workers=args.workers, max_batch=args.max_batch,
+            max_delay=args.max_delay / 1000, compiled=args.compiled, vectorized=args.vectorized
+        )
+        coroutine = run_server(server, args.socket, args.host, args.port, args.stats_interval)
+    try:
+        asyncio.run(coroutine)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
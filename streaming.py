@@ -0,0 +1,201 @@
+"""
+Streaming engine for rulesets.
+
+Rule.apply reads a whole context and makes a whole new one, so an utterance
+is copied once per Rule. Here, the Rules form a chain of generators instead,
+each taking the symbols of the one before it as they come and holding only
+a window of them:
+  - a Rule whose environments are of fixed width runs as a RuleTransducer
+    (see transducer.py), whose window spans its reach: as many Segments to
+    the left and to the right of a position as its environments can consume
+  - any other Rule runs as a StreamRule, which matches the Rule with its
+    Matchers on a window that reads as endless until the stream is over.
+    When a Matcher reads past what the window holds, more of the stream is
+    read and the position is matched again, so the window only grows as far
+    as matching actually looks ahead. Behind a position, it keeps as much as
+    the reach of the left environment.
+
+Memory is thus bounded by the windows, not by the length of the input,
+except for Rules with a zero-plus node in their left environment, which may
+look back to the start of the input and so keep all of it. The result is the
+same as applying every Rule with Rule.apply in turn.
+"""
+
+import sys
+from transducer import RuleTransducer, is_compilable, _reach
+from rules import apply_rules
+from init import *
+
+
+# Symbols that may be dropped from the start of a window at once
+_TRIM = 64
+
+
+class _NeedMore(Exception):
+    """Raised when a _Window is read past the symbols it holds"""
+
+
+class _Window:
+    """
+    The symbols of a stream held by a StreamRule, as a context for Matchers.
+    Until the stream is over, its length is unknown: it reads as endless, and
+    reading past the symbols it holds raises _NeedMore.
+    
+    Attributes
+    ------------------------
+    symbols: list of Segment/boundaries
+    done: bool
+        True once the stream is over, so that symbols is all there is
+    """
+    __slots__ = ("symbols", "done")
+    def __init__(self):
+        self.symbols = []
+        self.done = False
+        
+    def __len__(self):
+        return len(self.symbols) if self.done else sys.maxsize
+        
+    def __getitem__(self, i):
+        # Matchers check bounds before reading, so i is never negative
+        try:
+            return self.symbols[i]
+        except IndexError:
+            if self.done:
+                raise
+            raise _NeedMore
+            
+    def read(self, stream, count):
+        """Reads up to count more symbols from the iterator stream"""
+        for k in range(count):
+            try:
+                self.symbols.append(next(stream))
+            except StopIteration:
+                self.done = True
+                return
+
+
+class StreamRule:
+    """
+    Applies a Rule to a stream of symbols, with its Matchers, as Rule.apply
+    does to a context
+    
+    Attributes
+    ------------------------
+    rule: Rule
+    left_reach: int or None
+        Most Segments the left environment can consume, None if it is
+        unbounded (the whole stream is then kept) or there is none
+    """
+    def __init__(self, rule):
+        self.rule = rule
+        self.left_reach = _reach(rule.left_environment) if rule.left_environment else None
+        
+    def _keep(self, symbols, i):
+        """Returns the index of the first of symbols that matching at i or after may read"""
+        if not self.rule.left_environment:
+            return i
+        if self.left_reach is None:
+            return 0
+        # the Segments the left environment can consume, and the one before them
+        count = self.left_reach + 1
+        k = i
+        while count and k > 0:
+            k -= 1
+            if symbols[k] not in BOUNDARIES:
+                count -= 1
+        return k
+        
+    def run(self, symbols):
+        """Generator over the result of applying the Rule to the iterable symbols"""
+        rule = self.rule
+        core = rule.core
+        crosses_boundaries = core.crosses_boundaries
+        core_matcher = core.matcher()
+        left_matcher = rule.left_environment.matcher(reverse=True) if rule.left_environment else None
+        right_matcher = rule.right_environment.matcher() if rule.right_environment else None
+        
+        stream = iter(symbols)
+        window = _Window()
+        held = window.symbols
+        i = 0
+        while True:
+            try:
+                if i >= len(window):
+                    return
+                symbol = window[i]
+                if crosses_boundaries and symbol in BOUNDARIES:
+                    matches = False
+                elif not rule.can_start(window, i):
+                    matches = False
+                else:
+                    core_match = core_matcher.match(window, i)
+                    matches = bool(core_match)
+                    if matches and left_matcher is not None:
+                        matches = bool(left_matcher.match(window, i - 1))
+                    if matches and right_matcher is not None:
+                        matches = bool(right_matcher.match(window, core_match.range[1]))
+            except _NeedMore:
+                # read as much again as is held ahead of i, and match i again
+                window.read(stream, max(len(held) - i, 1))
+                continue
+                
+            if matches:
+                for new_symbol in rule.transformation.apply(core_match, core):
+                    if new_symbol != NULL:
+                        yield new_symbol
+                if core_match.range[1] == core_match.range[0]:
+                    yield symbol
+                    i = core_match.range[1] + 1
+                else:
+                    i = core_match.range[1]
+            else:
+                yield symbol
+                i += 1
+                
+            # forget what no match will read again, every _TRIM symbols or so
+            if i >= 2 * _TRIM:
+                keep = self._keep(held, i)
+                if keep >= _TRIM:
+                    del held[:keep]
+                    i -= keep
+    
+    def apply(self, context):
+        return list(self.run(context))
+
+
+class StreamingRuleset:
+    """
+    Applies a list of Rules as a chain of generators.
+    
+    Attributes
+    ------------------------
+    rules: list of Rule
+    stages: list of RuleTransducer or StreamRule
+        One per Rule: a RuleTransducer for every compilable Rule (see
+        transducer.py), otherwise a StreamRule
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.stages = [
+            RuleTransducer(rule) if is_compilable(rule) else StreamRule(rule)
+            for rule in rules
+        ]
+        
+    def run(self, symbols, start=0, stop=None):
+        """
+        Returns an iterator over the result of applying rules[start:stop] to
+        the iterable symbols, reading them as it goes (all of them first, if
+        the interpreter has to be used: see rules.apply_rules)
+        """
+        return iter(apply_rules(
+            self.rules[start:stop], symbols, lambda symbols: self._chain(symbols, start, stop)
+        ))
+        
+    def _chain(self, symbols, start, stop):
+        stream = iter(symbols)
+        for stage in self.stages[start:stop]:
+            stream = stage.run(stream)
+        return stream
+        
+    def apply(self, segments, start=0, stop=None):
+        return list(self.run(segments, start, stop))
@@ -0,0 +1,336 @@
+"""
+Tests that every engine transcribes as the interpreter does, that the
+tokenizer doesn't depend on how the text is cut into chunks, and that the
+server answers as batch.transcribe_text does.
+
+    $ python -m pytest -q test_pipeline.py
+    $ python -m unittest test_pipeline
+
+The corpus is the fixed sample of dictionary words and sentences of
+benchmark.py. Each transcription is compared with applying every Rule of the
+ruleset with Rule.apply in turn; an error is compared by its type.
+"""
+
+import asyncio
+import os
+import unittest
+from init import *
+
+
+RULESETS = ("standard-american-english", "received-pronunciation", "australian-english")
+
+WORDS = 200
+SENTENCE_LENGTHS = (8, 32, 256)
+SENTENCES = 10
+
+# Chunk sizes the tokenizer is given a text in
+CHUNK_SIZES = (1, 2, 3, 7, 64)
+
+TEXT = (
+    "Mr. Smith's 3-D rock'n'roll show,  on 21st  May, drew 1,250.5 fans -- "
+    "(the boys' “favourite”!) well-known  zzqx\tand\n"
+    "don’t forget: 007, 2nd, 3rd...  the end"
+)
+
+# A ruleset of word-local rules only, so that the word cache and the narrow
+# table apply to sentences too
+WORD_LOCAL_RULESET = """\
+"rhotic diphthongization"
+[i][r]:b -> [ɪ][ə]
+[ʊ][r]:b -> [ʊ][ə]
+"non-rhoticity"
+[r] -> Ø / [+syl]:b _
+[ɚ] -> [ə]
+"stopping of ð"
+[ð] -> [d̪]
+"""
+
+
+def setUpModule():
+    # ruleset paths are relative to the package
+    global _cwd
+    _cwd = os.getcwd()
+    os.chdir(DIR)
+
+
+def tearDownModule():
+    os.chdir(_cwd)
+
+
+def _outcome(fn, *args):
+    """Returns fn(*args), or the name of the type of the exception it raises"""
+    try:
+        return fn(*args)
+    except Exception as e:
+        return type(e).__name__
+
+
+def _interpret(pipeline, broad_ipa):
+    segments = pipeline.ic.to_segments(broad_ipa)
+    for rule in pipeline.rules:
+        segments = rule.apply(segments)
+    return pipeline.icf.to_ipa(segments)
+
+
+def _corpus():
+    from benchmark import sample_words, sample_sentences
+    words = sample_words()
+    inputs = words[:WORDS]
+    for length in SENTENCE_LENGTHS:
+        inputs += sample_sentences(words, length)[:SENTENCES]
+    return inputs
+
+
+class EngineTest(unittest.TestCase):
+    rulesets = RULESETS
+    
+    @classmethod
+    def setUpClass(cls):
+        from pipeline import Pipeline
+        cls.inputs = _corpus()
+        cls.expected = {}
+        for name in cls.rulesets:
+            pipeline = Pipeline(name, word_cache_size=0, use_table=False)
+            for text in cls.inputs:
+                broad_ipa = pipeline.to_broad(text)
+                cls.expected[name, text] = broad_ipa, _outcome(_interpret, pipeline, broad_ipa)
+                
+    def check(self, name, transcribe, inputs=None):
+        """Checks transcribe(text) (the narrow IPA) for the inputs, all of the corpus if None"""
+        for text in self.inputs if inputs is None else inputs:
+            with self.subTest(ruleset=name, text=text):
+                self.assertEqual(_outcome(transcribe, text), self.expected[name, text][1])
+                
+    def check_engine(self, **kwargs):
+        from pipeline import Pipeline
+        for name in self.rulesets:
+            pipeline = Pipeline(name, use_table=False, **kwargs)
+            self.check(name, lambda text: pipeline.to_narrow(pipeline.to_broad(text)))
+            
+    def test_default(self):
+        self.check_engine()
+        
+    def test_compiled(self):
+        self.check_engine(compiled=True)
+        
+    def test_vectorized(self):
+        self.check_engine(vectorized=True)
+        
+    def test_streaming(self):
+        from pipeline import Pipeline
+        for name in self.rulesets:
+            pipeline = Pipeline(name, use_table=False)
+            self.check(name, lambda text: "".join(pipeline.transcribe_stream([text])))
+            self.check(name, lambda text: "".join(pipeline.transcribe_stream(text)))
+            
+    def test_defaults(self):
+        # the word cache (each text twice, the second time from it), and the
+        # narrow table where one is built
+        from pipeline import Pipeline
+        for name in self.rulesets:
+            pipeline = Pipeline(name)
+            self.check(name, lambda text: pipeline.transcribe(text)[1])
+            self.check(name, lambda text: pipeline.transcribe(text)[1])
+            
+    def test_narrow_table(self):
+        from pipeline import Pipeline
+        words = [text for text in self.inputs if " " not in text]
+        for name in self.rulesets:
+            pipeline = Pipeline(name)
+            if pipeline.narrow_table is None:
+                self.skipTest("No narrow table for {} (see pyphone.py --build-table)".format(name))
+            self.check(name, lambda text: pipeline.transcribe(text)[1], words)
+            
+    def test_multi_pipeline(self):
+        from pipeline import MultiPipeline
+        multi = MultiPipeline(self.rulesets, use_table=False)
+        results = {text: multi.transcribe(text) for text in self.inputs}
+        for name in self.rulesets:
+            for text in self.inputs:
+                broad_ipa, narrow_ipa, error = results[text][name]
+                with self.subTest(ruleset=name, text=text):
+                    self.assertEqual(broad_ipa, self.expected[name, text][0])
+                    self.assertEqual(narrow_ipa or error.split(":")[0], self.expected[name, text][1])
+
+
+class WordLocalTest(EngineTest):
+    """
+    The same checks with WORD_LOCAL_RULESET, in a directory and cache of its
+    own. Its narrow table is built for the words of the corpus only.
+    """
+    rulesets = ("word-local",)
+    
+    @classmethod
+    def setUpClass(cls):
+        import tempfile
+        from unittest import mock
+        # the modules and the corpus are loaded before leaving the package
+        # directory, which is on sys.path as "" with python -m unittest
+        import cache
+        import pipeline
+        from narrowtable import build_table
+        from textparser import TextParser
+        words = sorted({word.upper() for text in _corpus() for word in text.split()})
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(cls.tmp.name, "rulesets"))
+        with open(os.path.join(cls.tmp.name, "rulesets", "word-local.txt"), "w", encoding="utf-8") as f:
+            f.write(WORD_LOCAL_RULESET)
+        cls.cache_dir = mock.patch.object(cache, "CACHE_DIR", os.path.join(cls.tmp.name, "cache"))
+        cls.cache_dir.start()
+        os.chdir(cls.tmp.name)
+        with mock.patch.object(TextParser, "words", lambda self: iter(words)):
+            build_table("word-local", workers=1)
+        super().setUpClass()
+        
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(DIR)
+        cls.cache_dir.stop()
+        cls.tmp.cleanup()
+        
+    def test_table_built(self):
+        from pipeline import Pipeline
+        pipeline = Pipeline("word-local")
+        self.assertTrue(pipeline.word_local)
+        self.assertIsNotNone(pipeline.narrow_table)
+
+
+class TokenizeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from textparser import TextParser
+        cls.tp = TextParser("english")
+        
+    def tokens(self, chunks):
+        return [(t.text, t.start, t.end, t.word, t.ipa) for t in self.tp.tokenize(chunks)]
+        
+    def test_chunk_invariance(self):
+        from benchmark import sample_words, sample_sentences
+        texts = [TEXT, " " + TEXT + " ", "", "   "] + sample_sentences(sample_words(), 32)[:SENTENCES]
+        for text in texts:
+            expected = self.tokens([text])
+            for size in CHUNK_SIZES:
+                with self.subTest(text=text, size=size):
+                    chunks = [text[k:k + size] for k in range(0, len(text), size)]
+                    self.assertEqual(self.tokens(chunks), expected)
+                    
+    def test_long_run(self):
+        from textparser import MAX_RUN
+        pieces = ["(Mr.)", "rock'n'roll-", "1,250.5", "boys'", "cat/"]
+        run = "".join(pieces[k % len(pieces)] for k in range(3 * MAX_RUN // 6))
+        # and a run that no character of could be cut after
+        text = "the " + run + " and " + "ab" * MAX_RUN + " end"
+        expected = self.tokens([text])
+        for size in (1000, 4099, MAX_RUN + 1):
+            with self.subTest(size=size):
+                chunks = [text[k:k + size] for k in range(0, len(text), size)]
+                self.assertEqual(self.tokens(chunks), expected)
+                
+    def test_spans(self):
+        for text, start, end, word, ipa in self.tokens([TEXT]):
+            self.assertEqual(TEXT[start:end], text)
+            
+    def test_oov(self):
+        from batch import transcribe_text
+        from pipeline import Pipeline
+        oov = []
+        broad_ipa = self.tp.to_ipa("the zzqx cat", oov)
+        self.assertEqual(oov, ["zzqx"])
+        self.assertEqual(broad_ipa, self.tp.to_ipa("the cat"))
+        pipeline = Pipeline("received-pronunciation", use_table=False)
+        self.assertEqual(transcribe_text(pipeline, "zzqx")[2:], (None, ["zzqx"]))
+        
+    def test_document(self):
+        from batch import transcribe_document
+        from pipeline import MultiPipeline
+        multi = MultiPipeline(RULESETS[1:], use_table=False)
+        for pipeline in [multi.pipelines[RULESETS[1]], multi]:
+            for token, broad_ipa, narrow_ipa, error in transcribe_document(pipeline, [TEXT, TEXT]):
+                with self.subTest(token=token):
+                    self.assertEqual(broad_ipa, token.ipa)
+                    if token.oov:
+                        continue
+                    for name in RULESETS[1:]:
+                        expected = _interpret(multi.pipelines[name], token.ipa)
+                        if pipeline is multi:
+                            self.assertEqual(narrow_ipa[name], expected)
+                        elif name == pipeline.ruleset_name:
+                            self.assertEqual(narrow_ipa, expected)
+
+
+class ServerTest(unittest.TestCase):
+    def test_server(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(self.check_server(os.path.join(tmp, "pyphone.sock")))
+            
+    async def check_server(self, socket_path):
+        from batch import transcribe_text
+        from pipeline import Pipeline
+        from server import Client, TranscriptionServer
+        pipeline = Pipeline(RULESETS[1])
+        texts = _corpus()[:WORDS:4] + [TEXT, "the zzqx cat", ""]
+        server = TranscriptionServer(["rp"], workers=0)
+        await server.start()
+        ready = asyncio.Event()
+        serving = asyncio.ensure_future(server.serve(socket_path, ready=ready.set))
+        client = None
+        try:
+            await asyncio.wait_for(ready.wait(), 10)
+            client = await Client.connect(socket_path)
+            responses = await asyncio.gather(*[client.transcribe(text) for text in texts])
+            for k, (text, response) in enumerate(zip(texts, responses)):
+                with self.subTest(text=text):
+                    expected = dict(zip(("broad", "narrow", "error", "oov"), transcribe_text(pipeline, text)))
+                    self.assertEqual(response, dict(expected, id=k + 1))
+            self.assertEqual(responses[-2]["oov"], ["zzqx"])
+            
+            response = await server.respond('{"id": ["x", 7], "text": "cat", "ruleset": "sae"}')
+            self.assertEqual(response, {
+                "id": ["x", 7], "broad": None, "narrow": None,
+                "error": "ValueError: Ruleset 'sae' is not served", "oov": [],
+            })
+            
+            stats = await client.stats()
+            self.assertEqual(stats["requests"], len(texts) + 1)
+            self.assertEqual(stats["batches"], server.stats.batches)
+            self.assertEqual(server.stats.batched, len(texts))
+            self.assertIn("p50", stats["latency_ms"])
+            
+            await server.close()
+            closing = {"broad": None, "narrow": None, "error": "CancelledError: server closing", "oov": []}
+            self.assertEqual(await server.transcribe("cat"), closing)
+            self.assertEqual(await client.transcribe("cat"), dict(closing, id=len(texts) + 2))
+        finally:
+            if client is not None:
+                await client.close()
+            serving.cancel()
+            try:
+                await serving
+            except asyncio.CancelledError:
+                pass
+            await server.close()
+
+
+class BinaryDictionaryTest(unittest.TestCase):
+    def test_truncated(self):
+        import tempfile
+        from dictionary import BinaryDictionary, build_binary_dictionary
+        text_filename = os.path.join(DATA_DIR, "dict-english.txt")
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "dict.bin")
+            self.assertTrue(build_binary_dictionary(text_filename, filename))
+            with open(filename, "rb") as f:
+                data = f.read()
+            for size in (0, 12, 40, 1000, len(data) - 1):
+                with self.subTest(size=size):
+                    with open(filename, "wb") as f:
+                        f.write(data[:size])
+                    d = BinaryDictionary.open(text_filename, filename)
+                    self.assertEqual(os.path.getsize(filename), len(data))
+                    self.assertEqual(len(d), len(list(d)))
+                    d.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,9 +4,163 @@ try:
 except ImportError:
     import re
 from ipaconverter import IpaConverter
+from dictionary import BinaryDictionary, read_text_dictionary
+from cache import cache_path
 from init import *
 
 
+# Characters read from a file at a time by read_chunks
+CHUNK_SIZE = 1 << 16
+
+# Longest run of non-space characters kept whole by TextParser.tokenize: a
+# longer one is cut (see _cut_run), so that memory stays bounded whatever the
+# text
+MAX_RUN = 1 << 16
+
+# A run of non-space characters, looked up whole before being split into tokens
+_RUN = re.compile(r"\S+")
+
+# The last space of a string, and the non-space characters after it
+_LAST_SPACE = re.compile(r"\s(?=\S*\Z)")
+
+# A character that no word or number can contain
+_BREAK = re.compile(r"[^\w'’.,\-]|_")
+
+# A number (with thousands separators, decimals and an ordinal suffix), or a
+# word: letters and digits, joined by apostrophes, hyphens or dots, and
+# ending with the apostrophe of a plural possessive
+_TOKEN = re.compile(r"""
+    (?P<number> (?:\d{1,3}(?:,\d{3})+|\d+) (?:\.\d+)? (?:st|nd|rd|th)? ) (?![^\W_])
+    | (?P<word> [^\W_]+ (?:['’.\-][^\W_]+)* (?:(?<=[sS])['’])? )
+""", re.VERBOSE | re.IGNORECASE)
+
+_NUMBER = re.compile(r"(\d{1,3}(?:,\d{3})+|\d+)(?:\.(\d+))?(ST|ND|RD|TH)?")
+
+# Separators of the parts of a compound word, looked up one by one
+_PARTS = re.compile(r"[\-.]")
+
+_ONES = (
+    "ZERO ONE TWO THREE FOUR FIVE SIX SEVEN EIGHT NINE TEN ELEVEN TWELVE THIRTEEN "
+    "FOURTEEN FIFTEEN SIXTEEN SEVENTEEN EIGHTEEN NINETEEN"
+).split()
+_TENS = "_ _ TWENTY THIRTY FORTY FIFTY SIXTY SEVENTY EIGHTY NINETY".split()
+_SCALES = ((10 ** 12, "TRILLION"), (10 ** 9, "BILLION"), (10 ** 6, "MILLION"), (10 ** 3, "THOUSAND"))
+
+# Largest number read as a whole, not digit by digit
+MAX_NUMBER = 10 ** 15 - 1
+
+_ORDINALS = {
+    "ONE": "FIRST", "TWO": "SECOND", "THREE": "THIRD", "FIVE": "FIFTH",
+    "EIGHT": "EIGHTH", "NINE": "NINTH", "TWELVE": "TWELFTH",
+}
+
+
+def read_chunks(f, size=CHUNK_SIZE):
+    """Generator (str) over the text of the file object f, size characters at a time"""
+    return iter(lambda: f.read(size), "")
+
+
+def _cut_run(run):
+    """
+    Returns where to cut run, a run of non-space characters longer than
+    MAX_RUN: after the last character of its first MAX_RUN that no word or
+    number can contain, or at MAX_RUN if there is none. It only depends on
+    the start of run, so a run is cut in the same places however it is read.
+    """
+    for k in range(MAX_RUN, 0, -1):
+        if _BREAK.match(run, k - 1):
+            return k
+    return MAX_RUN
+
+
+def _below_thousand(n):
+    words = []
+    if n >= 100:
+        words += [_ONES[n // 100], "HUNDRED"]
+        n %= 100
+    if n >= 20:
+        words.append(_TENS[n // 10])
+        n %= 10
+        if n:
+            words.append(_ONES[n])
+    elif n or not words:
+        words.append(_ONES[n])
+    return words
+
+
+def number_words(digits, decimals="", ordinal=False):
+    """
+    Returns the (upper case) English words of a number, eg ["TWO", "HUNDRED",
+    "FIFTY", "POINT", "FIVE"] for number_words("250", "5").
+    
+    digits: str
+        The integer part. It is read digit by digit if it has a leading zero
+        or is above MAX_NUMBER.
+    decimals: str
+        Digits after the decimal point, read one by one
+    ordinal: bool
+        Ends with an ordinal ("TWENTY FIRST") instead of a cardinal
+    """
+    n = int(digits)
+    if (len(digits) > 1 and digits[0] == "0") or n > MAX_NUMBER:
+        words = [_ONES[int(d)] for d in digits]
+    else:
+        words = []
+        for scale, name in _SCALES:
+            if n >= scale:
+                words += _below_thousand(n // scale) + [name]
+                n %= scale
+        if n or not words:
+            words += _below_thousand(n)
+    if decimals:
+        words.append("POINT")
+        words += [_ONES[int(d)] for d in decimals]
+    elif ordinal:
+        last = words[-1]
+        if last in _ORDINALS:
+            words[-1] = _ORDINALS[last]
+        elif last.endswith("Y"):
+            words[-1] = last[:-1] + "IETH"
+        else:
+            words[-1] = last + "TH"
+    return words
+
+
+class Token:
+    """
+    A word of a text (see TextParser.tokenize)
+    
+    Attributes
+    ------------------------
+    text: str
+        The word as it is in the text
+    start, end: int
+        Span of text, as character offsets from the start of the text
+    word: str
+        Normalized form of text, as it is looked up in the dictionary: upper
+        case, with straight apostrophes
+    ipa: str or None
+        Broad IPA of the word, None if it is out of the dictionary. Numbers
+        and compounds whose parts are looked up one by one may be several
+        words, separated by spaces.
+    """
+    __slots__ = ("text", "start", "end", "word", "ipa")
+    def __init__(self, text, start, end, word, ipa):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.word = word
+        self.ipa = ipa
+        
+    @property
+    def oov(self):
+        """True if the word is out of the dictionary"""
+        return self.ipa is None
+        
+    def __repr__(self):
+        return "Token({!r}, {}, {}, {!r})".format(self.text, self.start, self.end, self.ipa)
+
+
 class TextParser:
     """
     Converts orthographic text to IPA strings
@@ -14,35 +168,146 @@ class TextParser:
     def __init__(self, name, ipa_converter=None):
         self.name = name
         self.ipa_converter = ipa_converter if ipa_converter else IpaConverter.default
+        self.filename = os.path.join(DATA_DIR, "dict-" + self.name + ".txt")
         self._d = self.load_dictionary()
         
     def load_dictionary(self):
         """
-        Loads phonetic dictionary of words
-        """
-        d = {}
-        filename = "dict-" + self.name + ".txt"
-        filename = os.path.join(DATA_DIR, filename)
-        
-        with open(filename, "r", encoding="utf-8") as f:
-            for line in f:
-                if line[0] == "#":
-                    continue
-                line = line.strip()
-                word, p = line.split("  ")
-                p = p.replace("g", "ɡ")
-                
-                d[word] = p
+        Loads phonetic dictionary of words. The binary form of the dictionary
+        (see dictionary.py) is used, and rebuilt if the text file is newer.
+        If it can't be built, the text file is read into a dict instead.
+        """
+        d = BinaryDictionary.open(self.filename, cache_path("dict-" + self.name + ".bin"))
+        if d is None:
+            d = read_text_dictionary(self.filename)
         return d
-                
-    def to_ipa(self, text):
+        
+    def words(self):
+        """Returns an iterator over the (upper case) words in the dictionary"""
+        return iter(self._d)
+        
+    def to_ipa(self, text, oov=None):
+        """
+        Returns the broad IPA of text, its words separated by spaces. Words
+        out of the dictionary are left out, and added to the list oov if it
+        is given.
+        """
         li = []
-        for word in self.word_tokenize(text):
-            ipa = self._d.get(word.upper())
-            if ipa:
-                li.append(ipa)
+        for token in self.tokenize([text]):
+            if token.ipa is not None:
+                li.append(token.ipa)
+            elif oov is not None:
+                oov.append(token.text)
         return " ".join(li)
         
     def word_tokenize(self, text):
-        for word in re.split(r"\s+", text):
-            yield word
+        """Generator (str) over the normalized words of text (see Token.word)"""
+        for token in self.tokenize([text]):
+            yield token.word
+            
+    @staticmethod
+    def normalize(word):
+        return word.replace("’", "'").upper()
+        
+    def lookup(self, word):
+        """
+        Returns the broad IPA of a normalized word, or None if it is out of
+        the dictionary. A word that isn't in the dictionary as it is may
+        still be a number, which is spelled out, a plural possessive, or a
+        compound whose parts are.
+        """
+        ipa = self._d.get(word)
+        if ipa:
+            return ipa
+        match = _NUMBER.fullmatch(word)
+        if match:
+            digits, decimals, suffix = match.groups()
+            return self._lookup_all(number_words(digits.replace(",", ""), decimals or "", suffix is not None))
+        if word.endswith("'"):
+            return self.lookup(word[:-1])
+        parts = _PARTS.split(word)
+        if len(parts) > 1 and all(parts):
+            return self._lookup_all(parts)
+        return None
+        
+    def _lookup_all(self, words):
+        """Returns the broad IPA of each of words, joined by spaces, or None if any is out of the dictionary"""
+        li = []
+        for word in words:
+            ipa = self.lookup(word)
+            if ipa is None:
+                return None
+            li.append(ipa)
+        return " ".join(li)
+        
+    def tokenize(self, chunks):
+        """
+        Generator (Token) over the words of a text, given as an iterable of
+        str chunks of it (eg read_chunks(f) for a file), in order.
+
+        Each run of non-space characters is looked up whole first, so that
+        dictionary words with punctuation ("MR.", "ROCK'N'ROLL", "3-D") are
+        kept. Otherwise the numbers and words in it are each a Token, and
+        the punctuation around them is left out. A run longer than MAX_RUN
+        is cut into pieces (see _cut_run), which aren't looked up whole. Only
+        the current chunk and the run at its end are held at a time, so
+        memory doesn't grow with the text, and the Tokens are the same
+        whatever the chunks are.
+        """
+        pending = ""
+        offset = 0
+        # pending starts with a piece of a run longer than MAX_RUN
+        continued = False
+        for chunk in chunks:
+            pending += chunk
+            # the run at the end may go on in the next chunk
+            last = _LAST_SPACE.search(pending)
+            if last is not None:
+                cut = last.end()
+                yield from self._tokenize_runs(pending, cut, offset, continued)
+                pending = pending[cut:]
+                offset += cut
+                continued = False
+            # cut the run where _tokenize_runs would if it had all of it
+            while len(pending) > MAX_RUN:
+                cut = _cut_run(pending)
+                yield from self._tokenize_words(pending[:cut], offset)
+                pending = pending[cut:]
+                offset += cut
+                continued = True
+        yield from self._tokenize_runs(pending, len(pending), offset, continued)
+        
+    def _tokenize_runs(self, text, stop, offset, continued=False):
+        """
+        Generator (Token) over the runs of text[:stop], text being at offset.
+        If continued, text starts with the rest of a run longer than MAX_RUN.
+        """
+        for run in _RUN.finditer(text, 0, stop):
+            start = offset + run.start()
+            if (continued and run.start() == 0) or len(run.group()) > MAX_RUN:
+                yield from self._tokenize_long_run(run.group(), start)
+                continue
+            word = self.normalize(run.group())
+            ipa = self._d.get(word)
+            if ipa:
+                yield Token(run.group(), start, offset + run.end(), word, ipa)
+                continue
+            yield from self._tokenize_words(run.group(), start)
+            
+    def _tokenize_long_run(self, run, start):
+        """Generator (Token) over the pieces of run (see _cut_run), run being at start"""
+        while len(run) > MAX_RUN:
+            cut = _cut_run(run)
+            yield from self._tokenize_words(run[:cut], start)
+            run = run[cut:]
+            start += cut
+        yield from self._tokenize_words(run, start)
+        
+    def _tokenize_words(self, text, start):
+        """Generator (Token) over the numbers and words of text, text being at start"""
+        for match in _TOKEN.finditer(text):
+            word = self.normalize(match.group())
+            yield Token(
+                match.group(), start + match.start(), start + match.end(),
+                word, self.lookup(word)
+            )
@@ -0,0 +1,107 @@
+"""
+Tracing of rule parsing and application.
+
+Messages are only formatted when their level is enabled: pass either a
+format string plus its arguments, or a callable returning the message.
+    trace(DEBUG, "context index {}: {}", i, context[i])
+    trace(DEBUG, lambda: "".join(str(x) for x in context))
+In hot loops, check TRACER.level first so that not even the arguments are
+built while tracing is off.
+
+Messages go to every sink in TRACER.sinks. A sink is any callable taking
+(level, message). Tracing can be limited to a block of code (eg one input)
+with TRACER.scope(), and to rules with particular names with TRACER.rules.
+"""
+
+import sys
+from contextlib import contextmanager
+
+
+# levels
+OFF = 0
+INFO = 1  # rules applied, matches and transformations
+DEBUG = 2  # everything, including parsing and matching node by node
+
+
+def print_sink(level, message):
+    print(message)
+
+
+class StreamSink:
+    """Writes messages to a file object"""
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        
+    def __call__(self, level, message):
+        self.stream.write(message + "\n")
+
+
+class ListSink(list):
+    """Collects messages in a list"""
+    def __call__(self, level, message):
+        self.append(message)
+
+
+class Tracer:
+    """
+    Attributes
+    ------------------------
+    level: int
+        Highest level of message that is traced. OFF disables tracing.
+    sinks: list of callable (level, message)
+        Destinations of traced messages
+    rules: set of str or None
+        If not None, only rules whose name is in rules are traced
+    """
+    def __init__(self, level=OFF, sinks=None, rules=None):
+        self.level = level
+        self.sinks = list(sinks) if sinks else []
+        self.rules = rules
+        
+    def __call__(self, level, message, *args, i=0):
+        if level > self.level:
+            return
+        if callable(message):
+            message = message()
+        elif args:
+            message = message.format(*args)
+        if i:
+            message = "  " * i + message
+        for sink in self.sinks:
+            sink(level, message)
+            
+    @contextmanager
+    def scope(self, level=DEBUG, sink=None, rules=None):
+        """
+        Traces at level inside the with block, to sink in addition to the
+        existing sinks, and limited to rules if given.
+            with TRACER.scope(DEBUG, ListSink()) as sink:
+                pipeline.transcribe(text)
+        """
+        saved = self.level, self.sinks, self.rules
+        self.level = level
+        if sink is not None:
+            self.sinks = self.sinks + [sink]
+        if rules is not None:
+            self.rules = set(rules)
+        try:
+            yield sink
+        finally:
+            self.level, self.sinks, self.rules = saved
+            
+    @contextmanager
+    def rule_scope(self, rule):
+        """Disables tracing inside the with block if rule is filtered out by self.rules"""
+        if self.rules is None or rule.name in self.rules:
+            yield
+            return
+        level = self.level
+        self.level = OFF
+        try:
+            yield
+        finally:
+            self.level = level
+
+
+TRACER = Tracer()
+trace = TRACER
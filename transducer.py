@@ -0,0 +1,318 @@
+"""
+Optional compiled engine for rulesets.
+
+A Rule whose environments are all of fixed width (no zero-plus nodes, Greek
+letters or <> brackets) only ever looks at a bounded window around each
+position of the context: a known number of Segments to the left and to the
+right, plus the boundaries in between. Such a Rule is compiled into a
+RuleTransducer. Each symbol is reduced to its class (the MetaSegments of the
+Rule it matches), and whether the Rule applies is decided once per distinct
+window of classes and looked up from then on. This is the Rule's transducer,
+determinized lazily over the windows that actually occur: it can't be built
+up front, because the alphabet isn't closed (transformations can make feature
+bundles that aren't in any inventory).
+
+A RulesetTransducer composes runs of consecutive compiled Rules into one
+chain, so that an utterance goes through them in a single pass, each symbol
+going on to the next Rule as soon as the one before it is done with it.
+Rules that can't be compiled are applied by the interpreter (Rule.apply)
+between chains. Either way, the result is the same as applying every Rule
+with Rule.apply in turn.
+"""
+
+from bisect import bisect_left
+from rules import Environment, apply_rules
+from init import *
+
+
+# The decisions of a RuleTransducer are cleared when there are more than this
+MAX_DECISIONS = 1 << 16
+
+# Symbols that may be dropped from the start of the window at once
+_TRIM = 64
+
+
+def _reach(env):
+    """
+    Returns the most Segments that matching env can consume, or None if it is
+    unbounded (env contains a zero-plus node)
+    """
+    reach = 0
+    for node in env.nodes:
+        if node.zero_plus:
+            return None
+        if node.kind == Environment.Node.SEGMENT:
+            reach += 1
+        elif node.kind == Environment.Node.OPTIONAL:
+            sub_reach = _reach(node.value)
+            if sub_reach is None:
+                return None
+            reach += sub_reach
+        elif node.kind == Environment.Node.POSSIBILITIES:
+            sub_reaches = [_reach(sub_env) for sub_env in node.value]
+            if None in sub_reaches:
+                return None
+            reach += max(sub_reaches)
+    return reach
+
+
+def _metasegments(env):
+    """Generator over the MetaSegments of env, including those of its subenvironments"""
+    for node in env.nodes:
+        if node.kind == Environment.Node.SEGMENT:
+            yield node.value
+        elif node.kind == Environment.Node.OPTIONAL:
+            yield from _metasegments(node.value)
+        elif node.kind == Environment.Node.POSSIBILITIES:
+            for sub_env in node.value:
+                yield from _metasegments(sub_env)
+
+
+def _environments(rule):
+    return [env for env in (rule.core, rule.left_environment, rule.right_environment) if env]
+
+
+def is_compilable(rule):
+    """Returns True if rule can be compiled into a RuleTransducer"""
+    for env in _environments(rule):
+        if _reach(env) is None:
+            return False
+        for meta in _metasegments(env):
+            if meta.greek_feats or meta.bracketed is not None:
+                return False
+    return True
+
+
+class RuleTransducer:
+    """
+    Applies a compilable Rule to a stream of symbols (Segments/boundaries).
+    
+    The window of a position i is everything from the (left_reach + 1)th
+    Segment before i (or the start of the context) up to the
+    (right_reach + 1)th Segment from i (or the end of the context). Matching
+    the Rule at i reads nothing outside of it, and only reads Segments
+    through MetaSegment.matches, so the classes of the window decide the
+    match.
+    
+    Attributes
+    ------------------------
+    rule: Rule
+    left_reach: int or None
+        Most Segments the left environment can consume, None if there is no
+        left environment
+    right_reach: int
+        Most Segments the core and the right environment can consume
+    metas: tuple of MetaSegment
+        Every distinct MetaSegment of the Rule. The class of a Segment has
+        bit k set if it matches metas[k]; the class of a boundary is itself.
+    """
+    def __init__(self, rule):
+        if not is_compilable(rule):
+            raise ValueError("Rule can't be compiled: {}".format(rule))
+        self.rule = rule
+        if rule.left_environment:
+            self.left_reach = _reach(rule.left_environment)
+        else:
+            self.left_reach = None
+        self.right_reach = _reach(rule.core)
+        if rule.right_environment:
+            self.right_reach += _reach(rule.right_environment)
+            
+        metas = []
+        for env in _environments(rule):
+            for meta in _metasegments(env):
+                if meta not in metas:
+                    metas.append(meta)
+        self.metas = tuple(metas)
+        self._core_start = self._class_filter(rule.core_start)
+        self._left_end = self._class_filter(rule.left_end)
+        
+        self._classes = {}
+        self._decisions = {}
+        
+    def _class(self, symbol):
+        if symbol in BOUNDARIES:
+            return symbol
+        cls = 0
+        for k, meta in enumerate(self.metas):
+            if meta.matches(symbol):
+                cls |= 1 << k
+        return cls
+        
+    def _class_filter(self, node):
+        """
+        Returns node of the Rule's prefilter (see Rule.build_prefilter) as
+        (mask of the Segment classes it accepts, boundaries it accepts), or
+        None if there is no node
+        """
+        if node is None:
+            return None
+        if node.kind == Environment.Node.BOUNDARY:
+            return 0, BOUNDARIES if node.value == SYLL_B else frozenset((node.value,))
+        return 1 << self.metas.index(node.value), frozenset()
+        
+    def _match(self, context, i):
+        """Returns the core Match if the Rule applies at context[i], otherwise None"""
+        rule = self.rule
+        core_match = rule.core.matcher().match(context, i)
+        if not core_match:
+            return None
+        if rule.left_environment:
+            if not rule.left_environment.matcher(reverse=True).match(context, i - 1):
+                return None
+        if rule.right_environment:
+            if not rule.right_environment.matcher().match(context, core_match.range[1]):
+                return None
+        return core_match
+        
+    def run(self, symbols):
+        """Generator over the result of applying the Rule to the iterable symbols"""
+        rule = self.rule
+        crosses_boundaries = rule.core.crosses_boundaries
+        left_crosses_boundaries = rule.left_environment and rule.left_environment.crosses_boundaries
+        core_start = self._core_start
+        left_end = self._left_end
+        left_reach = self.left_reach
+        right_reach = self.right_reach
+        classes = self._classes
+        decisions = self._decisions
+        
+        symbols = iter(symbols)
+        done = False
+        window = []  # symbols from the start of the window of i
+        window_classes = []
+        segment_indexes = []  # indexes of the Segments in window
+        i = 0
+        while True:
+            # forget what no window will need again, every _TRIM symbols or so
+            if i >= 2 * _TRIM:
+                if left_reach is None:
+                    keep = i
+                else:
+                    r = bisect_left(segment_indexes, i)
+                    keep = segment_indexes[r - left_reach - 1] if r > left_reach else 0
+                if keep >= _TRIM:
+                    del window[:keep]
+                    del window_classes[:keep]
+                    segment_indexes = [j - keep for j in segment_indexes[bisect_left(segment_indexes, keep):]]
+                    i -= keep
+                    
+            # read ahead up to the end of the window
+            r = bisect_left(segment_indexes, i)
+            while not done and len(segment_indexes) - r <= right_reach:
+                try:
+                    symbol = next(symbols)
+                except StopIteration:
+                    done = True
+                    break
+                cls = classes.get(symbol)
+                if cls is None:
+                    cls = classes[symbol] = self._class(symbol)
+                if cls.__class__ is int:
+                    segment_indexes.append(len(window))
+                window.append(symbol)
+                window_classes.append(cls)
+            if i >= len(window):
+                return
+                
+            symbol = window[i]
+            if crosses_boundaries and symbol in BOUNDARIES:
+                yield symbol
+                i += 1
+                continue
+            # the Rule's prefilter, on classes
+            if core_start is not None:
+                cls = window_classes[i]
+                if not (cls & core_start[0] if cls.__class__ is int else cls in core_start[1]):
+                    yield symbol
+                    i += 1
+                    continue
+            if left_end is not None:
+                j = (segment_indexes[r - 1] if r else -1) if left_crosses_boundaries else i - 1
+                cls = window_classes[j] if j >= 0 else None
+                if cls is None or not (cls & left_end[0] if cls.__class__ is int else cls in left_end[1]):
+                    yield symbol
+                    i += 1
+                    continue
+                    
+                
+            if left_reach is None:
+                start = i
+            elif r > left_reach:
+                start = segment_indexes[r - left_reach - 1]
+            else:
+                start = 0
+            if r + right_reach < len(segment_indexes):
+                end = segment_indexes[r + right_reach] + 1
+            else:
+                end = len(window)
+            key = (i - start, tuple(window_classes[start:end]))
+            
+            matches = decisions.get(key)
+            if matches is None:
+                core_match = self._match(window, i)
+                matches = core_match is not None
+                if len(decisions) >= MAX_DECISIONS:
+                    decisions.clear()
+                decisions[key] = matches
+            elif matches:
+                core_match = rule.core.matcher().match(window, i)
+                
+            if matches:
+                for new_symbol in rule.transformation.apply(core_match, rule.core):
+                    if new_symbol != NULL:
+                        yield new_symbol
+                if core_match.range[1] == core_match.range[0]:
+                    yield symbol
+                    i = core_match.range[1] + 1
+                else:
+                    i = core_match.range[1]
+            else:
+                yield symbol
+                i += 1
+    
+    def apply(self, context):
+        return list(self.run(context))
+
+
+class RulesetTransducer:
+    """
+    Applies a list of Rules, compiling those that can be.
+    
+    Attributes
+    ------------------------
+    rules: list of Rule
+    stages: list of RuleTransducer or Rule
+        One per Rule: a RuleTransducer for every compilable Rule, otherwise
+        the Rule itself, to be applied by the interpreter
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.stages = [
+            RuleTransducer(rule) if is_compilable(rule) else rule
+            for rule in rules
+        ]
+        
+    @property
+    def compiled(self):
+        """The Rules that are compiled"""
+        return [stage.rule for stage in self.stages if isinstance(stage, RuleTransducer)]
+        
+    def run(self, segments, start=0, stop=None):
+        """
+        Returns an iterator over the result of applying rules[start:stop] to
+        segments. Runs of compiled Rules are chained lazily; an interpreted
+        Rule needs the whole context, so it consumes the chain before it.
+        """
+        stream = iter(segments)
+        for stage in self.stages[start:stop]:
+            if isinstance(stage, RuleTransducer):
+                stream = stage.run(stream)
+            else:
+                stream = iter(stage.apply(list(stream)))
+        return stream
+        
+    def apply(self, segments, start=0, stop=None):
+        return apply_rules(
+            self.rules[start:stop], segments, lambda segments: list(self.run(segments, start, stop))
+        )
@@ -0,0 +1,315 @@
+"""
+Optional whole-context engine for rulesets.
+
+The interpreter (Rule.apply) tries a Rule position by position, running
+Matchers at each. Here, the context is instead turned once per Rule pass into
+one big int with a 64-bit lane per symbol, holding its packed features (see
+segment.pack_features), its stress and whether it is a boundary. Testing a
+MetaSegment at every position then takes a few big int operations, and an
+environment made only of Segment, boundary and null nodes is matched at
+every position at once: the test of each node is shifted by the node's offset
+in the environment and ANDed with the others. Environments that skip
+boundaries are matched the same way over the Segments of the context alone.
+
+This gives the positions where the core matches and the ones where each
+environment matches, so the Rule is applied at those positions only. A Rule
+whose core isn't of that kind (zero-plus nodes, optional nodes or
+possibilities, Greek letters or <> brackets) is applied by the interpreter;
+environments that aren't are matched by Matchers at the remaining positions.
+Either way, the result is the same as applying every Rule with Rule.apply in
+turn.
+"""
+
+from bisect import bisect_left
+from rules import Environment, apply_rules
+from segment import STRESS_BITS, NEG_SHIFT
+from nearest import lanes_to_int
+from init import *
+
+
+_LANE = 64
+
+# Layout of the lane of a symbol, above the packed features of a Segment
+_STRESS_SHIFT = 2 * NEG_SHIFT
+_SYLL_FLAG = 1 << 56
+_WORD_FLAG = 1 << 57
+
+# Added to every lane to carry a nonzero lane (below 2 ** 63) into bit 63
+_CARRY = (1 << 63) - 1
+
+
+class _Codes(dict):
+    """{symbol: its lane}, filled on first use"""
+    def __missing__(self, symbol):
+        if symbol == SYLL_B:
+            code = _SYLL_FLAG
+        elif symbol == WORD_B:
+            code = _WORD_FLAG
+        else:
+            code = symbol.bits | (STRESS_BITS[symbol.stress] << _STRESS_SHIFT)
+        self[symbol] = code
+        return code
+
+
+_CODES = _Codes()
+_ONES = {}
+
+
+def _ones(n):
+    """Returns the big int with a 1 in each of n lanes"""
+    ones = _ONES.get(n)
+    if ones is None:
+        ones = _ONES[n] = ((1 << (_LANE * n)) - 1) // ((1 << _LANE) - 1)
+    return ones
+
+
+def _nonzero(lanes, ones):
+    """Returns 1 in each lane of lanes that is nonzero, 0 in the others"""
+    return ((lanes + _CARRY * ones) >> (_LANE - 1)) & ones
+
+
+def _flags(mask, n):
+    """Returns the n lanes of a mask of 0s and 1s as bytes, one per lane"""
+    return mask.to_bytes(n * _LANE // 8, "little")[::_LANE // 8]
+
+
+def is_simple(env):
+    """
+    Returns True if env is made only of Segment, boundary and null nodes,
+    without zero-plus nodes, Greek letters or <> brackets
+    """
+    for node in env.nodes:
+        if node.zero_plus:
+            return False
+        if node.kind == Environment.Node.SEGMENT:
+            if node.value.greek_feats or node.value.bracketed is not None:
+                return False
+        elif node.kind not in (Environment.Node.BOUNDARY, Environment.Node.NULL):
+            return False
+    return True
+
+
+def is_vectorizable(rule):
+    return is_simple(rule.core)
+
+
+class _Space:
+    """
+    Lanes of a sequence of symbols
+    
+    Attributes
+    ------------------------
+    n: int
+        Number of symbols
+    lanes: int
+        Big int with the lane of symbol k (see _Codes) in lane k
+    ones: int
+        Big int with a 1 in each lane
+    """
+    __slots__ = ("n", "lanes", "ones")
+    def __init__(self, symbols):
+        self.n = len(symbols)
+        self.lanes = lanes_to_int(map(_CODES.__getitem__, symbols))
+        self.ones = _ones(self.n)
+
+
+class VectorEnvironment:
+    """
+    A simple Environment (see is_simple), matched at every lane at once
+    
+    Attributes
+    ------------------------
+    environment: Environment
+    reverse: bool
+        If True, the Environment is matched ending at each lane (as a left
+        environment is), otherwise starting at it
+    crosses_boundaries: bool
+        If True, the Environment is matched over the Segments alone
+    tests: list of (Environment.Node, int)
+        Each node with its offset in lanes from the start of the match, or if
+        reverse, back from its end
+    """
+    def __init__(self, environment, reverse=False):
+        self.environment = environment
+        self.reverse = reverse
+        self.crosses_boundaries = environment.crosses_boundaries
+        nodes = environment.nodes
+        if reverse:
+            nodes = list(reversed(nodes))
+        self.tests = []
+        offset = 0
+        for node in nodes:
+            self.tests.append((node, offset))
+            if node.kind != Environment.Node.NULL:
+                offset += 1
+    
+    @staticmethod
+    def node_test(node, space):
+        """Returns the mask of the lanes of space that node matches"""
+        lanes = space.lanes
+        ones = space.ones
+        if node.kind == Environment.Node.SEGMENT:
+            meta = node.value
+            mismatch = _nonzero((lanes & (meta.match_bits * ones)) ^ (meta.value_bits * ones), ones)
+            # boundaries have no stress bits, so never match
+            stress = _nonzero(lanes & ((meta.stress_bits << _STRESS_SHIFT) * ones), ones)
+            return stress & ~mismatch
+        if node.kind == Environment.Node.BOUNDARY:
+            if node.value == SYLL_B:
+                return _nonzero(lanes & ((_SYLL_FLAG | _WORD_FLAG) * ones), ones)
+            return _nonzero(lanes & (_WORD_FLAG * ones), ones)
+        # a null node only needs there to be a symbol
+        return ones
+        
+    def match(self, space):
+        """Returns the mask of the lanes of space the Environment matches at"""
+        result = space.ones
+        for node, offset in self.tests:
+            test = self.node_test(node, space)
+            if self.reverse:
+                result &= test << (_LANE * offset)
+            else:
+                result &= test >> (_LANE * offset)
+            if not result:
+                break
+        return result
+
+
+class VectorRule:
+    """
+    A Rule whose core is simple (see is_vectorizable), applied by matching
+    its core and simple environments over the whole context
+    
+    Attributes
+    ------------------------
+    rule: Rule
+    core: VectorEnvironment
+    left, right: VectorEnvironment or Environment or None
+        The environments of the Rule: VectorEnvironments if they are
+        simple, otherwise matched with Matchers
+    """
+    def __init__(self, rule):
+        self.rule = rule
+        self.core = VectorEnvironment(rule.core)
+        self.left = self._environment(rule.left_environment, reverse=True)
+        self.right = self._environment(rule.right_environment)
+        
+    @staticmethod
+    def _environment(env, reverse=False):
+        if not env:
+            return None
+        if is_simple(env):
+            return VectorEnvironment(env, reverse=reverse)
+        return env
+        
+    def apply(self, context):
+        rule = self.rule
+        core = rule.core
+        seg_pos = None
+        spaces = {}
+        if self.core.crosses_boundaries or any(
+            isinstance(env, VectorEnvironment) and env.crosses_boundaries
+            for env in (self.left, self.right)
+        ):
+            seg_pos = [i for i, symbol in enumerate(context) if symbol not in BOUNDARIES]
+            
+        def flags(env):
+            """Returns the lanes env matches at, one byte each"""
+            crosses = env.crosses_boundaries
+            space = spaces.get(crosses)
+            if space is None:
+                space = spaces[crosses] = _Space(
+                    [context[i] for i in seg_pos] if crosses else context
+                )
+            return _flags(env.match(space), space.n)
+            
+        core_flags = flags(self.core)
+        if not any(core_flags):
+            return list(context)
+        if self.core.crosses_boundaries:
+            candidates = [seg_pos[k] for k, flag in enumerate(core_flags) if flag]
+        else:
+            candidates = [i for i, flag in enumerate(core_flags) if flag]
+            
+        left = self.left
+        if isinstance(left, VectorEnvironment):
+            left_flags = flags(left)
+            if left.crosses_boundaries:
+                # matched from the nearest Segment before each candidate
+                before = [bisect_left(seg_pos, i) - 1 for i in candidates]
+            else:
+                before = [i - 1 for i in candidates]
+            candidates = [i for i, k in zip(candidates, before) if k >= 0 and left_flags[k]]
+            if not candidates:
+                return list(context)
+                
+        right = self.right
+        if isinstance(right, VectorEnvironment):
+            right_flags = flags(right)
+            
+        result = []
+        i = 0
+        for start in candidates:
+            if start < i:
+                continue
+            if left is not None and not isinstance(left, VectorEnvironment):
+                if not left.matcher(reverse=True).match(context, start - 1):
+                    continue
+            core_match = core.matcher().match(context, start)
+            end = core_match.range[1]
+            if right is not None:
+                if isinstance(right, VectorEnvironment):
+                    if right.crosses_boundaries:
+                        k = bisect_left(seg_pos, end)
+                        matches = k < len(seg_pos) and right_flags[k]
+                    else:
+                        matches = end < len(context) and right_flags[end]
+                else:
+                    matches = right.matcher().match(context, end)
+                if not matches:
+                    continue
+                    
+            result += context[i:start]
+            result += rule.transformation.apply(core_match, core)
+            if end == start:
+                result.append(context[start])
+                i = start + 1
+            else:
+                i = end
+        result += context[i:]
+        return [x for x in result if x != NULL]
+
+
+class VectorizedRuleset:
+    """
+    Applies a list of Rules, evaluating those that can be over the whole
+    context.
+    
+    Attributes
+    ------------------------
+    rules: list of Rule
+    stages: list of VectorRule or Rule
+        One per Rule: a VectorRule for every vectorizable Rule, otherwise
+        the Rule itself, to be applied by the interpreter
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.stages = [
+            VectorRule(rule) if is_vectorizable(rule) else rule
+            for rule in rules
+        ]
+        
+    @property
+    def vectorized(self):
+        """The Rules that are vectorized"""
+        return [stage.rule for stage in self.stages if isinstance(stage, VectorRule)]
+        
+    def apply(self, segments, start=0, stop=None):
+        return apply_rules(
+            self.rules[start:stop], segments, lambda segments: self._apply_stages(segments, start, stop)
+        )
+        
+    def _apply_stages(self, segments, start, stop):
+        for stage in self.stages[start:stop]:
+            segments = stage.apply(segments)
+        return segments